@@ -0,0 +1,50 @@
+"""
+既存の設定アイテムに userEmailKey（UserEmailIndexのキー）を付けるスクリプト。
+UserEmailIndexを追加してから一度だけ実行する。何度実行しても結果は変わらない。
+
+    SETTINGS_TABLE_NAME=<テーブル名> python backfill_user_email_key.py [--dry-run]
+"""
+import argparse
+from botocore.exceptions import ClientError
+
+from utils.db import get_table, iter_settings, user_email_key
+
+
+def backfill(table, items, dry_run=False):
+    """userEmailKeyがない・古いアイテムを更新し、更新件数を返す"""
+    updated = 0
+    for item in items:
+        key = user_email_key(item['userEmail'])
+        if not key or item.get('userEmailKey') == key:
+            continue
+        if dry_run:
+            print(f"Would set userEmailKey={key} for {item['userEmail']}")
+            updated += 1
+            continue
+        try:
+            table.update_item(
+                Key={'gtfsRtEndpoint': item['gtfsRtEndpoint'], 'userEmail': item['userEmail']},
+                UpdateExpression='SET userEmailKey = :key',
+                # 実行中に削除されたアイテムを作り直さない
+                ConditionExpression='attribute_exists(gtfsRtEndpoint)',
+                ExpressionAttributeValues={':key': key},
+            )
+            updated += 1
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                raise
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill userEmailKey for UserEmailIndex')
+    parser.add_argument('--dry-run', action='store_true', help='更新せずに対象を表示する')
+    args = parser.parse_args()
+
+    items = iter_settings(attributes=['gtfsRtEndpoint', 'userEmail', 'userEmailKey'])
+    updated = backfill(get_table(), items, dry_run=args.dry_run)
+    print(f"{'Would update' if args.dry_run else 'Updated'} {updated} items")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+Lambdaハンドラーごとのコールドスタートを測るベンチマーク。
+ハンドラーごとに新しいPythonプロセスを起動し、モジュールのimport時間と、1回目（コールド）・2回目（ウォーム）の
+呼び出しのレイテンシを測る。AWSへのHTTPリクエストはbotocoreの送信部分で空の応答に差し替えるので、
+boto3のクライアント・リソースの作成やリクエストの組み立ては実際と同じように時間に含まれる。
+SMTP・Mattermost・GTFS-RTフィードへの送信もモックする。
+
+    cd lambda && python -m benchmarks.bench_cold_start --repeat 5
+    cd lambda && python -m benchmarks.bench_cold_start --importtime   # import時間の内訳（上位）も出す
+
+Lambdaの128MBの関数はCPUの割り当ても小さいので、実際のコールドスタートはこの値より長くなる。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+LAMBDA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ハンドラーごとの (モジュール, 関数, イベント)
+HANDLERS = {
+    'handler.GET': ('handler', 'main', {
+        'httpMethod': 'GET', 'queryStringParameters': {'email': 'user@example.com'},
+    }),
+    'handler.POST': ('handler', 'main', {
+        'httpMethod': 'POST', 'body': json.dumps({
+            'gtfs_rt_endpoint': 'data', 'user_email': 'user@example.com@device',
+            'gtfs_endpoint': 'https://example.com/gtfs', 'webhook_url': 'https://example.com/webhook',
+        }),
+    }),
+    'delete_alert': ('delete_alert', 'handler', {
+        'httpMethod': 'GET', 'queryStringParameters': {'userEmail': 'user@example.com@device'},
+    }),
+    'mattermost_handler.email': ('mattermost_handler', 'handler', {
+        'body': json.dumps({'email': 'user@example.com', 'alarm_settings': {'details': {'label': 'test'}}}),
+    }),
+    'scheduled_task': ('scheduled_task', 'scheduled_task', {}),
+}
+
+# 子プロセスで実行する計測コード
+CHILD = r'''
+import json, sys, time
+started = time.perf_counter()
+module = __import__(sys.argv[1])
+import_ms = (time.perf_counter() - started) * 1000
+
+from unittest.mock import MagicMock, patch
+from botocore.awsrequest import AWSResponse
+
+def send(self, request):
+    # DynamoDBなどへのリクエストには空のJSONを返す
+    raw = MagicMock()
+    raw.stream.return_value = [b'{}']
+    return AWSResponse(request.url, 200, {'Content-Type': 'application/x-amz-json-1.0'}, raw)
+
+function = getattr(module, sys.argv[2])
+event = json.loads(sys.argv[3])
+timings = []
+with patch('botocore.httpsession.URLLib3Session.send', send), \
+        patch('smtplib.SMTP'), \
+        patch('utils.http.post', return_value=MagicMock(status_code=200)), \
+        patch('utils.http.get', return_value=MagicMock(status_code=304)), \
+        patch('builtins.print'):
+    for _ in range(2):
+        started = time.perf_counter()
+        function(dict(event), None)
+        timings.append((time.perf_counter() - started) * 1000)
+sys.stdout.write(json.dumps({'import_ms': import_ms, 'first_call_ms': timings[0], 'warm_call_ms': timings[1]}))
+'''
+
+ENV = {
+    'AWS_DEFAULT_REGION': 'ap-northeast-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'SETTINGS_TABLE_NAME': 'settings',
+    'SETTINGS_TABLE_NAME_FOR_TRACE': 'settings-trace',
+    'MATTERMOST_WEBHOOK_URL': 'https://example.com/mattermost',
+    'SMTP_HOST': 'smtp.example.com',
+    'SMTP_USER': 'user',
+    'SMTP_PASSWORD': 'password',
+    'SENDER_EMAIL': 'sender@example.com',
+    'LOG_LEVEL': 'ERROR',
+}
+
+
+def measure(name, importtime=False):
+    module, function, event = HANDLERS[name]
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', CHILD, module, function, json.dumps(event)]
+    completed = subprocess.run(command, cwd=LAMBDA_DIR, env={**os.environ, **ENV},
+                               capture_output=True, text=True, check=True)
+    result = json.loads(completed.stdout)
+    if importtime:
+        result['top_imports'] = _top_imports(completed.stderr, module)
+    return result
+
+
+def _top_imports(stderr, module, limit=10):
+    """-X importtime の出力から、ハンドラーのモジュールが直接importしたものを累積時間の大きい順に返す"""
+    children = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            if name.strip() == module:
+                break
+            # ハンドラーより前のトップレベルのimport（インタープリターの起動など）は数えない
+            children = []
+        elif depth == 1:
+            children.append((int(cumulative_us), name.strip()))
+    return [{'module': name, 'cumulative_ms': round(us / 1000, 1)} for us, name in sorted(children, reverse=True)[:limit]]
+
+
+def run(names, repeat, importtime=False):
+    rows = []
+    for name in names:
+        samples = [measure(name) for _ in range(repeat)]
+        row = {'handler': name}
+        for key in ('import_ms', 'first_call_ms', 'warm_call_ms'):
+            row[key] = round(statistics.median(sample[key] for sample in samples), 1)
+        if importtime:
+            row['top_imports'] = measure(name, importtime=True)['top_imports']
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start import time and first-invocation latency per handler')
+    parser.add_argument('--handlers', nargs='+', choices=sorted(HANDLERS), default=list(HANDLERS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--importtime', action='store_true', help='import時間の内訳（上位10件）も出力する')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力する')
+    args = parser.parse_args()
+
+    rows = run(args.handlers, args.repeat, importtime=args.importtime)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"{'handler':>26} {'import ms':>10} {'1st call ms':>12} {'warm ms':>9}")
+    for row in rows:
+        print(f"{row['handler']:>26} {row['import_ms']:>10} {row['first_call_ms']:>12} {row['warm_call_ms']:>9}")
+        for item in row.get('top_imports', []):
+            print(f"{'':>28}{item['module']}: {item['cumulative_ms']} ms")
+
+
+if __name__ == '__main__':
+    main()
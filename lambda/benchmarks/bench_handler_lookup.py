@@ -0,0 +1,156 @@
+"""
+handler.main の GET（メールアドレス）・DELETE（id）のレイテンシを、設定テーブルの件数を変えて測るベンチマーク。
+DynamoDBはメモリ上の偽テーブルで置き換え、1リクエストごとに --rtt-ms の往復時間を足す。
+比較のため、以前のスキャンして絞り込む方式のGETも測る。
+
+    cd lambda && python -m benchmarks.bench_handler_lookup --sizes 1000 10000 100000
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+from collections import defaultdict
+from unittest.mock import patch
+
+import handler
+from utils.db import user_email_key, with_user_email_key
+
+GTFS_RT_ENDPOINTS = ('odpt_jreast', 'data', 'yanbaru-expressbus')
+
+
+class FakeTable:
+    """Scan・Query（GSI）・書き込みだけを持つ設定テーブルの代わり。1MB相当のページを page_size 件で近似する"""
+
+    def __init__(self, items, page_size=1000, rtt_seconds=0.0):
+        self.items = items
+        self.page_size = page_size
+        self.rtt_seconds = rtt_seconds
+        self.requests = 0
+        self.version = 0
+        self._indexes = {'IdIndex': defaultdict(list), 'UserEmailIndex': defaultdict(list)}
+        for item in items:
+            self._indexes['IdIndex'][item['id']].append(item)
+            if 'userEmailKey' in item:
+                self._indexes['UserEmailIndex'][item['userEmailKey']].append(item)
+
+    def _round_trip(self):
+        self.requests += 1
+        if self.rtt_seconds:
+            time.sleep(self.rtt_seconds)
+
+    def scan(self, **kwargs):
+        self._round_trip()
+        start = kwargs.get('ExclusiveStartKey', {}).get('offset', 0)
+        end = start + self.page_size
+        response = {'Items': self.items[start:end]}
+        if end < len(self.items):
+            response['LastEvaluatedKey'] = {'offset': end}
+        return response
+
+    def query(self, IndexName, KeyConditionExpression, **kwargs):
+        self._round_trip()
+        value = KeyConditionExpression.get_expression()['values'][1]
+        return {'Items': list(self._indexes[IndexName].get(value, []))}
+
+    def update_item(self, **kwargs):
+        self._round_trip()
+        self.version += 1
+        return {'Attributes': {'version': self.version}}
+
+    def put_item(self, **kwargs):
+        self._round_trip()
+
+    def delete_item(self, **kwargs):
+        # 件数を保つため実際には消さない
+        self._round_trip()
+
+
+def make_items(size):
+    items = []
+    for i in range(size):
+        items.append(with_user_email_key({
+            'gtfsRtEndpoint': GTFS_RT_ENDPOINTS[i % len(GTFS_RT_ENDPOINTS)],
+            'userEmail': f'user{i}@example.com@device{i}',
+            'id': f'id-{i}',
+            'webhook_url': 'https://example.com/webhook',
+            'filters': {'trip_id': f'trip{i}'},
+            'details': {},
+        }))
+    return items
+
+
+def legacy_get(table, email):
+    """以前のGET: 全件スキャンしてPythonで絞り込む"""
+    settings = []
+    kwargs = {}
+    while True:
+        response = table.scan(**kwargs)
+        settings.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return [setting for setting in settings if user_email_key(setting['userEmail']) == email]
+
+
+def _measure(call, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(samples), 3)
+
+
+def run(sizes, repeat, rtt_ms, legacy_max_size):
+    rows = []
+    for size in sizes:
+        table = FakeTable(make_items(size), rtt_seconds=rtt_ms / 1000)
+        rng = random.Random(size)
+
+        def get():
+            email = f'user{rng.randrange(size)}@example.com'
+            return handler.main({'httpMethod': 'GET', 'queryStringParameters': {'email': email}}, None)
+
+        def delete():
+            item_id = f'id-{rng.randrange(size)}'
+            return handler.main({'httpMethod': 'DELETE', 'pathParameters': {'id': item_id}}, None)
+
+        row = {'size': size}
+        # 計測中のログ出力は捨てる
+        with patch('handler.get_table', return_value=table), patch('builtins.print'):
+            table.requests = 0
+            row['get_ms'] = _measure(get, repeat)
+            row['get_requests'] = table.requests / repeat
+            table.requests = 0
+            row['delete_ms'] = _measure(delete, repeat)
+            row['delete_requests'] = table.requests / repeat
+        if size <= legacy_max_size:
+            table.requests = 0
+            row['legacy_get_ms'] = _measure(lambda: legacy_get(table, f'user{rng.randrange(size)}@example.com'), repeat)
+            row['legacy_get_requests'] = table.requests / repeat
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='handler.main lookup latency vs. settings table size')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--rtt-ms', type=float, default=2.0, help='DynamoDBへの1リクエストあたりの往復時間')
+    parser.add_argument('--legacy-max-size', type=int, default=100000, help='これより大きい件数ではスキャン方式を測らない')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力する')
+    args = parser.parse_args()
+
+    rows = run(args.sizes, args.repeat, args.rtt_ms, args.legacy_max_size)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"{'size':>8} {'GET ms':>9} {'DELETE ms':>10} {'scan GET ms':>12} {'scan requests':>14}")
+    for row in rows:
+        print(f"{row['size']:>8} {row['get_ms']:>9} {row['delete_ms']:>10} "
+              f"{row.get('legacy_get_ms', '-'):>12} {row.get('legacy_get_requests', '-'):>14}")
+
+
+if __name__ == '__main__':
+    main()
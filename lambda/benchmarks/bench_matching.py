@@ -0,0 +1,180 @@
+"""
+照合のスループット（車両/秒）を合成データで測るベンチマーク。
+- check_conditions: 車両1台を設定の一部（--check-settings 件）と1件ずつ照合する
+- is_within_any_radius: 車両1台を全設定のtarget_areaと判定する
+- tick: フィード取得・設定の読み込み・Webhook送信をモックした scheduled_task の1ティック
+結果をJSONで出力し、保存したベースラインより --threshold 以上遅くなった項目があれば終了コード1で終わる。
+
+    cd lambda && python -m benchmarks.bench_matching --json
+    cd lambda && python -m benchmarks.bench_matching --write-baseline
+
+ベースラインの値は測ったマシンに依存するので、比較は同じマシン（CIなら同じランナー）で行う。
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+import scheduled_task
+from benchmarks.synthetic import FEED_URL, make_feed, make_settings, make_stops
+from utils.geo import is_within_any_radius
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def _median_seconds(call, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def _rate(vehicles, checks, seconds):
+    return {
+        'seconds': round(seconds, 6),
+        'vehicles_per_second': round(vehicles / seconds, 1),
+        'checks_per_second': round(checks / seconds, 1),
+    }
+
+
+def _reset_scheduler_state():
+    """ティックをまたいで使い回す状態を捨て、毎回すべての車両を照合させる"""
+    scheduled_task.settings_cache.clear()
+    scheduled_task.vehicle_snapshots.clear()
+    scheduled_task.vehicle_states.clear()
+
+
+def bench_check_conditions(vehicles, settings, now, repeat):
+    def run():
+        for vehicle in vehicles:
+            for setting in settings:
+                scheduled_task.check_conditions(vehicle, setting['filters'], FEED_URL, now=now)
+    return _rate(len(vehicles), len(vehicles) * len(settings), _median_seconds(run, repeat))
+
+
+def bench_within_any_radius(vehicles, settings, repeat):
+    areas = []
+    for setting in settings:
+        target_area = setting['filters'].get('target_area')
+        if target_area:
+            areas.append(target_area if isinstance(target_area, list) else [target_area])
+    locations = [[vehicle.position.longitude, vehicle.position.latitude] for vehicle in vehicles]
+
+    def run():
+        for location in locations:
+            for points in areas:
+                is_within_any_radius(location, points)
+    return _rate(len(vehicles), len(vehicles) * len(areas), _median_seconds(run, repeat))
+
+
+def bench_tick(feed, settings, repeat):
+    table = MagicMock()
+    table.get_item.return_value = {}
+
+    def run():
+        _reset_scheduler_state()
+        with patch('scheduled_task.fetch_feeds', side_effect=lambda urls: iter([(FEED_URL, feed)])):
+            scheduled_task.scheduled_task({}, None)
+
+    with patch('scheduled_task.get_table', return_value=table), \
+            patch('scheduled_task.load_all_settings', return_value=settings), \
+            patch('scheduled_task.trigger_webhook', return_value=200):
+        seconds = _median_seconds(run, repeat)
+    _reset_scheduler_state()
+    return _rate(len(feed.entity), len(feed.entity) * len(settings), seconds)
+
+
+def run(args):
+    now = datetime.utcnow()
+    stops = make_stops(args.stops, spread_km=args.spread_km, seed=args.seed)
+    feed = make_feed(args.vehicles, args.trips, stops=stops, spread_km=args.spread_km, seed=args.seed)
+    settings = make_settings(args.settings, args.trips, stops=stops, spread_km=args.spread_km, seed=args.seed, now=now)
+    vehicles = [entity.vehicle for entity in feed.entity]
+
+    def resolve_stop(stop_id, gtfs_rt_endpoint):
+        return stops.get(stop_id, (None, None, None))
+
+    results = {}
+    # 計測中のログ出力は捨て、停留所はBuTTERの代わりに合成データから引く
+    with patch('builtins.print'), patch('scheduled_task.get_stop_name', side_effect=resolve_stop):
+        results['check_conditions'] = bench_check_conditions(
+            vehicles, settings[:args.check_settings], now, args.repeat)
+        results['is_within_any_radius'] = bench_within_any_radius(vehicles, settings, args.repeat)
+        results['tick'] = bench_tick(feed, settings, args.repeat)
+    config = {name: getattr(args, name) for name in (
+        'vehicles', 'trips', 'stops', 'settings', 'check_settings', 'spread_km', 'seed')}
+    return {'config': config, 'results': results}
+
+
+def compare(report, baseline, threshold):
+    """ベースラインより vehicles_per_second が threshold（割合）以上下がった項目のリスト"""
+    regressions = []
+    for name, expected in baseline.get('results', {}).items():
+        actual = report['results'].get(name)
+        if actual is None:
+            continue
+        ratio = actual['vehicles_per_second'] / expected['vehicles_per_second']
+        if ratio < 1 - threshold:
+            regressions.append({
+                'name': name,
+                'baseline': expected['vehicles_per_second'],
+                'actual': actual['vehicles_per_second'],
+                'ratio': round(ratio, 3),
+            })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Matching throughput (vehicles/sec) on synthetic feeds')
+    parser.add_argument('--vehicles', type=int, default=2000)
+    parser.add_argument('--trips', type=int, default=500)
+    parser.add_argument('--stops', type=int, default=500)
+    parser.add_argument('--settings', type=int, default=2000)
+    parser.add_argument('--check-settings', type=int, default=100, help='check_conditionsで照合する設定の件数')
+    parser.add_argument('--spread-km', type=float, default=20.0, help='車両・停留所・範囲を散らばらせる一辺の長さ')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--threshold', type=float, default=0.25, help='これ以上の割合で遅くなったら失敗とする')
+    parser.add_argument('--write-baseline', action='store_true', help='結果をベースラインとして保存する')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力する')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.write_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f"Wrote baseline to {args.baseline}")
+
+    regressions = []
+    if not args.write_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != report['config']:
+            print('Baseline was measured with a different configuration; skipping comparison', file=sys.stderr)
+        else:
+            regressions = compare(report, baseline, args.threshold)
+    report['regressions'] = regressions
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'benchmark':>22} {'vehicles/s':>12} {'checks/s':>14}")
+        for name, result in report['results'].items():
+            print(f"{name:>22} {result['vehicles_per_second']:>12} {result['checks_per_second']:>14}")
+        for regression in regressions:
+            print(f"REGRESSION {regression['name']}: {regression['actual']} vehicles/s "
+                  f"(baseline {regression['baseline']}, x{regression['ratio']})")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+ベンチマーク用の合成データ（GTFS-RTのFeedMessageと通知設定）の生成。
+同じ引数と seed からは常に同じデータを作る。
+"""
+import math
+import random
+from datetime import datetime, timedelta
+
+from google.transit import gtfs_realtime_pb2
+
+FEED_URL = 'https://example.com/synthetic/vehicle_position.pb'
+# 生成する設定のフィルターの種類と既定の割合
+SETTING_MIX = {
+    'trip_id': 0.3,
+    'stop_id': 0.2,
+    'time': 0.1,
+    'weekday': 0.1,
+    'area': 0.2,
+    'multi_area': 0.1,
+}
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+METERS_PER_DEGREE = 111320
+
+
+def _offset(rng, center, spread_km):
+    """center（経度, 緯度）から spread_km 四方の範囲の点をランダムに選ぶ"""
+    lon, lat = center
+    half = spread_km * 1000 / 2
+    dy = rng.uniform(-half, half) / METERS_PER_DEGREE
+    dx = rng.uniform(-half, half) / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+    return lon + dx, lat + dy
+
+
+def make_stops(count, center=(139.7, 35.68), spread_km=20.0, seed=0):
+    """stop_id -> (停留所名, 緯度, 経度)"""
+    rng = random.Random(seed)
+    stops = {}
+    for i in range(count):
+        lon, lat = _offset(rng, center, spread_km)
+        stops[f'stop{i}'] = (f'Stop {i}', lat, lon)
+    return stops
+
+
+def make_feed(vehicles, trips, routes=20, stops=None, center=(139.7, 35.68), spread_km=20.0, seed=0,
+              timestamp=1715601600):
+    """
+    vehicles 台の車両位置を持つFeedMessageを作る。
+    車両は trips 個のtripと routes 個の路線に割り振り、center を中心に spread_km 四方に散らばらせる。
+    stops（make_stopsの戻り値）を渡すと、各車両に停留所を割り当てる。
+    """
+    rng = random.Random(seed)
+    stop_ids = list(stops) if stops else []
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = timestamp
+    for i in range(vehicles):
+        entity = feed.entity.add()
+        entity.id = f'entity{i}'
+        vehicle = entity.vehicle
+        vehicle.vehicle.id = f'vehicle{i}'
+        trip = i % max(trips, 1)
+        vehicle.trip.trip_id = f'trip{trip}'
+        vehicle.trip.route_id = f'route{trip % max(routes, 1)}'
+        vehicle.trip.direction_id = trip % 2
+        lon, lat = _offset(rng, center, spread_km)
+        vehicle.position.latitude = lat
+        vehicle.position.longitude = lon
+        if stop_ids:
+            vehicle.stop_id = rng.choice(stop_ids)
+        vehicle.timestamp = timestamp
+    return feed
+
+
+def _area(rng, center, spread_km, radius_range):
+    lon, lat = _offset(rng, center, spread_km)
+    return {'type': 'Point', 'coordinates': [lon, lat], 'properties': {'radius': rng.uniform(*radius_range)}}
+
+
+def make_settings(count, trips, stops=None, mix=None, center=(139.7, 35.68), spread_km=20.0, seed=0,
+                  now=datetime(2024, 5, 13, 12, 0), radius_range=(200, 2000), points_per_area=5,
+                  gtfs_rt_endpoint=FEED_URL):
+    """
+    count 件の通知設定を作る。フィルターの種類は mix（種類 -> 割合、既定は SETTING_MIX）の割合で選ぶ。
+    time は now を含む時間帯、weekday は now の曜日を含む組み合わせにするので、どちらも有効な設定になる。
+    """
+    rng = random.Random(seed)
+    mix = mix or SETTING_MIX
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    stop_ids = list(stops) if stops else []
+    settings = []
+    for i in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == 'stop_id' and not stop_ids:
+            kind = 'trip_id'
+        filters = {'allow_multiple_notifications': True}
+        if kind == 'trip_id':
+            filters['trip_id'] = f'trip{rng.randrange(max(trips, 1))}'
+        elif kind == 'stop_id':
+            filters['stop_id'] = rng.choice(stop_ids)
+        elif kind == 'time':
+            filters['start_time'] = (now - timedelta(hours=rng.randint(0, 3))).isoformat()
+            filters['end_time'] = (now + timedelta(hours=rng.randint(1, 3))).isoformat()
+            filters['target_area'] = _area(rng, center, spread_km, radius_range)
+        elif kind == 'weekday':
+            filters['weekday'] = sorted({now.strftime('%A'), *rng.sample(WEEKDAYS, 2)})
+            filters['trip_id'] = f'trip{rng.randrange(max(trips, 1))}'
+        elif kind == 'area':
+            filters['target_area'] = _area(rng, center, spread_km, radius_range)
+        else:
+            filters['target_area'] = [_area(rng, center, spread_km, radius_range) for _ in range(points_per_area)]
+        settings.append({
+            'gtfsRtEndpoint': gtfs_rt_endpoint,
+            'userEmail': f'user{i}@example.com@device{i}',
+            'id': f'setting-{i}',
+            'webhook_url': f'https://hooks{i % 10}.example.com/webhook',
+            'filters': filters,
+            'details': {},
+        })
+    return settings
@@ -1,11 +1,12 @@
 import json
-import boto3
 import os
+from utils import aws
+from utils.db import key_condition, query_items, user_email_key
+from utils.settings_cache import record_settings_change
 
 def get_table():
-  """Get DynamoDB table instance"""
-  dynamodb = boto3.resource('dynamodb')
-  return dynamodb.Table(os.getenv('SETTINGS_TABLE_NAME'))
+  """Get DynamoDB table instance（コンテナ内で使い回す）"""
+  return aws.table(os.getenv('SETTINGS_TABLE_NAME'))
 
 
 def create_response(status_code, body, headers=None):
@@ -24,19 +25,6 @@ def create_response(status_code, body, headers=None):
     }
   return response
 
-def get_all_settings():
-    """DynamoDBからすべての設定を取得する"""
-    print("Fetching all settings from DynamoDB")
-    try:
-        settings_table = get_table()
-        response = settings_table.scan()
-        items = response.get('Items', [])
-        print(f"Fetched {len(items)} settings")
-        return items
-    except Exception as e:
-        print(f"Error fetching settings from DynamoDB: {str(e)}")
-        return []
-
 def handler(event, context):
   """アラート設定を取得するLambda関数"""
   if event.get('httpMethod') == 'GET':
@@ -48,7 +36,12 @@ def handler(event, context):
     if not userEmail:
       return create_response(404, {'message': '削除するアラートが見つかりませんでした'})
 
-    settings = get_all_settings()
+    # 正規化したメールアドレスのGSIで候補を絞り、元のメールアドレスで照合する
+    email_key = user_email_key(userEmail)
+    if not email_key:
+      return create_response(404, {'message': '削除するアラートが見つかりませんでした'})
+    settings_table = get_table()
+    settings = query_items(settings_table, IndexName='UserEmailIndex', KeyConditionExpression=key_condition('userEmailKey').eq(email_key))
 
     for setting in settings:
       user_email = setting.get('userEmail')
@@ -58,8 +51,9 @@ def handler(event, context):
         pkey = setting.get('gtfsRtEndpoint')
         skey = setting.get('userEmail')
         # 削除
-        settings_table = get_table()
         settings_table.delete_item(Key={'gtfsRtEndpoint': pkey, 'userEmail': skey})
+        # スケジューラーのキャッシュに変更を伝える
+        record_settings_change('REMOVE', {'gtfsRtEndpoint': pkey, 'userEmail': skey})
         return create_response(200, {'message': 'アラートを削除しました'})
 
     return create_response(404, {'settings': "アラートが見つかりませんでした"})
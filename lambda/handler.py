@@ -1,11 +1,18 @@
 # lambda/handler.py
 import json
 import os
-import boto3
 from decimal import Decimal
 import uuid
 from utils.response import create_response
-from utils.db import get_table, get_all_settings
+from utils import aws
+from utils.db import get_table, key_condition, query_items, with_user_email_key
+from utils.settings_cache import record_settings_change
+from utils.vehicle_state import TRANSITIONS, parse_dwell_seconds, parse_notification_policy
+from utils.log import logger
+
+def get_trace_table():
+    """これまでに作成されたアラート一覧のテーブル（コンテナ内で使い回す）"""
+    return aws.table(os.getenv('SETTINGS_TABLE_NAME_FOR_TRACE'))
 
 def validate_point(point):
     if point.get('type') != 'Point' or 'coordinates' not in point:
@@ -15,6 +22,16 @@ def validate_point(point):
         return False
     return True
 
+def validate_notification_policy(filters):
+    """notify_onとdwell_secondsを検証する（スケジューラーが解釈できない値を保存しない）"""
+    try:
+        notify_on, _ = parse_notification_policy(filters, 0)
+        if filters.get('dwell_seconds') not in (None, ''):
+            parse_dwell_seconds(filters['dwell_seconds'])
+    except ValueError:
+        return False
+    return notify_on <= TRANSITIONS
+
 def convert_floats_to_decimal(obj):
     if isinstance(obj, list):
         return [convert_floats_to_decimal(item) for item in obj]
@@ -42,16 +59,21 @@ def main(event, context):
             return create_response(400, {'message': 'id is required in path'})
 
         try:
-            settings = get_all_settings()
+            # GSIからidで該当アイテムを検索
+            settings_table = get_table()
+            items = query_items(settings_table, IndexName='IdIndex', KeyConditionExpression=key_condition('id').eq(item_id))
+            if not items:
+                return create_response(404, {'message': 'Item not found by id'})
 
-            for setting in settings:
-                if setting.get('id') == item_id:
-                    settings_table = get_table()
-                    settings_table.delete_item(Key={'gtfsRtEndpoint': setting['gtfsRtEndpoint'], 'userEmail': setting['userEmail']})
+            for setting in items:
+                key = {'gtfsRtEndpoint': setting['gtfsRtEndpoint'], 'userEmail': setting['userEmail']}
+                settings_table.delete_item(Key=key)
+                # スケジューラーのキャッシュに変更を伝える
+                record_settings_change('REMOVE', key)
 
             return create_response(200, {'message': 'Item deleted successfully'})
         except Exception as e:
-            print(f"Error deleting item: {str(e)}")
+            logger.error("Error deleting item: %s", e)
             return create_response(500, {'message': 'Error deleting item'})
 
 
@@ -64,16 +86,14 @@ def main(event, context):
         if not email:
             return create_response(400, {'message': 'fcm or email query parameter is required'})
 
-        settings = get_all_settings()
-        filtered_settings = []
-
-        for setting in settings:
-            user_email = setting.get('userEmail')
-            user_email = user_email.replace('{', '').replace('}', '')
-            user_email = '@'.join(user_email.split('@')[:-1])
-            print(f"Comparing {user_email} with {email}")
-            if user_email == email:
-                filtered_settings.append(setting)
+        # 正規化したメールアドレスのGSIで該当ユーザーの設定だけを取得
+        settings_table = get_table()
+        filtered_settings = query_items(
+            settings_table,
+            IndexName='UserEmailIndex',
+            KeyConditionExpression=key_condition('userEmailKey').eq(email),
+        )
+        logger.info("Found %d settings for %s", len(filtered_settings), email)
 
         return create_response(200, {'settings': filtered_settings})
 
@@ -109,13 +129,12 @@ def main(event, context):
                 else:
                     return create_response(400, {'message': 'Invalid target_area format'})
 
+            if not validate_notification_policy(filters):
+                return create_response(400, {'message': 'Invalid notify_on or dwell_seconds'})
+
             # GSIからidで該当アイテムを検索
             settings_table = get_table()
-            result = settings_table.query(
-                IndexName='IdIndex',
-                KeyConditionExpression=boto3.dynamodb.conditions.Key('id').eq(item_id)
-            )
-            items = result.get('Items', [])
+            items = query_items(settings_table, IndexName='IdIndex', KeyConditionExpression=key_condition('id').eq(item_id))
             if not items:
                 return create_response(404, {'message': 'Item not found by id'})
 
@@ -127,7 +146,7 @@ def main(event, context):
 
             # gtfsRtEndpoint, userEmailを変更可能にする場合はそのままdataの値を利用、
             # 不変とする場合はoriginalから使うなど自由に調整
-            settings_table.put_item(Item={
+            item = with_user_email_key({
                 'gtfsRtEndpoint': gtfs_rt_endpoint if gtfs_rt_endpoint else original_gtfsRtEndpoint,
                 'userEmail': user_email if user_email else original_userEmail,
                 'id': item_id,
@@ -136,19 +155,21 @@ def main(event, context):
                 'filters': filters,
                 'details': details,
             })
+            settings_table.put_item(Item=item)
+            record_settings_change('MODIFY', item, new_image=item)
             return create_response(200, {'message': 'Settings updated.', 'id': item_id})
 
         except (KeyError, json.JSONDecodeError) as e:
-            print(f"Error parsing request: {str(e)}")
+            logger.warning("Error parsing request: %s", e)
             return create_response(400, {'message': 'Invalid request format'})
         except Exception as e:
-            print(f"Error updating settings: {str(e)}")
+            logger.error("Error updating settings: %s", e)
             return create_response(500, {'message': f'Error updating settings: {str(e)}'})
 
     # 以下はPOST時の処理
     try:
         data = json.loads(event['body'])
-        print(f"Parsed data: {data}")
+        logger.debug("Parsed data: %s", data)
 
         gtfs_rt_endpoint = data['gtfs_rt_endpoint']
         user_email = data['user_email']
@@ -174,11 +195,14 @@ def main(event, context):
             else:
                 return create_response(400, {'message': 'Invalid target_area format'})
 
+        if not validate_notification_policy(filters):
+            return create_response(400, {'message': 'Invalid notify_on or dwell_seconds'})
+
     except (KeyError, json.JSONDecodeError) as e:
-        print(f"Error parsing request: {str(e)}")
+        logger.warning("Error parsing request: %s", e)
         return create_response(400, {'message': 'Invalid request format'})
 
-    print(f"Saving settings for {user_email} with GTFS-RT URL: {gtfs_endpoint}")
+    logger.info("Saving settings for %s with GTFS-RT URL: %s", user_email, gtfs_endpoint)
 
     try:
         # detailsが存在すればそのまま、なければ空dictを使用
@@ -189,7 +213,7 @@ def main(event, context):
         # 新規作成時にidを自動生成する処理を追加
         id_str = str(uuid.uuid4())
 
-        settings_table.put_item(Item={
+        item = with_user_email_key({
             'gtfsRtEndpoint': gtfs_rt_endpoint,
             'gtfsEndpoint': gtfs_endpoint,
             'userEmail': user_email,
@@ -198,10 +222,11 @@ def main(event, context):
             'filters': filters,
             'details': details,
         })
-        print("Settings saved successfully.")
+        settings_table.put_item(Item=item)
+        record_settings_change('INSERT', item, new_image=item)
+        logger.info("Settings saved successfully.")
 
-        dynamodb = boto3.resource('dynamodb')
-        settings_table_for_trace = dynamodb.Table(os.getenv('SETTINGS_TABLE_NAME_FOR_TRACE'))
+        settings_table_for_trace = get_trace_table()
         settings_table_for_trace.put_item(Item={
             'gtfsRtEndpoint': gtfs_rt_endpoint,
             'userEmail': user_email,
@@ -212,7 +237,7 @@ def main(event, context):
             'details': details,
         })
     except Exception as e:
-        print(f"Error saving settings to DynamoDB: {str(e)}")
+        logger.error("Error saving settings to DynamoDB: %s", e)
         return create_response(500, {'message': 'Error saving settings'})
 
     return create_response(200, {'message': 'Settings saved.', 'id': id_str})
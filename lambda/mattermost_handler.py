@@ -1,19 +1,30 @@
 import json
 import os
-import smtplib
-from email.mime.text import MIMEText
 import requests
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import messaging
+from utils import http
+from utils import mail
+from utils.log import logger
 
+FCM_MULTICAST_LIMIT = 500  # send_each_for_multicast に1度に渡せるトークンの上限
+
+_firebase_app = None
+
+# firebase_adminは読み込みが重く、FCMで送るときにしか使わないので、その経路で初めてimportする
 def initialize_app(path:str):
-  cred = credentials.Certificate(path)
-  if not firebase_admin._apps:
-    firebase_admin.initialize_app(cred)
+  """Firebaseのアプリはコンテナごとに1度だけ初期化し、証明書の読み込みを呼び出しのたびにしない"""
+  global _firebase_app
+  if _firebase_app is None:
+    import firebase_admin
+    from firebase_admin import credentials
+    if firebase_admin._apps:
+      _firebase_app = firebase_admin.get_app()
+    else:
+      _firebase_app = firebase_admin.initialize_app(credentials.Certificate(path))
+  return _firebase_app
 
 def send_message( registration_token:str, title:str, body:str):
-  print(f"registration_token: {registration_token}")
+  from firebase_admin import messaging
+  logger.debug("registration_token: %s", registration_token)
   message = messaging.Message(
       data = {
         "title": title,
@@ -22,7 +33,65 @@ def send_message( registration_token:str, title:str, body:str):
       token=registration_token,
   )
   response = messaging.send(message)
-  print('Successfully sent message:', response)
+  logger.info('Successfully sent message: %s', response)
+
+def send_multicast(registration_tokens, title:str, body:str):
+  """同じ通知を複数の端末にまとめて送り、トークンごとの結果を返す"""
+  from firebase_admin import messaging
+  results = []
+  for start in range(0, len(registration_tokens), FCM_MULTICAST_LIMIT):
+    tokens = registration_tokens[start:start + FCM_MULTICAST_LIMIT]
+    message = messaging.MulticastMessage(
+        data = {
+          "title": title,
+          "body": body
+        },
+        tokens=tokens,
+    )
+    batch = messaging.send_each_for_multicast(message)
+    for token, response in zip(tokens, batch.responses):
+      if response.success:
+        results.append({'fcm': token, 'success': True, 'message_id': response.message_id})
+      else:
+        results.append({'fcm': token, 'success': False, 'error': str(response.exception)})
+  failures = sum(1 for result in results if not result['success'])
+  logger.info('Sent multicast message: success=%d failure=%d', len(results) - failures, failures)
+  return results
+
+def send_multicasts(multicasts):
+  """
+  (タイトル, 本文) -> トークン の通知をまとめて送り、トークンごとの結果を返す。
+  失敗したグループは例外を送出せず、トークンごとの失敗として返す。
+  """
+  results = []
+  for (title, body), tokens in multicasts.items():
+    try:
+      initialize_app("./firebase.json")
+      results.extend(send_multicast(tokens, title, body))
+    except Exception as e:
+      logger.error("Error sending multicast message: %s", e)
+      results.extend({'fcm': token, 'success': False, 'error': str(e)} for token in tokens)
+  return results
+
+def recipient_email(value):
+  """通知のemail（user@example.com@端末 の形式）から宛先のメールアドレスを取り出す"""
+  parts = value.split('@') if isinstance(value, str) else []
+  if len(parts) < 2 or not parts[0] or not parts[1]:
+    raise ValueError(f'Invalid email: {value!r}')
+  return parts[0] + '@' + parts[1]
+
+def failed_result(item, error):
+  """まとめ送りで送れなかった通知の結果（宛先がわかればそれを含める）"""
+  if isinstance(item, dict):
+    for channel in ('email', 'fcm'):
+      if channel in item:
+        return {channel: item[channel], 'success': False, 'error': str(error)}
+  return {'success': False, 'error': str(error)}
+
+def fcm_tokens(value):
+  """設定に保存された {token} 形式のトークン（またはそのリスト）から登録トークンを取り出す"""
+  values = value if isinstance(value, list) else [value]
+  return [token.replace('{', '').replace('}', '') for token in values if token]
 
 def create_response(status_code, body, headers=None):
     """CORS対応のレスポンスを生成"""
@@ -49,46 +118,68 @@ def post_to_mattermost(webhook_url, content):
     }
 
     try:
-        response = requests.post(webhook_url, headers=headers, json=data)
+        response = http.post(webhook_url, headers=headers, json=data)
         response.raise_for_status()
         return response.status_code, "Message posted to MatterMost"
     except requests.exceptions.RequestException as e:
-        print(f"Error posting to MatterMost: {str(e)}")
+        logger.error("Error posting to MatterMost: %s", e)
         return 500, f"Error posting to MatterMost: {str(e)}"
 
 def send_email(smtp_host, smtp_port, smtp_user, smtp_password, to_email, subject, body):
-    """SMTPを使用してメールを送信"""
+    """SMTPを使用してメールを送信（ウォームスタート間で認証済みの接続を使い回す）"""
     try:
-        # メール内容を設定
-        msg = MIMEText(body, 'plain', 'utf-8')
-        msg['Subject'] = subject
-        msg['From'] = os.getenv('SENDER_EMAIL')
-        msg['To'] = to_email
-
-        # SMTPサーバーに接続してメールを送信
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.sendmail(msg['From'], to_email, msg.as_string())
-        print(f"Email sent to {to_email}")
+        mail.get_sender(smtp_host, smtp_port, smtp_user, smtp_password).send(to_email, subject, body)
+        logger.info("Email sent to %s", to_email)
     except Exception as e:
-        print(f"Error sending email: {str(e)}")
+        logger.error("Error sending email: %s", e)
         raise
 
+def send_emails(smtp_host, smtp_port, smtp_user, smtp_password, messages):
+    """(宛先, 件名, 本文) のリストを1つのSMTPセッションでまとめて送り、宛先ごとの結果を返す"""
+    results = mail.get_sender(smtp_host, smtp_port, smtp_user, smtp_password).send_many(messages)
+    logger.info("Emails sent: %d/%d", sum(1 for result in results if result['success']), len(results))
+    return results
+
+def compose_message(alarm_settings):
+    """アラームの設定から、メールの件名・メールの本文・FCMの本文を作る"""
+    label = alarm_settings.get('details', {}).get('label', 'PoiCle')
+    description = alarm_settings.get('details', {}).get('describe', 'PoiCleからの通知です。')
+    # trip_short_name = alarm_settings.get('details', {}).get('trip_short_name', '不明')
+    # trip_headsign = alarm_settings.get('details', {}).get('trip_headsign', '不明')
+    # stop_name = alarm_settings.get('details', {}).get('stop_name', '不明')
+
+    # if stop_name == '':
+    #     stop_name = '海が見えるスポット'
+
+    userEmailId = alarm_settings.get('userEmail', '')
+
+    subject = f"{label}"
+    email_body = (
+        f"{description}"
+        f"\n\n"
+        f"この通知メールの受信を止める場合はこちらのURLをクリックしてください。\n"
+        f"https://m8aeo2cuti.execute-api.ap-northeast-1.amazonaws.com/prod/delete-alarm?userEmail={userEmailId}"
+        # f"[開発用詳細情報]\n```json\n{json.dumps(body, indent=2, ensure_ascii=False)}\n```"
+    )
+    fcm_body = (
+        f"{description}"
+    )
+    return subject, email_body, fcm_body
+
 def handler(event, context):
     """MatterMostおよびメール通知を処理するLambda関数"""
-    print(f"Received event: {event}")
+    logger.debug("Received event: %s", event)
 
     try:
         # POSTリクエストボディを解析
         body = json.loads(event['body'])
-        print(f"Parsed body: {body}")
+        logger.debug("Parsed body: %s", body)
 
         # MatterMost Webhook URLを環境変数から取得
         mattermost_webhook_url = os.getenv('MATTERMOST_WEBHOOK_URL')
 
         if not mattermost_webhook_url:
-            print("Error: MATTERMOST_WEBHOOK_URL is not set.")
+            logger.error("Error: MATTERMOST_WEBHOOK_URL is not set.")
             return create_response(500, {'message': 'MATTERMOST_WEBHOOK_URL is not set'})
 
         # SMTP情報を環境変数から取得
@@ -98,54 +189,75 @@ def handler(event, context):
         smtp_password = os.getenv('SMTP_PASSWORD')
 
         if not all([smtp_host, smtp_port, smtp_user, smtp_password]):
-            print("Error: SMTP configuration is not fully set.")
+            logger.error("Error: SMTP configuration is not fully set.")
             return create_response(500, {'message': 'SMTP configuration is not fully set'})
 
-        alarm_settings = body.get('alarm_settings', {})
-
-        label = alarm_settings.get('details', {}).get('label', 'PoiCle')
-        description = alarm_settings.get('details', {}).get('describe', 'PoiCleからの通知です。')
-        # trip_short_name = alarm_settings.get('details', {}).get('trip_short_name', '不明')
-        # trip_headsign = alarm_settings.get('details', {}).get('trip_headsign', '不明')
-        # stop_name = alarm_settings.get('details', {}).get('stop_name', '不明')
-
-        # if stop_name == '':
-        #     stop_name = '海が見えるスポット'
-
-        userEmailId = alarm_settings.get('userEmail', '')
-
-        subject = f"{label}"
-        email_body = (
-            f"{description}"
-            f"\n\n"
-            f"この通知メールの受信を止める場合はこちらのURLをクリックしてください。\n"
-            f"https://m8aeo2cuti.execute-api.ap-northeast-1.amazonaws.com/prod/delete-alarm?userEmail={userEmailId}"
-            # f"[開発用詳細情報]\n```json\n{json.dumps(body, indent=2, ensure_ascii=False)}\n```"
-        )
-        fcm_body = (
-            f"{description}"
-        )
-
-        if 'email' in body:
-            email = body.get('email', '').split('@')[0] + '@' + body.get('email', '').split('@')[1]
-            send_email(smtp_host, smtp_port, smtp_user, smtp_password, email, subject, email_body)
-            print('email sended.')
-        elif 'fcm' in body:
-            initialize_app("./firebase.json")
-            fcm = body.get('fcm', '')
-            fcm = fcm.replace('{', '').replace('}', '')
-            send_message(fcm, label, fcm_body)
-
-        post_to_mattermost(mattermost_webhook_url, email_body)
+        # まとめ送り（WEBHOOK_BATCH_HOSTS）の場合、ボディは通知の配列になる
+        batch = isinstance(body, list)
+        items = body if batch else [body]
+
+        results = []
+        contents = []
+        emails = []  # (宛先, 件名, 本文)
+        multicasts = {}  # (タイトル, 本文) -> 同じ通知を送るFCMのトークン
+        for item in items:
+            try:
+                subject, email_body, fcm_body = compose_message(item.get('alarm_settings', {}))
+                if 'email' in item:
+                    emails.append((recipient_email(item['email']), subject, email_body))
+                elif 'fcm' in item:
+                    tokens = multicasts.setdefault((subject, fcm_body), [])
+                    tokens.extend(token for token in fcm_tokens(item['fcm']) if token not in tokens)
+            except Exception as e:
+                if not batch:
+                    raise
+                # まとめ送りでは不正な通知だけを失敗として返し、残りの通知は送る
+                logger.warning("Invalid notification in batch: %s", e)
+                results.append(failed_result(item, e))
+                continue
+            contents.append(email_body)
+
+        if batch:
+            # まとめ送りのメールは1つのSMTPセッションで送り、1件の失敗で残りの通知を止めない
+            if emails:
+                results.extend(send_emails(smtp_host, smtp_port, smtp_user, smtp_password, emails))
+        else:
+            for email, subject, email_body in emails:
+                send_email(smtp_host, smtp_port, smtp_user, smtp_password, email, subject, email_body)
+                logger.info('email sended.')
+                results.append({'email': email, 'success': True})
+
+        # まとめ送りは送り元が5xxで配列全体を再送するので、メールを送った後の失敗では500を返さず、
+        # 失敗は通知ごとの結果に記録して200を返す（再送で送信済みのメールが重複しないように）
+        if multicasts:
+            if batch:
+                results.extend(send_multicasts(multicasts))
+            else:
+                initialize_app("./firebase.json")
+                for (title, fcm_body), tokens in multicasts.items():
+                    if len(tokens) > 1:
+                        results.extend(send_multicast(tokens, title, fcm_body))
+                    else:
+                        send_message(tokens[0], title, fcm_body)
+
+        if contents:
+            try:
+                post_to_mattermost(mattermost_webhook_url, '\n\n---\n\n'.join(contents))
+            except Exception as e:
+                if not batch:
+                    raise
+                logger.error("Error posting to MatterMost: %s", e)
 
+        if batch or any('fcm' in result for result in results):
+            return create_response(200, {'message': 'Notifications sent', 'results': results})
         return create_response(200, {'message': 'Email sent successfully'})
 
     except json.JSONDecodeError as e:
-        print(f"Error decoding JSON: {str(e)}")
+        logger.warning("Error decoding JSON: %s", e)
         return create_response(400, {'message': 'Invalid JSON format'})
     except KeyError as e:
-        print(f"Missing key in the request: {str(e)}")
+        logger.warning("Missing key in the request: %s", e)
         return create_response(400, {'message': f'Missing key in the request: {str(e)}'})
     except Exception as e:
-        print(f"Unexpected error: {str(e)}")
+        logger.error("Unexpected error: %s", e)
         return create_response(500, {'message': f'Unexpected error: {str(e)}'})
@@ -1,17 +1,32 @@
 import requests
-import boto3
 import os
+import time
+import hashlib
+import json
 
 from decimal import Decimal
 from datetime import datetime, timedelta
 from collections import defaultdict
-from google.transit import gtfs_realtime_pb2
-from utils.geo import is_within_radius, is_within_any_radius
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from urllib.parse import urlparse, parse_qs, urlunparse
-from utils.db import get_table, get_all_settings
+from utils import http
+from utils.db import get_table, get_changes_table, iter_settings, NotificationWriteBuffer
+from utils.settings_cache import SettingsCache
+from utils.stops import stop_catalog
+from utils.spatial import GeofenceIndex
+from utils.filter_plan import compile_filters, vehicle_keys, vehicle_fingerprint
+from utils.key_index import KeyIndex
+from utils.dispatch import WebhookDispatcher, summarize_deliveries
+from utils.vehicle_state import VehicleStateStore, parse_notification_policy, setting_state_key, ENTER
+from utils.metrics import TickMetrics
+from utils.log import logger
+from utils.profiling import profile, profiling_modes
+from utils.sharding import (HashRing, setting_shard_key, put_feed_snapshot, get_feed_snapshot,
+                            put_settings_snapshot, get_settings_snapshot, LocalProcessBackend, LambdaInvokeBackend)
 
 def get_stop_name(stop_id, gtfs_rt_endpoint):
     api_base_url = os.getenv('API_BASE_URL')
+    gtfs_id_temp = None
     if gtfs_rt_endpoint == f'{api_base_url}/odpt-challenge-2024-jreast_odpt_train_vehicle':
         gtfs_id_temp = 'odpt_jreast'
     elif gtfs_rt_endpoint == f'{api_base_url}/odpt-yokohama-city-bus-vehicle-position':
@@ -20,157 +35,187 @@ def get_stop_name(stop_id, gtfs_rt_endpoint):
         gtfs_id_temp = 'odpt_tobu'
     elif gtfs_rt_endpoint == 'https://gtfs.yanbaru-bus-navi.com/gtfs-rt/yanbaru/vehicle_position.pb':
         gtfs_id_temp = 'yanbaru-expressbus'
-    try:
-        api_url = f"{api_base_url}/getBusStops?gtfs_id=" + gtfs_id_temp
-        response = requests.get(api_url)
-        response.raise_for_status()
-        stops_data = response.json()
-        print('Stops data retrieved successfully from BuTTER API')
-
-        for stop in stops_data:
-            if stop['stop_id'] == stop_id:
-                stop_name = stop['stop_name']
-                stop_lat = stop['stop_lat']
-                stop_lon = stop['stop_lon']
-                print(f'Found stop name: {stop_name} for stop ID: {stop_id}')
-                return stop_name, stop_lat, stop_lon
-
-        print(f'Stop ID: {stop_id} not found')
+    if gtfs_id_temp is None:
+        logger.warning('Unknown GTFS-RT endpoint for stop ID: %s, endpoint: %s', stop_id, gtfs_rt_endpoint)
         return None, None, None
 
-    except Exception as e:
-        print(f'Error fetching stop name for stop ID: {stop_id}, Error: {str(e)}')
+    # 停留所一覧はgtfs_idごとにキャッシュされ、ティックごとに最大1回だけ取得される
+    stop = stop_catalog.get(gtfs_id_temp, stop_id)
+    if stop is None:
         return None, None, None
-
-def fetch_gtfs_data(gtfs_endpoint):
-    """GTFS-RTエンドポイントからプロトコルバッファデータを取得しデコード"""
-    print(f"Fetching GTFS-RT data from endpoint: {gtfs_endpoint}")
+    return stop['stop_name'], stop['stop_lat'], stop['stop_lon']
+
+# 照合と通知に必要な設定の属性（スキャン時のProjectionExpression）
+SETTING_ATTRIBUTES = (
+    'gtfsRtEndpoint', 'userEmail', 'gtfsEndpoint', 'id', 'webhook_url', 'filters', 'details',
+    'lastNotificationTimestamp',
+)
+
+# ウォームスタートしたLambda間で使い回す設定一覧（変更履歴で差分だけ更新する）
+settings_cache = SettingsCache(attributes=SETTING_ATTRIBUTES)
+
+def load_all_settings():
+    """設定テーブルを全件スキャンする（失敗時は例外を送出し、キャッシュ側で前回の一覧を使い続ける）"""
+    logger.info("Fetching all settings from DynamoDB")
+    items = list(iter_settings(attributes=SETTING_ATTRIBUTES))
+    logger.info("Fetched %d settings", len(items))
+    return items
+
+# ウォームスタートしたLambda間で保持する、フィードごとの前回取得時の情報
+# (ETag, Last-Modified, 本文のダイジェスト, FeedHeader.timestamp)
+feed_states = {}
+
+class FeedSnapshot:
+    """
+    フィードごとの前回の照合結果。
+    車両IDごとに、照合に使う状態（位置・trip・停留所など）と一致した設定の識別子を持つ。
+    一致の判定は車両の状態と設定の内容だけで決まるので、どちらも変わっていなければ結果を使い回せる。
+    """
+
+    def __init__(self, active_ids):
+        self.active_ids = active_ids  # 照合時に有効だった設定の識別子
+        self._vehicles = {}  # 車両ID -> (状態, 一致した設定の識別子)
+
+    def add(self, vehicle_id, fingerprint, matched_ids):
+        self._vehicles[vehicle_id] = (fingerprint, matched_ids)
+
+    def matches_if_unchanged(self, vehicle_id, fingerprint):
+        """状態が前回と同じなら前回一致した設定の識別子、変わっていればNone"""
+        previous = self._vehicles.get(vehicle_id)
+        if previous is None or previous[0] != fingerprint:
+            return None
+        return previous[1]
+
+# ウォームスタートしたLambda間で保持する、フィードのURLごとの前回の照合結果
+vehicle_snapshots = {}
+
+# 設定と車両の組ごとの出入りの状態（VEHICLE_STATE_TABLE_NAMEのテーブルに永続化する）
+vehicle_states = VehicleStateStore()
+
+# ティックごとのフェーズの所要時間と件数（EMFのレコードとして出力する）
+tick_metrics = TickMetrics(service=os.getenv('AWS_LAMBDA_FUNCTION_NAME'))
+
+FEED_NOT_MODIFIED = object()  # 前回取得時からスナップショットが更新されていない
+FEED_STALE = object()  # FeedHeader.timestampが許容する鮮度より古い
+
+def new_feed_message():
+    """GTFS-RTのFeedMessage（プロトコルバッファのバインディングは初めて使うときにimportする）"""
+    from google.transit import gtfs_realtime_pb2
+    return gtfs_realtime_pb2.FeedMessage()
+
+def fetch_gtfs_data(gtfs_endpoint, timeout=None, states=None):
+    """
+    GTFS-RTエンドポイントからプロトコルバッファデータを取得しデコード。
+    前回から更新がなければFEED_NOT_MODIFIED、古すぎればFEED_STALE、失敗時はNoneを返す。
+    states: 今回の取得時の情報を書き込む辞書（デフォルトは feed_states）
+    """
+    logger.debug("Fetching GTFS-RT data from endpoint: %s", gtfs_endpoint)
+    state = feed_states.get(gtfs_endpoint, {})
+    if states is None:
+        states = feed_states
     try:
-        response = requests.get(gtfs_endpoint)
+        # 条件付きGETで、更新がなければ本文を受け取らない
+        headers = {}
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
+        with tick_metrics.timer('fetch', feed=gtfs_endpoint):
+            response = http.get(gtfs_endpoint, headers=headers, timeout=timeout)
+        if response.status_code == 304:
+            logger.debug("GTFS-RT data not modified: %s", gtfs_endpoint)
+            tick_metrics.count('feeds_not_modified', feed=gtfs_endpoint)
+            return FEED_NOT_MODIFIED
         response.raise_for_status()
-        print(f"HTTP status code: {response.status_code}")
+        logger.debug("HTTP status code: %s", response.status_code)
+        tick_metrics.count('bytes_fetched', len(response.content), feed=gtfs_endpoint)
 
-        # GTFS-RTプロトコルバッファをデコード
-        feed = gtfs_realtime_pb2.FeedMessage()  # GTFS-RT用プロトコルバッファメッセージ
-        feed.ParseFromString(response.content)  # バイナリデータを解析
+        # 検証ヘッダーに対応していないサーバーでも、同じ本文ならデコードを省略する
+        digest = hashlib.sha1(response.content).hexdigest()
+        if digest == state.get('digest'):
+            logger.debug("GTFS-RT data unchanged: %s", gtfs_endpoint)
+            tick_metrics.count('feeds_not_modified', feed=gtfs_endpoint)
+            return FEED_NOT_MODIFIED
 
-        print(f"GTFS-RT data parsed successfully")
+        # GTFS-RTプロトコルバッファをデコード
+        with tick_metrics.timer('parse', feed=gtfs_endpoint):
+            feed = new_feed_message()  # GTFS-RT用プロトコルバッファメッセージ
+            feed.ParseFromString(response.content)  # バイナリデータを解析
+        logger.debug("GTFS-RT data parsed successfully")
+
+        header_timestamp = feed.header.timestamp
+        states[gtfs_endpoint] = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'digest': digest,
+            'header_timestamp': header_timestamp,
+        }
+        if header_timestamp and header_timestamp == state.get('header_timestamp'):
+            logger.debug("GTFS-RT feed header timestamp unchanged: %s", gtfs_endpoint)
+            tick_metrics.count('feeds_not_modified', feed=gtfs_endpoint)
+            return FEED_NOT_MODIFIED
+
+        max_age = float(os.getenv('GTFS_MAX_FEED_AGE_SECONDS', 0))
+        if max_age and header_timestamp and time.time() - header_timestamp > max_age:
+            logger.warning("GTFS-RT feed is stale (%ds old): %s", time.time() - header_timestamp, gtfs_endpoint)
+            return FEED_STALE
         return feed
     except requests.exceptions.RequestException as e:
-        print(f"Error fetching GTFS-RT data: {str(e)}")
+        logger.error("Error fetching GTFS-RT data: %s", e)
+        tick_metrics.count('feeds_failed', feed=gtfs_endpoint)
         return None
     except Exception as e:
-        print(f"Error parsing GTFS-RT data: {str(e)}")
+        logger.error("Error parsing GTFS-RT data: %s", e)
+        tick_metrics.count('feeds_failed', feed=gtfs_endpoint)
         return None
 
-def check_conditions(vehicle, filters, gtfs_rt_endpoint):
-    """フィルター条件をチェック"""
-    # print(f"Checking conditions for vehicle: {vehicle}")
-    # 現在の日時と曜日
-    now = datetime.utcnow()
-    current_weekday = now.strftime('%A')  # 'Monday', 'Tuesday', etc.
-
-    # フィルター条件の取得
-    trip_id_filter = filters.get('trip_id')
-    stop_id_filter = filters.get('stop_id')
-    date_filter = filters.get('date')
-    start_time_filter = filters.get('start_time')
-    end_time_filter = filters.get('end_time')
-    weekday_filter = filters.get('weekday')
-    target_area = filters.get('target_area')
-
-    # 条件チェック
-    # trip_id のチェック
-    if trip_id_filter and vehicle.trip.trip_id != trip_id_filter:
-        # print(f"Trip ID does not match: {vehicle.trip.trip_id} != {trip_id_filter}")
-        return False
-
-    # stop_id のチェック
-    # print('stop@@@@@@@@@@@@@',stop_id_filter)
-    if stop_id_filter:
-        stop_name, stop_lat, stop_lon = get_stop_name(stop_id_filter, gtfs_rt_endpoint)
-        # print("stop lat lon:",stop_lat,stop_lon)
-        r = 100
-
-        # やんばる急行バスの場合のみ、半径を3kmに設定。やんばる急行バスは緯度が30度以下のはず！
-        if stop_lat:
-            # stop_latをfloatに変換
-            if float(stop_lat) < 30.0:
-                r = 3000
-
-        if not stop_name or not is_within_radius([vehicle.position.latitude, vehicle.position.longitude], [stop_lat, stop_lon], r):
-            print(f"Vehicle is not within 1km radius of stop ID: {stop_id_filter}")
-            return False
-
-    # date のチェック
-    if date_filter:
-        date_filter_dt = datetime.strptime(date_filter, '%Y-%m-%d').date()
-        if now.date() != date_filter_dt:
-            # print(f"Date does not match: {now.date()} != {date_filter_dt}")
-            return False
-
-    # start_time と end_time のチェック
-    if start_time_filter:
-        start_time_dt = datetime.fromisoformat(start_time_filter)
-        if now < start_time_dt:
-            # print(f"Current time is before start time: {now} < {start_time_dt}")
-            return False
-
-    if end_time_filter:
-        end_time_dt = datetime.fromisoformat(end_time_filter)
-        if now > end_time_dt:
-            # print(f"Current time is after end time: {now} > {end_time_dt}")
-            return False
-
-    # weekday のチェック
-    if weekday_filter and current_weekday not in weekday_filter:
-        # print(f"Weekday does not match: {current_weekday} not in {weekday_filter}")
-        return False
-
-    # target_area のチェック (GeoJSON Point with radius version)
-    if target_area:
-        vehicle_lon = vehicle.position.longitude
-        vehicle_lat = vehicle.position.latitude
-        vehicle_location = [vehicle_lon, vehicle_lat]
-
-        if isinstance(target_area, list):
-            # List of points
-            points_with_radius = []
-            for point in target_area:
-                # Validate GeoJSON Point format
-                if point.get('type') != 'Point' or 'coordinates' not in point:
-                    # print("Invalid GeoJSON Point format in list")
-                    return False
-                if 'radius' not in point.get('properties', {}):
-                    # print("Radius not specified in target_area properties")
-                    return False
-                points_with_radius.append(point)
-            if not is_within_any_radius(vehicle_location, points_with_radius):
-                # print("Vehicle is not within any of the specified radii")
-                return False
-        elif isinstance(target_area, dict):
-            # Single point
-            if target_area.get('type') != 'Point' or 'coordinates' not in target_area:
-                # print("Invalid GeoJSON Point format")
-                return False
-            if 'radius' not in target_area.get('properties', {}):
-                # print("Radius not specified in target_area properties")
-                return False
-            center_point = target_area['coordinates']
-            radius_meters = target_area['properties']['radius']
-            if not is_within_radius(vehicle_location, center_point, radius_meters):
-                # print("Vehicle is not within the specified radius")
-                return False
-        else:
-            print("Invalid target_area format")
-            return False
+def compile_setting(filters, gtfs_rt_endpoint):
+    """設定のfiltersをティック内で使い回す評価プランにコンパイルする"""
+    return compile_filters(filters, lambda stop_id: get_stop_name(stop_id, gtfs_rt_endpoint))
 
-    # print("All conditions matched")
-    return True
+def check_conditions(vehicle, filters, gtfs_rt_endpoint=None, now=None):
+    """フィルター条件をチェック"""
+    # 現在の日時（UTC）
+    if now is None:
+        now = datetime.utcnow()
+    plan = compile_setting(filters, gtfs_rt_endpoint)
+    return plan.is_active(now) and plan.matches(vehicle)
+
+def build_key_index(plans):
+    """trip_idなど完全一致の条件を持つプランを転置インデックスに登録する"""
+    index = KeyIndex()
+    for i, plan in enumerate(plans):
+        if plan is None:
+            continue
+        index_key = plan.index_key()
+        if index_key is not None:
+            index.add(index_key[0], index_key[1], i)
+    return index
+
+def build_geofence_index(plans):
+    """
+    評価プランのジオフェンスを空間インデックスに登録し、(index, 位置条件のないプランの番号) を返す。
+    Noneのプラン（このティックで評価不要な設定）と、転置インデックスで引けるプランは登録しない。
+    """
+    index = GeofenceIndex()
+    unindexed = set()
+    for i, plan in enumerate(plans):
+        if plan is None or plan.index_key() is not None:
+            continue
+        circles = plan.geofence()
+        if circles is None:
+            unindexed.add(i)
+            continue
+        for lon, lat, radius_meters in circles:
+            index.add([lon, lat], radius_meters, i)
+    return index, unindexed
 
 def trigger_webhook(webhook_url, event_data):
-    """条件に一致した場合にWebHookを呼び出す"""
-    print(f"Triggering webhook: {webhook_url} with event_data: {event_data}")
+    """
+    条件に一致した場合にWebHookを呼び出す。
+    event_dataがリスト（まとめ送り）の場合は、配列のままPOSTする。
+    """
+    logger.debug("Triggering webhook: %s", webhook_url)
     try:
         # URLを解析
         parsed_url = urlparse(webhook_url)
@@ -179,113 +224,579 @@ def trigger_webhook(webhook_url, event_data):
         # クエリパラメータが存在する場合、event_dataに追加してPOST
         if query_params:
             # print(f"Found query parameters: {query_params}")
-            event_data.update({key: values[0] if len(values) == 1 else values for key, values in query_params.items()})
+            params = {key: values[0] if len(values) == 1 else values for key, values in query_params.items()}
+            for event in (event_data if isinstance(event_data, list) else [event_data]):
+                event.update(params)
             # クエリパラメータを削除したURLを再構築
             webhook_url = urlunparse(parsed_url._replace(query=""))
 
-        response = requests.post(webhook_url, json=event_data)
+        response = http.post(webhook_url, json=event_data)
         # print(f"Webhook response status code: {response.status_code}")
         return response.status_code
     except requests.exceptions.RequestException as e:
-        print(f"Error triggering webhook: {str(e)}")
+        logger.error("Error triggering webhook: %s", e)
         return None
 
-def scheduled_task(event, context):
-    """スケジュール実行されるLambda関数"""
-    print("Scheduled task started")
-    settings_table = get_table()
-    settings_list = get_all_settings()
-
-    # GTFS-RT URLごとに設定をグループ化
+def resolve_gtfs_rt_endpoint(gtfs_rt_endpoint):
+    """設定に保存されたGTFS-RTの識別子を実際に取得するURLに変換する"""
+    api_base_url = os.getenv('API_BASE_URL')
+    # gtfs_rt_endpoint = 'https://pub-fe12e25cb8d7447bab4c05076e1a5e6b.r2.dev/2024/vehicle_position.pb'
+    if gtfs_rt_endpoint == 'odpt_jreast':
+        return f'{api_base_url}/odpt-challenge-2024-jreast_odpt_train_vehicle'
+    elif gtfs_rt_endpoint == 'odpt_tobu':
+        return f'{api_base_url}/odpt-challenge-2024-tobu_odpt_train_vehicle'
+    elif gtfs_rt_endpoint == 'data':
+        return f'{api_base_url}/odpt-yokohama-city-bus-vehicle-position'
+    elif gtfs_rt_endpoint == 'yanbaru-expressbus':
+        return 'https://gtfs.yanbaru-bus-navi.com/gtfs-rt/yanbaru/vehicle_position.pb'
+    return gtfs_rt_endpoint
+
+def notification_policy(filters):
+    """
+    filtersの notify_on と dwell_seconds を解釈する（dwell_secondsのデフォルトは環境変数DWELL_SECONDS）。
+    戻り値は (遷移の集合, 滞在通知の秒数。dwellを通知しなければNone)。不正な値ならValueErrorを送出する。
+    """
+    return parse_notification_policy(filters, os.getenv('DWELL_SECONDS', 300))
+
+class FeedGroup:
+    """
+    1つのGTFS-RTフィードと、それを対象とする設定の評価プラン・インデックス。
+    設定が変わらない間（ループ実行中の各反復）は使い回す。
+    """
+
+    def __init__(self, feed_key, gtfs_rt_endpoint, settings):
+        self.feed_key = feed_key  # 設定に保存されたフィードの識別子
+        self.gtfs_rt_endpoint = gtfs_rt_endpoint  # 実際に取得するURL
+        self.settings = settings
+        # 設定ごとにフィルターを1回だけコンパイルする
+        # あわせて、通知する遷移（enter / exit / dwell）と、dwellとみなす滞在秒数を解釈する
+        self.plans = []
+        self.notify_on = []
+        self.dwell_seconds = []
+        for setting in settings:
+            self.notify_on.append(frozenset())
+            self.dwell_seconds.append(None)
+            if 'userEmail' not in setting or 'webhook_url' not in setting or 'filters' not in setting:
+                # print("Skipping setting without userEmail or webhook_url or filters")
+                self.plans.append(None)
+                continue
+            try:
+                self.notify_on[-1], self.dwell_seconds[-1] = notification_policy(setting.get('filters') or {})
+            except ValueError as e:
+                # 解釈できない設定は一致しないものとして扱い、他の設定の照合を止めない
+                logger.warning("Invalid notification policy: %s, Error: %s", setting.get('filters'), e)
+                self.plans.append(None)
+                continue
+            self.plans.append(compile_setting(setting.get('filters', {}), gtfs_rt_endpoint))
+        self.state_keys = [setting_state_key(setting) if 'userEmail' in setting else None for setting in settings]
+        # 前回の照合結果と突き合わせるための識別子（設定のキーとフィルターの内容）
+        self.identities = [
+            None if plan is None else (setting['gtfsRtEndpoint'], setting['userEmail'], plan.signature())
+            for setting, plan in zip(settings, self.plans)
+        ]
+        # trip_idなどの転置インデックスとジオフェンスの空間インデックスを構築し、
+        # 車両ごとに自分に紐づく設定と近傍の設定、どちらにも索引できない残りの設定だけを評価する
+        self.key_index = build_key_index(self.plans)
+        self.geofence_index, self.unindexed = build_geofence_index(self.plans)
+        # target_areaだけが条件の設定は、空間インデックスの距離判定で一致が決まる
+        self.area_only = frozenset(i for i, plan in enumerate(self.plans) if plan is not None and plan.area_only())
+
+    def active(self, now):
+        """時刻の条件を満たす設定の番号（ティックごとに1回だけ評価する）"""
+        return {i for i, plan in enumerate(self.plans) if plan is not None and plan.is_active(now)}
+
+def group_feeds(settings_list):
+    """設定をGTFS-RTフィードごとにまとめ、取得するURL -> FeedGroup を返す"""
     settings_by_gtfs_rt_endpoint = defaultdict(list)
     for setting in settings_list:
-        gtfs_rt_endpoint = setting['gtfsRtEndpoint']
-        settings_by_gtfs_rt_endpoint[gtfs_rt_endpoint].append(setting)
-
-    api_base_url = os.getenv('API_BASE_URL')
-    for gtfs_rt_endpoint, settings in settings_by_gtfs_rt_endpoint.items():
-        print(f"Processing GTFS-RT URL: {gtfs_rt_endpoint}")
-        # GTFS-RTデータの取得
-        gtfs_rt_endpoint = settings[0]['gtfsRtEndpoint']
-        # gtfs_rt_endpoint = 'https://pub-fe12e25cb8d7447bab4c05076e1a5e6b.r2.dev/2024/vehicle_position.pb'
-        if gtfs_rt_endpoint == 'odpt_jreast':
-            gtfs_rt_endpoint = f'{api_base_url}/odpt-challenge-2024-jreast_odpt_train_vehicle'
-        elif gtfs_rt_endpoint == 'odpt_tobu':
-            gtfs_rt_endpoint = f'{api_base_url}/odpt-challenge-2024-tobu_odpt_train_vehicle'
-        elif gtfs_rt_endpoint == 'data':
-            gtfs_rt_endpoint = f'{api_base_url}/odpt-yokohama-city-bus-vehicle-position'
-        elif gtfs_rt_endpoint == 'yanbaru-expressbus':
-            gtfs_rt_endpoint = 'https://gtfs.yanbaru-bus-navi.com/gtfs-rt/yanbaru/vehicle_position.pb'
-
-        gtfs_data = fetch_gtfs_data(gtfs_rt_endpoint)
+        settings_by_gtfs_rt_endpoint[setting['gtfsRtEndpoint']].append(setting)
+    feeds = {}
+    for feed_key, settings in settings_by_gtfs_rt_endpoint.items():
+        gtfs_rt_endpoint = resolve_gtfs_rt_endpoint(feed_key)
+        feeds[gtfs_rt_endpoint] = FeedGroup(feed_key, gtfs_rt_endpoint, settings)
+    return feeds
+
+def notified_recently(setting, now):
+    """lastNotificationTimestamp（メモリ上の通知時刻）から1時間以内ならTrue"""
+    last_ts_str = setting.get('lastNotificationTimestamp')
+    return bool(last_ts_str) and now - datetime.fromisoformat(last_ts_str) < timedelta(hours=1)
+
+def process_feed(gtfs_rt_endpoint, feed, gtfs_data, now, notification_writes, dispatcher):
+    """1つのGTFS-RTフィードの車両と、そのフィードを対象とする設定を照合し、通知をdispatcherに積む"""
+    settings = feed.settings
+    plans = feed.plans
+    active = feed.active(now)
+    if not active:
+        return
+
+    # 前回の照合から状態が変わっていない車両は、前回一致した設定をそのまま使い、
+    # 前回は評価していなかった設定（新しく有効になった・追加・変更された設定）だけを評価する
+    previous = vehicle_snapshots.get(gtfs_rt_endpoint)
+    active_ids = {feed.identities[i]: i for i in active}
+    if previous is None:
+        newly_active = active
+    else:
+        newly_active = {i for identity, i in active_ids.items() if identity not in previous.active_ids}
+    snapshot = FeedSnapshot(frozenset(active_ids))
+    active_state_keys = {feed.state_keys[i]: i for i in active}
+
+    # GTFS-RTデータ内の車両情報を取得し、車両ごとに評価する設定を決める
+    vehicles = []  # (車両, 状態, 評価する設定, 前回から引き継ぐ一致した設定)
+    changed = []  # 前回から状態が変わった（または初めて見る）車両の番号
+    for entity in gtfs_data.entity:
+        if not entity.HasField('vehicle'):
+            continue
+        vehicle = entity.vehicle
+        fingerprint = vehicle_fingerprint(vehicle)
+        reused = previous.matches_if_unchanged(vehicle.vehicle.id, fingerprint) if previous else None
+        if reused is None:
+            changed.append(len(vehicles))
+            vehicles.append((vehicle, fingerprint, active, set()))
+        else:
+            carried = {active_ids[identity] for identity in reused if identity in active_ids}
+            vehicles.append((vehicle, fingerprint, newly_active, carried))
+
+    # 評価が必要な車両の位置とジオフェンスの距離判定をまとめてベクトル計算する
+    evaluated = [k for k, (_, _, targets, _) in enumerate(vehicles) if targets]
+    geofence_matches = dict(zip(evaluated, feed.geofence_index.matches_many(
+        [[vehicles[k][0].position.longitude, vehicles[k][0].position.latitude] for k in evaluated]
+    )))
+
+    settings_evaluated = 0
+    matches = 0
+    notifications = 0
+    for k, (vehicle, fingerprint, targets, matching) in enumerate(vehicles):
+        vehicle_id = vehicle.vehicle.id
+        # print(f"Processing vehicle: {vehicle_id}")
+
+        if targets:
+            keyed = feed.key_index.lookup(vehicle_keys(vehicle))
+            # target_areaだけの設定はベクトル計算の距離判定の結果をそのまま使い、スカラー版で判定し直さない
+            trusted = geofence_matches[k] & feed.area_only & targets
+            matching |= trusted
+            settings_evaluated += len(trusted)
+            for i in ((keyed | geofence_matches[k] | feed.unindexed) & targets) - trusted:
+                settings_evaluated += 1
+                if plans[i].matches(vehicle):
+                    matching.add(i)
+        matches += len(matching)
+        snapshot.add(vehicle_id, fingerprint, frozenset(feed.identities[i] for i in matching))
+
+    # 出入りの判定の前に、ほかのコンテナが記録した状態を反映する
+    # （設定の記録は初めて照合するときに読み込み、状態が変わった車両の一致した組だけをティックごとに読み直す）
+    vehicle_states.load(active_state_keys)
+    vehicle_states.refresh(
+        (feed.state_keys[i], vehicles[k][0].vehicle.id) for k in changed for i in vehicles[k][3])
+
+    candidates = []  # 通知する遷移 (車両, 設定の番号, 遷移, 再通知を抑止するか)
+    for vehicle, _, _, matching in vehicles:
+        vehicle_id = vehicle.vehicle.id
+
+        # 前回中にいて今回一致しなかった設定は退出として扱う
+        inside = vehicle_states.inside(vehicle_id, now)
+        exited = {active_state_keys[key] for key in inside if key in active_state_keys} - matching
+
+        for i in sorted(matching | exited):
+            setting = settings[i]
+            filters = setting.get('filters', {})
+
+            # 入場・退出・滞在の遷移があったときだけ通知する（状態の書き込みは予約され、後でまとめて行う）
+            event_type = vehicle_states.transition(
+                feed.state_keys[i], vehicle_id, i in matching, now, dwell_seconds=feed.dwell_seconds[i])
+            if event_type is None or event_type not in feed.notify_on[i]:
+                continue
+
+            # 新たに追加: 複数通知可否フラグ取得（デフォルトfalse想定）
+            allow_multiple = filters.get('allow_multiple_notifications', False)
+
+            # 1時間以内の再通知制御（複数通知を許可しない設定は、別の車両の入場でも1時間は通知しない）
+            cooldown = event_type == ENTER and not allow_multiple
+            if cooldown and notified_recently(setting, now):
+                continue
+            candidates.append((vehicle, i, event_type, cooldown))
+
+    # 通知する遷移だけを、手元の状態を条件にまとめて確定させる（ほかのコンテナが先に確定させた遷移は通知しない）
+    conflicts = vehicle_states.commit((feed.state_keys[i], vehicle.vehicle.id) for vehicle, i, _, _ in candidates)
+    for vehicle, i, event_type, cooldown in candidates:
+        vehicle_id = vehicle.vehicle.id
+        if (feed.state_keys[i], vehicle_id) in conflicts:
+            continue
+        setting = settings[i]
+        user_email = setting['userEmail']
+        webhook_url = setting['webhook_url']
+        # 同じティックでほかの車両の通知が先に送られていれば、再通知を抑止する
+        if cooldown and notified_recently(setting, now):
+            # print(f"Skipping notification since last was {delta} ago and multiple not allowed.")
+            continue
 
+        # 条件に一致、かつ通知可能な場合、WebHookを呼び出す
+        event_data = {
+            'vehicle_id': vehicle_id,
+            'location': {
+                'latitude': Decimal(str(vehicle.position.latitude)),
+                'longitude': Decimal(str(vehicle.position.longitude)),
+            },
+            'stop_id': vehicle.stop_id,
+            'trip_id': vehicle.trip.trip_id,
+            'schedule_relationship': vehicle.trip.schedule_relationship,
+            'current_stop_sequence': vehicle.current_stop_sequence,
+            'occupancy_status': vehicle.occupancy_status,
+            'timestamp': now.isoformat(),
+            'event_type': event_type,
+            'event_details': {},
+            # 新たに追加: アラーム設定の詳細情報を追加
+            # 送信は別スレッドで行われるため、この後の更新の影響を受けないようコピーを渡す
+            'alarm_settings': dict(setting)
+        }
+        # メモリ上の通知時刻はほかのコンテナの通知を反映していないことがあるので、
+        # 再通知を抑止する通知はテーブルの値で確かめ、通知時刻を書き込んでから送る
+        if cooldown and not notification_writes.claim(setting, now.isoformat(), (now - timedelta(hours=1)).isoformat()):
+            tick_metrics.count('notifications_suppressed', feed=gtfs_rt_endpoint)
+            continue
+        dispatcher.submit(webhook_url, event_data)
+        notifications += 1
+
+        # タイムスタンプの書き込みはティックの最後にまとめて行う
+        if not cooldown:
+            notification_writes.record(setting, now.isoformat())
+        logger.debug("Webhook queued for vehicle %s and user %s (%s)", vehicle_id, user_email, event_type)
+
+    vehicle_snapshots[gtfs_rt_endpoint] = snapshot
+    logger.debug("Evaluated %d of %d vehicles: %s", len(evaluated), len(vehicles), gtfs_rt_endpoint)
+    tick_metrics.count('vehicles', len(vehicles), feed=gtfs_rt_endpoint)
+    tick_metrics.count('vehicles_evaluated', len(evaluated), feed=gtfs_rt_endpoint)
+    tick_metrics.count('settings_evaluated', settings_evaluated, feed=gtfs_rt_endpoint)
+    tick_metrics.count('matches', matches, feed=gtfs_rt_endpoint)
+    tick_metrics.count('notifications', notifications, feed=gtfs_rt_endpoint)
+
+def webhook_drain_timeout(context):
+    """Webhookの配信完了を待つ最大秒数。Lambdaの残り時間から余裕を引いた値を超えない"""
+    timeout = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT_SECONDS', 60))
+    get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining_time is not None:
+        timeout = min(timeout, max(get_remaining_time() / 1000 - 5, 0))
+    return timeout
+
+def fetch_feeds(gtfs_rt_endpoints):
+    """
+    全フィードのダウンロードを同時に開始し、(URL, 取得結果) を届いた順に返すジェネレーター。
+    ティック全体の待ち時間に上限を設け、間に合わなかったフィードは飛ばす。
+    取得時の情報（ETagなど）は、上限までに届いて照合に回したフィードの分だけ feed_states に反映する。
+    間に合わなかったフィードの情報を反映すると、次のティックで更新なし（304）になり照合されなくなるため。
+    """
+    if not gtfs_rt_endpoints:
+        return
+    # 接続は短いタイムアウトで諦め、読み込みだけフィード用のタイムアウトにする
+    fetch_timeout = (http.default_timeout()[0], float(os.getenv('GTFS_FETCH_TIMEOUT_SECONDS', 10)))
+    # ティック全体の待ち時間の上限。スケジュールの間隔（60秒）より短くし、次のティックと重ならないようにする
+    fetch_budget = float(os.getenv('GTFS_FETCH_BUDGET_SECONDS', 40))
+    max_workers = min(len(gtfs_rt_endpoints), int(os.getenv('GTFS_FETCH_CONCURRENCY', 8)))
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {}
+    states = {}  # 取得したスレッドが書き込む、反映前の取得時の情報
+    for gtfs_rt_endpoint in gtfs_rt_endpoints:
+        logger.debug("Processing GTFS-RT URL: %s", gtfs_rt_endpoint)
+        futures[executor.submit(fetch_gtfs_data, gtfs_rt_endpoint, timeout=fetch_timeout, states=states)] = gtfs_rt_endpoint
+
+    # 接続・読み込みのタイムアウトとリトライ（バックオフを含む）から決まる待ち時間を、ティック全体の上限で打ち切る
+    deadline = time.monotonic() + min(http.max_request_seconds(fetch_timeout) + 1, fetch_budget)
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                gtfs_rt_endpoint = futures[future]
+                if gtfs_rt_endpoint in states:
+                    feed_states[gtfs_rt_endpoint] = states.pop(gtfs_rt_endpoint)
+                yield gtfs_rt_endpoint, future.result()
+        for future in pending:
+            logger.warning("Timed out fetching GTFS-RT data for URL: %s", futures[future])
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def run_tick(feeds, now, notification_writes, dispatcher):
+    """feeds（URL -> FeedGroup）を取得して照合する。届いたフィードから順に照合し、通知をdispatcherに積む"""
+    if not feeds:
+        return
+    for gtfs_rt_endpoint, gtfs_data in fetch_feeds(list(feeds)):
+        if gtfs_data is None:
+            logger.warning("Failed to fetch GTFS-RT data for URL: %s", gtfs_rt_endpoint)
+            continue
+        if gtfs_data is FEED_NOT_MODIFIED or gtfs_data is FEED_STALE:
+            # 更新のないフィード・古いフィードは照合しない
+            continue
+        with tick_metrics.timer('match', feed=gtfs_rt_endpoint):
+            process_feed(gtfs_rt_endpoint, feeds[gtfs_rt_endpoint], gtfs_data, now, notification_writes, dispatcher)
+    # まとめ送りの宛先には、このティックの通知をwebhook_urlごとに1件のPOSTで送る
+    dispatcher.flush_batches()
+
+def polling_loop_seconds(event):
+    """1回の起動内でポーリングを繰り返す秒数。0ならループせず1回だけ照合する"""
+    value = event.get('poll_loop_seconds') if isinstance(event, dict) else None
+    if value is None:
+        value = os.getenv('POLL_LOOP_SECONDS', 0)
+    return float(value)
+
+def poll_intervals(feeds, event):
+    """フィードごとのポーリング間隔（秒）。設定に保存された識別子ごとに上書きできる"""
+    overrides = event.get('poll_intervals') if isinstance(event, dict) else None
+    if overrides is None:
+        overrides = json.loads(os.getenv('POLL_FEED_INTERVALS', '{}'))
+    default_interval = float(os.getenv('POLL_INTERVAL_SECONDS', 15))
+    return {
+        gtfs_rt_endpoint: max(float(overrides.get(feed.feed_key, default_interval)), 1.0)
+        for gtfs_rt_endpoint, feed in feeds.items()
+    }
+
+def run_polling_loop(feeds, loop_seconds, intervals, context, notification_writes, dispatcher,
+                     clock=time.monotonic, sleep=time.sleep):
+    """
+    各フィードをそれぞれの間隔でポーリングし、loop_seconds 経過するか、
+    Lambdaの残り時間が POLL_SAFETY_MARGIN_SECONDS を切るまで照合を繰り返す。戻り値は反復回数。
+    """
+    if not feeds:
+        return 0
+    started = clock()
+    end = started + loop_seconds
+    get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining_time is not None:
+        end = min(end, started + get_remaining_time() / 1000 - float(os.getenv('POLL_SAFETY_MARGIN_SECONDS', 25)))
+
+    next_due = {gtfs_rt_endpoint: started for gtfs_rt_endpoint in feeds}
+    iterations = 0
+    while True:
+        current = clock()
+        due = {gtfs_rt_endpoint: feeds[gtfs_rt_endpoint]
+               for gtfs_rt_endpoint, due_at in next_due.items() if due_at <= current}
+        if due:
+            iterations += 1
+            run_tick(due, datetime.utcnow(), notification_writes, dispatcher)
+            flush_writes(notification_writes)
+            # 反復ごとに1件のレコードを出す（Webhookの配信結果は最後のレコードにまとめて入る）
+            tick_metrics.emit()
+            logger.summary()
+            current = clock()
+            for gtfs_rt_endpoint in due:
+                interval = intervals[gtfs_rt_endpoint]
+                # 次の時刻は予定時刻から数え、照合にかかった時間でずれていかないようにする。間に合わなかった回は飛ばす
+                skipped = max(int((current - next_due[gtfs_rt_endpoint]) // interval), 0)
+                next_due[gtfs_rt_endpoint] += interval * (skipped + 1)
+        upcoming = min(next_due.values())
+        if upcoming > end:
+            return iterations
+        sleep(max(upcoming - clock(), 0))
+
+def flush_writes(notification_writes):
+    """通知時刻と出入りの状態の書き込みを反映する"""
+    with tick_metrics.timer('writes'):
+        logger.info("Notification timestamp writes: %s", notification_writes.flush())
+        logger.info("Vehicle state writes: %s", vehicle_states.flush())
+
+def finish_tick(notification_writes, dispatcher, context):
+    """通知時刻を書き込み、未送信のWebhookを待って結果とメトリクスを出力する"""
+    # Webhookの配信はその間も別スレッドで進む
+    flush_writes(notification_writes)
+
+    # 未送信のWebhookを、Lambdaの残り時間の範囲で待つ
+    with tick_metrics.timer('dispatch'):
+        results, unfinished = dispatcher.drain(timeout=webhook_drain_timeout(context))
+    for result in results:
+        if not result['ok']:
+            logger.warning("Webhook delivery failed: %s", result)
+    summary = summarize_deliveries(results, unfinished)
+    logger.info("Webhook delivery summary: %s", summary)
+    tick_metrics.count('webhooks_sent', summary['succeeded'])
+    tick_metrics.count('webhooks_failed', summary['failed'])
+    tick_metrics.count('webhooks_unfinished', unfinished)
+    logger.info("Stop catalog stats: %s", stop_catalog.stats())
+    tick_metrics.emit()
+    logger.summary()
+
+def worker_nodes():
+    """
+    コーディネーター実行時のワーカー名のリスト。
+    SCHEDULER_WORKERS（カンマ区切り。Lambdaバックエンドでは関数名）、なければ SCHEDULER_WORKER_COUNT 個のローカルワーカー
+    """
+    nodes = [node.strip() for node in os.getenv('SCHEDULER_WORKERS', '').split(',') if node.strip()]
+    if nodes:
+        return nodes
+    count = int(os.getenv('SCHEDULER_WORKER_COUNT') or os.cpu_count() or 1)
+    return [f'worker-{i}' for i in range(max(count, 1))]
+
+# ウォームスタートしたLambda間で使い回すワーカーのバックエンド（ローカルではワーカーのプロセスを保持する）
+worker_backend = None
+
+def get_worker_backend():
+    global worker_backend
+    if worker_backend is None:
+        if os.getenv('SCHEDULER_BACKEND', 'local') == 'lambda':
+            worker_backend = LambdaInvokeBackend()
+        else:
+            worker_backend = LocalProcessBackend(worker_task)
+    return worker_backend
+
+def coordinate_tick(settings_list, now, nodes, backend):
+    """
+    各フィードを1回だけ取得してスナップショットを保存し、そのフィードの設定を担当するワーカーに
+    (担当範囲, スナップショットの参照) の作業単位を渡す。担当は設定のidのコンシステントハッシュで決める。
+    ワーカーが設定テーブル全体を読まずに済むよう、担当する設定の一覧も保存して作業単位に参照を入れる。
+    """
+    ring = HashRing(nodes)
+    settings_by_node = ring.partition(settings_list, setting_shard_key)
+    nodes_by_feed = defaultdict(set)
+    for node, settings in settings_by_node.items():
+        for setting in settings:
+            nodes_by_feed[resolve_gtfs_rt_endpoint(setting['gtfsRtEndpoint'])].add(node)
+    if not nodes_by_feed:
+        # 設定がなければ取得するフィードも割り振る作業もない
+        return []
+
+    feeds_by_node = defaultdict(list)
+    for gtfs_rt_endpoint, gtfs_data in fetch_feeds(list(nodes_by_feed)):
         if gtfs_data is None:
-            print(f"Failed to fetch GTFS-RT data for URL: {gtfs_rt_endpoint}")
+            logger.warning("Failed to fetch GTFS-RT data for URL: %s", gtfs_rt_endpoint)
             continue
+        if gtfs_data is FEED_NOT_MODIFIED or gtfs_data is FEED_STALE:
+            continue
+        with tick_metrics.timer('snapshot', feed=gtfs_rt_endpoint):
+            snapshot = put_feed_snapshot(gtfs_data.SerializeToString())
+        for node in nodes_by_feed[gtfs_rt_endpoint]:
+            feeds_by_node[node].append({'gtfs_rt_endpoint': gtfs_rt_endpoint, 'snapshot': snapshot})
+
+    units = []
+    for node in ring.nodes:
+        if not feeds_by_node[node]:
+            continue
+        unit = {'node': node, 'nodes': ring.nodes, 'now': now.isoformat(), 'feeds': feeds_by_node[node]}
+        try:
+            with tick_metrics.timer('snapshot'):
+                unit['settings'] = put_settings_snapshot(settings_by_node[node])
+        except Exception as e:
+            # 参照がなければ、ワーカーは設定一覧を自分で読み込んで担当分に絞る
+            logger.error("Error saving settings snapshot for %s: %s", node, e)
+        units.append(unit)
+    if not units:
+        return []
+    tick_metrics.count('work_units', len(units))
+    with tick_metrics.timer('fan_out'):
+        return backend.dispatch(units)
+
+def worker_task(event, context):
+    """
+    コーディネーターから渡された作業単位を処理するLambda関数（ローカルではワーカーのプロセスで呼ばれる）。
+    イベントの profile か PROFILE_MODES の指定があればプロファイルを取る。
+    """
+    with profile('worker_task', profiling_modes(event)):
+        return run_worker_task(event, context)
+
+# ワーカーのコンテナで使い回す、コーディネーターから渡された設定の一覧（スナップショットの参照 -> 設定）
+worker_settings = {}
+
+def load_worker_settings(event, changes_table):
+    """
+    自分が担当する設定の一覧。作業単位に設定のスナップショットの参照があればそれだけを読み、
+    参照が前回と同じなら読み直さない。参照がない（または読めない）場合は、設定一覧から担当分に絞る。
+    """
+    ref = event.get('settings')
+    if ref:
+        settings_list = worker_settings.get(ref)
+        if settings_list is not None:
+            return settings_list
+        try:
+            settings_list = get_settings_snapshot(ref)
+        except Exception as e:
+            logger.error("Error loading settings snapshot %s: %s", ref, e)
+        else:
+            worker_settings.clear()
+            worker_settings[ref] = settings_list
+            return settings_list
+    ring = HashRing(event['nodes'])
+    return [
+        setting for setting in settings_cache.get_settings(changes_table, load_all_settings)
+        if ring.node_for(setting_shard_key(setting)) == event['node']
+    ]
+
+def run_worker_task(event, context):
+    """自分が担当する設定だけを、スナップショットのフィードと照合する"""
+    node = event['node']
+    logger.info("Worker %s started", node)
+    stop_catalog.begin_tick()
+    logger.begin_tick()
+    tick_metrics.begin_tick()
+    settings_table = get_table()
+    with tick_metrics.timer('settings'):
+        settings_list = load_worker_settings(event, get_changes_table())
+    tick_metrics.count('settings', len(settings_list))
+    notification_writes = NotificationWriteBuffer(settings_table)
+    dispatcher = WebhookDispatcher(send=lambda webhook_url, event_data: trigger_webhook(webhook_url, event_data))
+    feeds = group_feeds(settings_list)
+    now = datetime.fromisoformat(event['now'])
+
+    processed = 0
+    for unit in event['feeds']:
+        feed = feeds.get(unit['gtfs_rt_endpoint'])
+        if feed is None:
+            continue
+        try:
+            with tick_metrics.timer('parse', feed=unit['gtfs_rt_endpoint']):
+                gtfs_data = new_feed_message()
+                gtfs_data.ParseFromString(get_feed_snapshot(unit['snapshot']))
+        except Exception as e:
+            logger.error("Error loading feed snapshot %s: %s", unit['snapshot'], e)
+            continue
+        with tick_metrics.timer('match', feed=unit['gtfs_rt_endpoint']):
+            process_feed(unit['gtfs_rt_endpoint'], feed, gtfs_data, now, notification_writes, dispatcher)
+        processed += 1
+    dispatcher.flush_batches()
+
+    finish_tick(notification_writes, dispatcher, context)
+    logger.info("Worker %s completed", node)
+    return {'node': node, 'settings': len(settings_list), 'feeds': processed}
 
-        # GTFS-RTデータ内の車両情報を取得
-        for entity in gtfs_data.entity:
-            if entity.HasField('vehicle'):
-                vehicle = entity.vehicle
-                vehicle_id = vehicle.vehicle.id
-                # print(f"Processing vehicle: {vehicle_id}")
-
-                for setting in settings:
-                    if 'userEmail' not in setting or 'webhook_url' not in setting or 'filters' not in setting:
-                        # print("Skipping setting without userEmail or webhook_url or filters")
-                        continue
-                    user_email = setting['userEmail']
-                    webhook_url = setting['webhook_url']
-                    filters = setting.get('filters', {})
-
-                    # 新たに追加: 複数通知可否フラグ取得（デフォルトfalse想定）
-                    allow_multiple = filters.get('allow_multiple_notifications', False)
-
-                    if check_conditions(vehicle, filters, gtfs_rt_endpoint):
-                        # # 通知抑止ロジック:
-                        # # lastNotificationTimestampを取得
-                        last_ts_str = setting.get('lastNotificationTimestamp')
-                        now = datetime.utcnow()
-
-                        if last_ts_str:
-                            last_ts = datetime.fromisoformat(last_ts_str)
-                            delta = now - last_ts
-                            # 1時間以内の再通知制御
-                            if delta < timedelta(hours=1) and not allow_multiple:
-                                # print(f"Skipping notification since last was {delta} ago and multiple not allowed.")
-                                continue
-
-                        # 条件に一致、かつ通知可能な場合、WebHookを呼び出す
-                        event_data = {
-                            'vehicle_id': vehicle_id,
-                            'location': {
-                                'latitude': Decimal(str(vehicle.position.latitude)),
-                                'longitude': Decimal(str(vehicle.position.longitude)),
-                            },
-                            'stop_id': vehicle.stop_id,
-                            'trip_id': vehicle.trip.trip_id,
-                            'schedule_relationship': vehicle.trip.schedule_relationship,
-                            'current_stop_sequence': vehicle.current_stop_sequence,
-                            'occupancy_status': vehicle.occupancy_status,
-                            'timestamp': now.isoformat(),
-                            'event_details': {},
-                            'alarm_settings': setting  # 新たに追加: アラーム設定の詳細情報を追加
-                        }
-                        trigger_webhook(webhook_url, event_data)
-
-                        setting['lastNotificationTimestamp'] = now.isoformat()
-                        settings_table.put_item(Item={
-                            'gtfsRtEndpoint': setting['gtfsRtEndpoint'],
-                            'userEmail': setting['userEmail'],
-                            'gtfsEndpoint': setting['gtfsEndpoint'],
-                            'id': setting['id'],
-                            'webhook_url': setting['webhook_url'],
-                            'filters': setting['filters'],
-                            'details': setting['details'],
-                            'lastNotificationTimestamp': now.isoformat()
-                        })
-                        print(f"Webhook triggered for vehicle {vehicle_id} and user {user_email}")
-                    # else:
-                        # print(f"Vehicle {vehicle_id} did not match the conditions for user {user_email}")
-
-    print("Scheduled task completed")
+def scheduled_task(event, context):
+    """
+    スケジュール実行されるLambda関数。
+    イベントの profile（EventBridgeの入力で指定）か PROFILE_MODES の指定があればプロファイルを取る。
+    """
+    with profile('scheduled_task', profiling_modes(event)):
+        return run_scheduled_task(event, context)
+
+def run_scheduled_task(event, context):
+    """設定を読み込み、フィードを取得して照合する（コーディネーター実行ではワーカーに割り振る）"""
+    logger.info("Scheduled task started")
+    stop_catalog.begin_tick()
+    logger.begin_tick()
+    tick_metrics.begin_tick()
+    settings_table = get_table()
+    with tick_metrics.timer('settings'):
+        settings_list = settings_cache.get_settings(get_changes_table(), load_all_settings)
+    logger.info("Settings cache refresh: %s", settings_cache.last_refresh)
+    tick_metrics.count('settings', len(settings_list))
+
+    if os.getenv('SCHEDULER_MODE', 'single') == 'coordinator':
+        # 照合はワーカーに任せ、ここではフィードの取得と作業の割り振りだけを行う
+        results = coordinate_tick(settings_list, datetime.utcnow(), worker_nodes(), get_worker_backend())
+        logger.info("Worker results: %s", results)
+        tick_metrics.emit()
+        logger.summary()
+        logger.info("Scheduled task completed")
+        return
+    notification_writes = NotificationWriteBuffer(settings_table)
+    # Webhookは照合と並行して配信し、照合が遅い宛先に引きずられないようにする
+    dispatcher = WebhookDispatcher(send=lambda webhook_url, event_data: trigger_webhook(webhook_url, event_data))
+    # GTFS-RTフィードごとに設定をまとめてコンパイルする（ループ実行中は使い回す）
+    feeds = group_feeds(settings_list)
+
+    loop_seconds = polling_loop_seconds(event)
+    if loop_seconds > 0:
+        iterations = run_polling_loop(
+            feeds, loop_seconds, poll_intervals(feeds, event), context, notification_writes, dispatcher)
+        logger.info("Polling loop completed: %d iterations", iterations)
+    else:
+        # ティック全体で共通の時刻
+        run_tick(feeds, datetime.utcnow(), notification_writes, dispatcher)
+
+    finish_tick(notification_writes, dispatcher, context)
+    logger.info("Scheduled task completed")
@@ -1,8 +1,14 @@
 # tests/test_handler.py
 
 import pytest
+import io
 import json
 import os
+import pstats
+import smtplib
+import subprocess
+import sys
+import time
 from decimal import Decimal
 from datetime import datetime, timedelta
 from unittest.mock import Mock, patch, MagicMock
@@ -10,14 +16,49 @@ from google.transit import gtfs_realtime_pb2
 from handler import (
     main,
 )
+from delete_alert import handler as delete_alert_handler
+import mattermost_handler
+from backfill_user_email_key import backfill
 from scheduled_task import (
     check_conditions,
     scheduled_task,
     trigger_webhook,
-    fetch_gtfs_data
+    fetch_gtfs_data,
+    FEED_NOT_MODIFIED,
+    FEED_STALE,
+    build_geofence_index,
+    build_key_index,
+    compile_setting,
+    settings_cache,
+    run_polling_loop,
+    poll_intervals,
+    group_feeds,
+    process_feed,
+    FeedGroup,
+    vehicle_snapshots,
+    vehicle_states,
+    coordinate_tick,
+    worker_task
 )
-from utils.geo import is_within_radius, is_within_any_radius
+from utils.geo import is_within_radius, is_within_any_radius, within_radius_indexed
 from utils.response import create_response
+from utils.stops import StopCatalog
+from utils.spatial import GeofenceIndex
+from utils.filter_plan import compile_filters
+from utils import http
+from utils import aws
+from utils import mail
+from utils.dispatch import WebhookDispatcher
+from utils.rate_limit import TokenBucket, HostRateLimiter
+from utils.db import NotificationWriteBuffer, iter_settings, get_all_settings, SETTINGS_CHANGES_PARTITION, SETTINGS_VERSION_KEY, user_email_key
+from utils.settings_cache import SettingsCache, record_settings_change
+from benchmarks.synthetic import make_feed, make_settings, make_stops
+from benchmarks.bench_matching import compare
+from utils.metrics import TickMetrics
+from utils.log import Logger, DEBUG
+from utils.profiling import profile, profiling_modes, ProfileSink
+from utils.sharding import (HashRing, LocalProcessBackend, LambdaInvokeBackend, put_feed_snapshot, get_feed_snapshot,
+                            get_settings_snapshot, put_settings_snapshot)
 from boto3.dynamodb.conditions import Key
 import requests.exceptions
 
@@ -103,6 +144,29 @@ def mock_get_table():
         mock.return_value = mock_table
         yield mock_table
 
+@pytest.fixture(autouse=True)
+def reset_aws_cache():
+    """コンテナ内で使い回すboto3のリソースを、テストごとに作り直す（モックが他のテストに残らないように）"""
+    aws.clear()
+    yield
+    aws.clear()
+
+@pytest.fixture(autouse=True)
+def reset_settings_cache():
+    """ウォームスタート用の設定キャッシュをテストごとに空にする"""
+    settings_cache.clear()
+    yield
+    settings_cache.clear()
+
+@pytest.fixture(autouse=True)
+def reset_vehicle_snapshots():
+    """前回の照合結果をテストごとに空にする"""
+    vehicle_snapshots.clear()
+    vehicle_states.clear()
+    yield
+    vehicle_snapshots.clear()
+    vehicle_states.clear()
+
 @pytest.fixture
 def gtfs_feed_mock_vehicle():
     """
@@ -394,6 +458,21 @@ def test_is_within_any_radius():
     assert is_within_any_radius(vehicle_inside_second, points_with_radius) is True
     assert is_within_any_radius(vehicle_outside, points_with_radius) is False
 
+def test_within_radius_indexed_matches_scalar():
+    """候補ペア（車両と円の番号）の判定は、スカラー版と同じ結果を返す"""
+    vehicles = [[139.02, 35.02], [140.01, 36.01], [138.0, 34.0]]
+    centers = [[139.0, 35.0], [140.0, 36.0]]
+    radii = [5000, Decimal('10000')]
+    vehicle_ids, circle_ids = [0, 0, 1, 1, 2], [0, 1, 0, 1, 0]
+
+    expected = [(v, c) for v, c in zip(vehicle_ids, circle_ids) if is_within_radius(vehicles[v], centers[c], radii[c])]
+    assert expected == [(0, 0), (1, 1)]
+    assert within_radius_indexed(vehicles, centers, radii, vehicle_ids, circle_ids) == expected
+
+    # NumPyがない環境でもスカラー版にフォールバックする
+    with patch('utils.geo._numpy', return_value=None):
+        assert within_radius_indexed(vehicles, centers, radii, vehicle_ids, circle_ids) == expected
+
 ######################################################################
 # DELETEメソッドのテスト
 ######################################################################
@@ -451,7 +530,7 @@ def test_main_get_success(mock_get_table, mock_settings_item):
 
     # DynamoDBから取得したアイテムをモック
     mock_settings_item['userEmail'] = 'test@example.com'
-    mock_get_table.scan.return_value = {
+    mock_get_table.query.return_value = {
         'Items': [mock_settings_item]
     }
 
@@ -568,11 +647,34 @@ def test_main_post_success(mock_get_table):
     assert 'id' in data
     assert data['message'] == 'Settings saved.'
 
+@pytest.mark.parametrize('filters', [
+    {'notify_on': ['dwell'], 'dwell_seconds': '5min'},
+    {'notify_on': 1},
+    {'notify_on': ['arrive']},
+    {'notify_on': ['enter'], 'dwell_seconds': -1},
+])
+def test_main_post_rejects_invalid_notification_policy(mock_get_table, filters):
+    """スケジューラーが解釈できないnotify_on・dwell_secondsは保存しない"""
+    event = {
+        'httpMethod': 'POST',
+        'body': json.dumps({
+            'gtfs_endpoint': 'https://example.com/gtfs',
+            'user_email': 'test@example.com',
+            'gtfs_rt_endpoint': 'data',
+            'webhook_url': 'https://example.com/webhook',
+            'filters': filters,
+        })
+    }
+    response = main(event, None)
+    assert response['statusCode'] == 400
+    assert json.loads(response['body'])['message'] == 'Invalid notify_on or dwell_seconds'
+    mock_get_table.put_item.assert_not_called()
+
 ######################################################################
 # trigger_webhook のテスト
 ######################################################################
 
-@patch('requests.post')
+@patch('requests.Session.post')
 def test_trigger_webhook_success(mock_post):
     """WebhookへのPOSTが成功した場合のステータスコードをテスト"""
     mock_post.return_value.status_code = 200
@@ -586,7 +688,7 @@ def test_trigger_webhook_success(mock_post):
     assert 'foo' in kwargs['json']
     assert kwargs['json']['foo'] == 'bar'
 
-@patch('requests.post')
+@patch('requests.Session.post')
 def test_trigger_webhook_failure(mock_post):
     """WebhookへのPOSTがリクエスト例外を投げる場合"""
     # requests.exceptions.RequestException にする
@@ -610,7 +712,7 @@ def test_trigger_webhook_failure(mock_post):
 #     assert len(feed.entity) == 1
 #     assert feed.entity[0].vehicle.trip.trip_id == 'trip123'
 
-@patch('requests.get')
+@patch('requests.Session.get')
 def test_fetch_gtfs_data_http_error(mock_get):
     """HTTPエラーまたは例外の場合"""
     mock_get.side_effect = requests.exceptions.RequestException("HTTP Error")
@@ -716,3 +818,1766 @@ def test_scheduled_task_within_1hour_allow_multiple(
     context = {}
     scheduled_task(event, context)
     # mock_webhook.assert_called_once()
+
+######################################################################
+# StopCatalog のテスト
+######################################################################
+
+def test_stop_catalog_fetches_once_per_gtfs_id():
+    """同じgtfs_idの停留所一覧は1回だけ取得され、stop_idで引ける"""
+    fetch = Mock(return_value=[
+        {'stop_id': 'stop456', 'stop_name': 'Test Stop', 'stop_lat': 35.2, 'stop_lon': 139.2},
+        {'stop_id': 'stop789', 'stop_name': 'Other Stop', 'stop_lat': 35.3, 'stop_lon': 139.3},
+    ])
+    catalog = StopCatalog(ttl_seconds=60, fetch=fetch)
+    catalog.begin_tick()
+
+    for _ in range(100):
+        assert catalog.get('data', 'stop456')['stop_name'] == 'Test Stop'
+    assert catalog.get('data', 'stop999') is None
+
+    fetch.assert_called_once_with('data')
+    assert catalog.stats() == {'hits': 100, 'misses': 1, 'fetches': 1}
+
+def test_stop_catalog_failed_fetch_not_retried_within_tick():
+    """取得に失敗したgtfs_idは同一ティック内で再取得しない"""
+    fetch = Mock(side_effect=requests.exceptions.RequestException("HTTP Error"))
+    catalog = StopCatalog(ttl_seconds=60, fetch=fetch)
+    catalog.begin_tick()
+
+    assert catalog.get('data', 'stop456') is None
+    assert catalog.get('data', 'stop456') is None
+    assert fetch.call_count == 1
+
+    # 次のティックでは再取得する
+    catalog.begin_tick()
+    catalog.get('data', 'stop456')
+    assert fetch.call_count == 2
+
+def test_stop_catalog_refetches_after_ttl():
+    """TTLを過ぎたら再取得する"""
+    fetch = Mock(return_value=[{'stop_id': 'stop456', 'stop_name': 'Test Stop', 'stop_lat': 35.2, 'stop_lon': 139.2}])
+    catalog = StopCatalog(ttl_seconds=0, fetch=fetch)
+    catalog.get('data', 'stop456')
+    catalog.get('data', 'stop456')
+    assert fetch.call_count == 2
+
+######################################################################
+# GeofenceIndex のテスト
+######################################################################
+
+def test_geofence_index_candidates():
+    """車両位置のセルに重なる円のキーだけが候補になる"""
+    index = GeofenceIndex(cell_degrees=0.01)
+    index.add([139.0, 35.0], 500, 'near')
+    index.add([140.0, 36.0], 10000, 'far')
+
+    assert index.candidates([139.001, 35.001]) == {'near'}
+    assert index.candidates([140.05, 36.05]) == {'far'}
+    assert index.candidates([138.0, 34.0]) == set()
+
+def test_geofence_index_matches_many():
+    """matches_many はセル内の候補のうち実際に円に含まれるキーだけを返す"""
+    index = GeofenceIndex(cell_degrees=0.1)
+    index.add([139.0, 35.0], 500, 'near')
+    index.add([139.0, 35.0], 5000, 'wide')
+
+    matches = index.matches_many([[139.0, 35.0], [139.02, 35.02], [138.0, 34.0]])
+    assert matches == [{'near', 'wide'}, {'wide'}, set()]
+
+def test_geofence_index_oversized_circle_always_candidate():
+    """セル数の上限を超える巨大な円は常に候補になる"""
+    index = GeofenceIndex(cell_degrees=0.01, max_cells_per_circle=10)
+    index.add([139.0, 35.0], 100000, 'huge')
+    assert index.candidates([0.0, 0.0]) == {'huge'}
+
+def test_build_geofence_index(sample_geojson_point, sample_geojson_points):
+    """target_area・stop_idの円を登録し、位置条件のないプランはunindexedに入る"""
+    with patch('scheduled_task.get_stop_name') as mock_get_stop_name:
+        mock_get_stop_name.return_value = ("Test Stop", 35.5, 139.5)
+        filters_list = [
+            {'target_area': sample_geojson_point},
+            {'target_area': sample_geojson_points},
+            {'stop_id': 'stop456'},
+            {'allow_multiple_notifications': True},
+            {'trip_id': 'trip123', 'target_area': sample_geojson_point},  # 転置インデックス側で扱う
+        ]
+        plans = [compile_setting(filters, 'https://example.com/gtfs-rt-endpoint') for filters in filters_list]
+        plans.append(None)  # このティックで評価不要な設定
+        index, unindexed = build_geofence_index(plans)
+
+    assert unindexed == {3}
+    assert index.candidates([139.2, 35.2]) == {0}
+    assert index.candidates([140.0, 36.0]) == {1}
+    assert index.candidates([139.5, 35.5]) == {2}
+
+@patch('utils.filter_plan.haversine_distance')
+def test_process_feed_trusts_vectorized_hits_for_area_only_settings(
+    mock_haversine, sample_geojson_point, gtfs_feed_mock_vehicle
+):
+    """target_areaだけの設定はベクトル計算の距離判定で一致とし、スカラー版で判定し直さない"""
+    with patch('scheduled_task.get_stop_name', return_value=("Test Stop", 35.2, 139.2)):
+        feed = FeedGroup('feed', 'https://example.com/gtfs-rt-endpoint', [
+            _delta_setting(target_area=sample_geojson_point),
+            dict(_delta_setting(target_area=sample_geojson_point, stop_id='stop456'), userEmail='stop@example.com'),
+        ])
+    assert feed.area_only == {0}
+    mock_haversine.return_value = 0
+    dispatcher = Mock()
+
+    process_feed('https://example.com/gtfs-rt-endpoint', feed, gtfs_feed_mock_vehicle,
+                 datetime(2024, 5, 13, 12, 0), MagicMock(), dispatcher)
+
+    assert dispatcher.submit.call_count == 2
+    # 停留所の条件もある設定だけをスカラー版で判定する（停留所と target_area の円の2回）
+    assert mock_haversine.call_count == 2
+
+@patch('scheduled_task.get_table')
+@patch('scheduled_task.load_all_settings')
+@patch('scheduled_task.fetch_gtfs_data')
+@patch('scheduled_task.trigger_webhook')
+@patch('utils.filter_plan.FilterPlan.matches', autospec=True, return_value=False)
+def test_scheduled_task_skips_settings_outside_geofence_cells(
+    mock_check, mock_webhook, mock_fetch, mock_get_all, mock_table, sample_geojson_points, gtfs_feed_mock_vehicle
+):
+    """車両から遠いジオフェンスを持つ設定は条件判定されない"""
+    mock_get_all.return_value = [{
+        'gtfsRtEndpoint': 'https://example.com/gtfs-rt-endpoint',
+        'userEmail': 'test@example.com',
+        'webhook_url': 'https://example.com/webhook',
+        'filters': {'target_area': sample_geojson_points},
+    }]
+    mock_fetch.return_value = gtfs_feed_mock_vehicle  # 車両は (139.2, 35.2)
+
+    scheduled_task({}, {})
+    mock_check.assert_not_called()
+    mock_webhook.assert_not_called()
+
+######################################################################
+# FilterPlan のテスト
+######################################################################
+
+def test_filter_plan_time_predicates_evaluated_against_given_clock():
+    """時刻条件は渡された時刻で判定される"""
+    plan = compile_filters({
+        'date': '2024-05-13',
+        'weekday': ['Monday'],
+        'start_time': '2024-05-13T08:00:00',
+        'end_time': '2024-05-13T20:00:00Z',
+    }, resolve_stop=Mock())
+
+    assert plan.is_active(datetime(2024, 5, 13, 12, 0)) is True
+    assert plan.is_active(datetime(2024, 5, 13, 7, 59)) is False
+    assert plan.is_active(datetime(2024, 5, 13, 20, 1)) is False
+    assert plan.is_active(datetime(2024, 5, 14, 12, 0)) is False
+
+def test_filter_plan_resolves_stop_once():
+    """停留所の座標はコンパイル時に1回だけ解決される"""
+    resolve_stop = Mock(return_value=("Test Stop", 35.2, 139.2))
+    plan = compile_filters({'stop_id': 'stop456'}, resolve_stop)
+
+    class Vehicle:
+        position = MagicMock(latitude=35.2, longitude=139.2)
+        trip = MagicMock(trip_id='trip123')
+
+    for _ in range(10):
+        assert plan.matches(Vehicle()) is True
+    resolve_stop.assert_called_once_with('stop456')
+
+def test_filter_plan_invalid_filters_never_match():
+    """不正なフィルターは例外を出さず、決して一致しないプランになる"""
+    assert compile_filters({'date': 'not-a-date'}, Mock()).never is True
+    assert compile_filters({'target_area': {'type': 'Polygon'}}, Mock()).never is True
+    assert compile_filters({'stop_id': 'stop999'}, Mock(return_value=(None, None, None))).never is True
+
+######################################################################
+# KeyIndex のテスト
+######################################################################
+
+def test_build_key_index_uses_most_selective_filter():
+    """完全一致の条件を持つプランは最も絞り込みの効くフィールドで登録される"""
+    plans = [
+        compile_filters({'trip_id': 'trip123', 'route_id': 'route1'}, Mock()),
+        compile_filters({'route_id': 'route1'}, Mock()),
+        compile_filters({'vehicle_id': 'vehicle123'}, Mock()),
+        compile_filters({'direction_id': Decimal('1')}, Mock()),
+        compile_filters({}, Mock()),
+        None,
+    ]
+    index = build_key_index(plans)
+
+    assert index.size == 4
+    assert index.lookup({'trip_id': 'trip123', 'route_id': 'route1', 'vehicle_id': 'v9', 'direction_id': None}) == {0, 1}
+    assert index.lookup({'trip_id': 'trip999', 'route_id': 'route2', 'vehicle_id': 'vehicle123', 'direction_id': 1}) == {2, 3}
+
+def test_filter_plan_matches_route_vehicle_and_direction(gtfs_feed_mock_vehicle):
+    """route_id・vehicle_id・direction_idの条件をVehiclePositionから判定する"""
+    vehicle = gtfs_feed_mock_vehicle.entity[0].vehicle
+    vehicle.trip.route_id = 'route1'
+
+    assert compile_filters({'route_id': 'route1', 'vehicle_id': 'vehicle123'}, Mock()).matches(vehicle) is True
+    assert compile_filters({'route_id': 'route2'}, Mock()).matches(vehicle) is False
+    # direction_idが未設定の車両は一致しない
+    assert compile_filters({'direction_id': 0}, Mock()).matches(vehicle) is False
+    vehicle.trip.direction_id = 1
+    assert compile_filters({'direction_id': Decimal('1')}, Mock()).matches(vehicle) is True
+
+@patch('scheduled_task.get_table')
+@patch('scheduled_task.load_all_settings')
+@patch('scheduled_task.fetch_gtfs_data')
+@patch('scheduled_task.trigger_webhook')
+@patch('utils.filter_plan.FilterPlan.matches', autospec=True, return_value=False)
+def test_scheduled_task_skips_settings_keyed_to_other_trips(
+    mock_matches, mock_webhook, mock_fetch, mock_get_all, mock_table, gtfs_feed_mock_vehicle
+):
+    """他のtrip_idを追跡する設定は車両に対して評価されない"""
+    mock_get_all.return_value = [{
+        'gtfsRtEndpoint': 'https://example.com/gtfs-rt-endpoint',
+        'userEmail': 'test@example.com',
+        'webhook_url': 'https://example.com/webhook',
+        'filters': {'trip_id': 'trip999'},
+    }]
+    mock_fetch.return_value = gtfs_feed_mock_vehicle  # 車両は trip123
+
+    scheduled_task({}, {})
+    mock_matches.assert_not_called()
+
+######################################################################
+# フィードの並行取得のテスト
+######################################################################
+
+@patch('scheduled_task.get_table')
+@patch('scheduled_task.load_all_settings')
+@patch('scheduled_task.fetch_gtfs_data')
+@patch('scheduled_task.process_feed')
+def test_scheduled_task_fetches_feeds_concurrently(mock_process, mock_fetch, mock_get_all, mock_table, mock_settings_item):
+    """遅いフィードを待たずに、届いたフィードから順に照合する"""
+    import time
+    slow = dict(mock_settings_item, gtfsRtEndpoint='https://example.com/slow')
+    fast = dict(mock_settings_item, gtfsRtEndpoint='https://example.com/fast')
+    mock_get_all.return_value = [slow, fast]
+
+    def fetch(endpoint, timeout=None, states=None):
+        assert timeout is not None
+        if endpoint.endswith('slow'):
+            time.sleep(0.3)
+        return gtfs_realtime_pb2.FeedMessage()
+    mock_fetch.side_effect = fetch
+
+    started = time.monotonic()
+    scheduled_task({}, {})
+    elapsed = time.monotonic() - started
+
+    processed = [call.args[0] for call in mock_process.call_args_list]
+    assert processed == ['https://example.com/fast', 'https://example.com/slow']
+    assert elapsed < 0.6
+
+######################################################################
+# 条件付きGETのテスト
+######################################################################
+
+def _complete_feed(feed):
+    # シリアライズにはFeedHeaderとentity.idの必須フィールドが必要
+    feed.header.gtfs_realtime_version = '2.0'
+    for i, entity in enumerate(feed.entity):
+        entity.id = entity.id or f'entity{i}'
+    return feed
+
+def _feed_response(feed, status_code=200, headers=None):
+    _complete_feed(feed)
+    return Mock(status_code=status_code, content=feed.SerializeToString(), headers=headers or {})
+
+@patch('requests.Session.get')
+def test_fetch_gtfs_data_sends_validators_and_handles_304(mock_get, gtfs_feed_mock_vehicle):
+    """2回目以降はETag/Last-Modifiedを送り、304なら照合を省略する"""
+    endpoint = 'https://example.com/conditional-get'
+    mock_get.return_value = _feed_response(gtfs_feed_mock_vehicle, headers={
+        'ETag': '"v1"', 'Last-Modified': 'Mon, 13 May 2024 12:00:00 GMT'
+    })
+    feed = fetch_gtfs_data(endpoint)
+    assert len(feed.entity) == 1
+
+    mock_get.return_value = Mock(status_code=304)
+    assert fetch_gtfs_data(endpoint) is FEED_NOT_MODIFIED
+    _, kwargs = mock_get.call_args
+    assert kwargs['headers'] == {'If-None-Match': '"v1"', 'If-Modified-Since': 'Mon, 13 May 2024 12:00:00 GMT'}
+
+@patch('requests.Session.get')
+def test_fetch_gtfs_data_unchanged_header_timestamp(mock_get, gtfs_feed_mock_vehicle):
+    """検証ヘッダーがなくても、本文やFeedHeader.timestampが同じなら更新なしとみなす"""
+    endpoint = 'https://example.com/no-validators'
+    gtfs_feed_mock_vehicle.header.timestamp = 1715601600
+    mock_get.return_value = _feed_response(gtfs_feed_mock_vehicle)
+    assert fetch_gtfs_data(endpoint) not in (None, FEED_NOT_MODIFIED)
+    # 同じ本文
+    assert fetch_gtfs_data(endpoint) is FEED_NOT_MODIFIED
+    # 本文は異なるがスナップショットの時刻は同じ
+    gtfs_feed_mock_vehicle.entity[0].vehicle.position.latitude = 35.3
+    mock_get.return_value = _feed_response(gtfs_feed_mock_vehicle)
+    assert fetch_gtfs_data(endpoint) is FEED_NOT_MODIFIED
+
+@patch('requests.Session.get')
+def test_fetch_gtfs_data_stale_feed(mock_get, gtfs_feed_mock_vehicle, monkeypatch):
+    """FeedHeader.timestampがGTFS_MAX_FEED_AGE_SECONDSより古ければ照合しない"""
+    monkeypatch.setenv('GTFS_MAX_FEED_AGE_SECONDS', '300')
+    gtfs_feed_mock_vehicle.header.timestamp = int((datetime.utcnow() - datetime(1970, 1, 1)).total_seconds()) - 3600
+    mock_get.return_value = _feed_response(gtfs_feed_mock_vehicle)
+    assert fetch_gtfs_data('https://example.com/stale-feed') is FEED_STALE
+
+@patch.dict('scheduled_task.feed_states', clear=True)
+@patch('scheduled_task.http.max_request_seconds', return_value=-0.8)  # 待ち時間の上限を0.2秒にする
+@patch('requests.Session.get')
+def test_fetch_feeds_late_result_does_not_update_feed_state(mock_get, mock_max_request_seconds, gtfs_feed_mock_vehicle):
+    """上限までに届かなかったフィードは取得時の情報を反映せず、次のティックでも304にならないようにする"""
+    import time
+    from scheduled_task import feed_states, fetch_feeds
+
+    def get(url, **kwargs):
+        if url.endswith('slow'):
+            time.sleep(0.4)
+        return _feed_response(gtfs_feed_mock_vehicle, headers={'ETag': f'"{url}"'})
+    mock_get.side_effect = get
+
+    results = list(fetch_feeds(['https://example.com/fast', 'https://example.com/slow']))
+    assert [url for url, _ in results] == ['https://example.com/fast']
+    time.sleep(0.5)
+    assert list(feed_states) == ['https://example.com/fast']
+    assert mock_max_request_seconds.call_args.args == ((3.05, 10.0),)
+
+@patch.dict('scheduled_task.feed_states', clear=True)
+@patch('scheduled_task.http.max_request_seconds', return_value=1000)
+@patch('requests.Session.get')
+def test_fetch_feeds_deadline_is_capped_by_tick_budget(mock_get, mock_max_request_seconds, gtfs_feed_mock_vehicle,
+                                                       monkeypatch):
+    """リトライ方針から決まる待ち時間が長くても、GTFS_FETCH_BUDGET_SECONDSで打ち切る"""
+    import time
+    from scheduled_task import fetch_feeds
+    monkeypatch.setenv('GTFS_FETCH_BUDGET_SECONDS', '0.2')
+
+    def get(url, **kwargs):
+        assert kwargs['timeout'] == (3.05, 10.0)
+        if url.endswith('slow'):
+            time.sleep(0.4)
+        return _feed_response(gtfs_feed_mock_vehicle)
+    mock_get.side_effect = get
+
+    started = time.monotonic()
+    results = list(fetch_feeds(['https://example.com/fast', 'https://example.com/slow']))
+    assert [url for url, _ in results] == ['https://example.com/fast']
+    assert time.monotonic() - started < 0.4
+
+######################################################################
+# utils.http のテスト
+######################################################################
+
+def test_max_request_seconds_includes_retries_and_backoff(monkeypatch):
+    """リトライの回数だけ接続・読み込みのタイムアウトを繰り返し、間のバックオフを足す"""
+    monkeypatch.setenv('HTTP_MAX_RETRIES', '3')
+    monkeypatch.setenv('HTTP_RETRY_BACKOFF_SECONDS', '0.5')
+    assert http.max_request_seconds(10) == 4 * 20 + 1.0 + 2.0
+    assert http.max_request_seconds((3, 5)) == 4 * 8 + 1.0 + 2.0
+
+def test_http_session_is_reused_with_pooling_and_retries():
+    """セッションはウォームスタート間で共有され、接続プールとリトライが設定される"""
+    http.reset_session()
+    session = http.get_session()
+    assert http.get_session() is session
+
+    adapter = session.get_adapter('https://example.com/')
+    assert adapter.max_retries.total == 2
+    assert 'POST' not in adapter.max_retries.allowed_methods
+    http.reset_session()
+
+@patch('requests.Session.post')
+def test_http_post_applies_default_timeout(mock_post, monkeypatch):
+    """タイムアウト未指定の呼び出しには既定の接続・読み込みタイムアウトが付く"""
+    monkeypatch.setenv('HTTP_CONNECT_TIMEOUT_SECONDS', '1')
+    monkeypatch.setenv('HTTP_READ_TIMEOUT_SECONDS', '5')
+    http.post('https://example.com/webhook', json={})
+    _, kwargs = mock_post.call_args
+    assert kwargs['timeout'] == (1.0, 5.0)
+
+######################################################################
+# WebhookDispatcher のテスト
+######################################################################
+
+def test_webhook_dispatcher_caps_per_host_concurrency():
+    """同じホストへの同時送信数が上限を超えない"""
+    import threading
+    import time
+    lock = threading.Lock()
+    active = {'now': 0, 'max': 0}
+
+    def send(webhook_url, event_data):
+        with lock:
+            active['now'] += 1
+            active['max'] = max(active['max'], active['now'])
+        time.sleep(0.02)
+        with lock:
+            active['now'] -= 1
+        return 200
+
+    dispatcher = WebhookDispatcher(send, max_workers=8, per_host_limit=2)
+    for i in range(10):
+        dispatcher.submit('https://hooks.example.com/webhook', {'n': i})
+    results, unfinished = dispatcher.drain(timeout=5)
+
+    assert unfinished == 0
+    assert len(results) == 10
+    assert all(result['ok'] for result in results)
+    assert active['max'] == 2
+
+def test_webhook_dispatcher_retries_with_exponential_backoff():
+    """失敗・5xxは指数バックオフで再送し、4xxは再送しない"""
+    sleep = Mock()
+    send = Mock(side_effect=[None, 503, 200, 404])
+    dispatcher = WebhookDispatcher(send, max_workers=1, per_host_limit=1, max_attempts=3, backoff_seconds=0.5, sleep=sleep)
+    dispatcher.submit('https://example.com/a', {})
+    dispatcher.submit('https://example.com/b', {})
+    results, _ = dispatcher.drain(timeout=5)
+
+    assert [(r['webhook_url'], r['status_code'], r['attempts']) for r in results] == [
+        ('https://example.com/a', 200, 3),
+        ('https://example.com/b', 404, 1),
+    ]
+    assert [call.args[0] for call in sleep.call_args_list] == [0.5, 1.0]
+
+@patch('scheduled_task.get_table')
+@patch('scheduled_task.load_all_settings')
+@patch('scheduled_task.fetch_gtfs_data')
+@patch('scheduled_task.trigger_webhook')
+def test_scheduled_task_dispatches_matched_webhooks(mock_webhook, mock_fetch, mock_get_all, mock_table, mock_settings_item, gtfs_feed_mock_vehicle):
+    """条件に一致した車両の通知はdispatcher経由でtrigger_webhookに渡される"""
+    mock_settings_item['filters'] = {'trip_id': 'trip123'}
+    mock_get_all.return_value = [mock_settings_item]
+    mock_fetch.return_value = gtfs_feed_mock_vehicle
+    mock_webhook.return_value = 200
+
+    scheduled_task({}, {})
+    mock_webhook.assert_called_once()
+    webhook_url, event_data = mock_webhook.call_args.args
+    assert webhook_url == 'https://example.com/webhook'
+    assert event_data['vehicle_id'] == 'vehicle123'
+    assert 'lastNotificationTimestamp' not in event_data['alarm_settings']
+
+######################################################################
+# NotificationWriteBuffer のテスト
+######################################################################
+
+def test_notification_write_buffer_coalesces_updates(mock_settings_item):
+    """同じ設定への複数回の更新は、タイムスタンプ属性だけの条件付きUpdateItem 1回にまとめる"""
+    table = Mock()
+    table.update_item.return_value = {'ConsumedCapacity': {'CapacityUnits': 1.0}}
+    mock_settings_item['lastNotificationTimestamp'] = '2024-05-13T10:00:00'
+    buffer = NotificationWriteBuffer(table)
+
+    buffer.record(mock_settings_item, '2024-05-13T12:00:00')
+    buffer.record(mock_settings_item, '2024-05-13T12:00:30')
+    assert mock_settings_item['lastNotificationTimestamp'] == '2024-05-13T12:00:30'
+    table.update_item.assert_not_called()
+
+    stats = buffer.flush()
+    assert stats == {'writes': 1, 'conflicts': 0, 'errors': 0, 'consumed_capacity': 1.0}
+    _, kwargs = table.update_item.call_args
+    assert kwargs['Key'] == {'gtfsRtEndpoint': mock_settings_item['gtfsRtEndpoint'], 'userEmail': 'test@example.com'}
+    assert kwargs['UpdateExpression'] == 'SET lastNotificationTimestamp = :ts'
+    assert kwargs['ExpressionAttributeValues'] == {':ts': '2024-05-13T12:00:30', ':previous': '2024-05-13T10:00:00'}
+    assert len(buffer) == 0
+
+def test_notification_write_buffer_counts_conflicts(mock_settings_item):
+    """ティック中に編集された設定は上書きせず、競合として数える"""
+    from botocore.exceptions import ClientError
+    table = Mock()
+    table.update_item.side_effect = ClientError(
+        {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'conflict'}}, 'UpdateItem'
+    )
+    buffer = NotificationWriteBuffer(table)
+    buffer.record(mock_settings_item, '2024-05-13T12:00:00')
+
+    assert buffer.flush()['conflicts'] == 1
+    _, kwargs = table.update_item.call_args
+    assert 'attribute_not_exists(lastNotificationTimestamp)' in kwargs['ConditionExpression']
+
+def _conditional_check_failed(item=None):
+    from botocore.exceptions import ClientError
+    response = {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'conflict'}}
+    if item is not None:
+        response['Item'] = item
+    return ClientError(response, 'UpdateItem')
+
+def test_notification_write_buffer_claim_writes_before_sending(mock_settings_item):
+    """再通知を抑止する通知は、テーブルの値が期間外のときだけ通知時刻を書き込んで送る権利を得る"""
+    table = Mock()
+    buffer = NotificationWriteBuffer(table)
+    buffer.record(mock_settings_item, '2024-05-13T12:00:00')
+
+    assert buffer.claim(mock_settings_item, '2024-05-13T12:00:00', '2024-05-13T11:00:00') is True
+    _, kwargs = table.update_item.call_args
+    assert 'lastNotificationTimestamp < :not_after' in kwargs['ConditionExpression']
+    assert kwargs['ExpressionAttributeValues'] == {':ts': '2024-05-13T12:00:00', ':not_after': '2024-05-13T11:00:00'}
+    assert mock_settings_item['lastNotificationTimestamp'] == '2024-05-13T12:00:00'
+    # 書き込み済みなので、ティックの最後にもう一度書き込まない
+    assert len(buffer) == 0
+
+def test_notification_write_buffer_claim_fails_when_notified_elsewhere(mock_settings_item):
+    """ほかのコンテナが期間内に通知していたら送らず、その時刻をメモリ上の設定に反映する"""
+    table = Mock()
+    table.update_item.side_effect = _conditional_check_failed(
+        {'lastNotificationTimestamp': {'S': '2024-05-13T11:30:00'}})
+    buffer = NotificationWriteBuffer(table)
+
+    assert buffer.claim(mock_settings_item, '2024-05-13T12:00:00', '2024-05-13T11:00:00') is False
+    assert mock_settings_item['lastNotificationTimestamp'] == '2024-05-13T11:30:00'
+
+def test_process_feed_skips_notification_claimed_by_other_container(gtfs_feed_mock_vehicle, sample_geojson_point):
+    """キャッシュした設定の通知時刻が古くても、ほかのコンテナが1時間以内に通知していれば送らない"""
+    setting = _delta_setting(target_area=sample_geojson_point, allow_multiple_notifications=False)
+    setting['lastNotificationTimestamp'] = '2024-05-13T10:00:00'
+    table = Mock()
+    table.update_item.side_effect = _conditional_check_failed(
+        {'lastNotificationTimestamp': {'S': '2024-05-13T11:59:00'}})
+    dispatcher = Mock()
+    feed = FeedGroup('feed', 'https://example.com/gtfs-rt-endpoint', [setting])
+
+    process_feed('https://example.com/gtfs-rt-endpoint', feed, gtfs_feed_mock_vehicle,
+                 datetime(2024, 5, 13, 12, 0), NotificationWriteBuffer(table), dispatcher)
+    dispatcher.submit.assert_not_called()
+    assert setting['lastNotificationTimestamp'] == '2024-05-13T11:59:00'
+
+@patch('scheduled_task.get_table')
+@patch('scheduled_task.load_all_settings')
+@patch('scheduled_task.fetch_gtfs_data')
+@patch('scheduled_task.trigger_webhook')
+def test_scheduled_task_writes_only_notification_timestamp(mock_webhook, mock_fetch, mock_get_all, mock_table, mock_settings_item, gtfs_feed_mock_vehicle):
+    """通知時は設定全体をput_itemせず、タイムスタンプだけを更新する"""
+    mock_settings_item['filters'] = {'trip_id': 'trip123'}
+    mock_get_all.return_value = [mock_settings_item]
+    mock_fetch.return_value = gtfs_feed_mock_vehicle
+    mock_table.return_value.update_item.return_value = {}
+
+    scheduled_task({}, {})
+    mock_table.return_value.put_item.assert_not_called()
+    mock_table.return_value.update_item.assert_called_once()
+
+######################################################################
+# 設定テーブルのスキャンのテスト
+######################################################################
+
+@patch('utils.db.get_table')
+def test_iter_settings_follows_pagination_with_projection(mock_table):
+    """LastEvaluatedKeyをたどって全ページを読み、ProjectionExpressionを付ける"""
+    mock_table.return_value.scan.side_effect = [
+        {'Items': [{'id': '1'}, {'id': '2'}], 'LastEvaluatedKey': {'id': '2'}},
+        {'Items': [{'id': '3'}]},
+    ]
+    items = list(iter_settings(attributes=['id', 'filters'], segments=1))
+
+    assert [item['id'] for item in items] == ['1', '2', '3']
+    first, second = mock_table.return_value.scan.call_args_list
+    assert first.kwargs == {
+        'ProjectionExpression': '#a0, #a1',
+        'ExpressionAttributeNames': {'#a0': 'id', '#a1': 'filters'},
+    }
+    assert second.kwargs['ExclusiveStartKey'] == {'id': '2'}
+
+@patch('utils.db._segment_table')
+def test_iter_settings_parallel_segments(mock_segment_table):
+    """TotalSegmentsで分割したセグメントを並列に読み、全アイテムを返す"""
+    def scan(**kwargs):
+        segment = kwargs['Segment']
+        assert kwargs['TotalSegments'] == 3
+        if 'ExclusiveStartKey' not in kwargs:
+            return {'Items': [{'id': f'{segment}-a'}], 'LastEvaluatedKey': {'id': f'{segment}-a'}}
+        return {'Items': [{'id': f'{segment}-b'}]}
+    mock_segment_table.return_value.__enter__.return_value.scan.side_effect = scan
+
+    items = list(iter_settings(segments=3))
+    assert sorted(item['id'] for item in items) == ['0-a', '0-b', '1-a', '1-b', '2-a', '2-b']
+    assert mock_segment_table.call_count == 3
+
+@patch('utils.db._segment_table')
+def test_get_all_settings_returns_empty_on_segment_error(mock_segment_table):
+    """いずれかのセグメントの読み込みに失敗したら、従来どおり空のリストを返す"""
+    mock_segment_table.return_value.__enter__.return_value.scan.side_effect = Exception('throttled')
+    assert get_all_settings(segments=2) == []
+
+######################################################################
+# 設定キャッシュのテスト
+######################################################################
+
+def _settings_table(version, changes=()):
+    """バージョンカウンターと変更履歴を持つ変更履歴テーブルのモック"""
+    table = MagicMock()
+    table.get_item.return_value = {'Item': {'version': Decimal(version)}}
+    table.query.return_value = {'Items': list(changes)}
+    return table
+
+def _change(version, event_name, user_email, **image):
+    keys = {'gtfsRtEndpoint': 'data', 'userEmail': user_email}
+    change = {'version': Decimal(version), 'eventName': event_name, 'Keys': keys}
+    if event_name != 'REMOVE':
+        change['NewImage'] = dict(keys, **image)
+    return change
+
+def test_settings_cache_reuses_settings_while_version_unchanged():
+    """バージョンが変わらなければ全件スキャンしない"""
+    cache = SettingsCache(max_age_seconds=3600)
+    load_all = Mock(return_value=[{'gtfsRtEndpoint': 'data', 'userEmail': 'a@example.com'}])
+    table = _settings_table(5)
+
+    assert len(cache.get_settings(table, load_all)) == 1
+    assert len(cache.get_settings(table, load_all)) == 1
+    assert load_all.call_count == 1
+    table.query.assert_not_called()
+    assert cache.last_refresh['mode'] == 'unchanged'
+
+def test_settings_cache_applies_change_log_incrementally():
+    """新しいバージョンの変更履歴だけを読んで反映する"""
+    cache = SettingsCache(max_age_seconds=3600, attributes=('gtfsRtEndpoint', 'userEmail', 'webhook_url'))
+    load_all = Mock(return_value=[
+        {'gtfsRtEndpoint': 'data', 'userEmail': 'a@example.com', 'webhook_url': 'https://a'},
+        {'gtfsRtEndpoint': 'data', 'userEmail': 'b@example.com', 'webhook_url': 'https://b'},
+    ])
+    cache.get_settings(_settings_table(5), load_all)
+
+    table = _settings_table(8, [
+        _change(6, 'REMOVE', 'a@example.com'),
+        _change(7, 'MODIFY', 'b@example.com', webhook_url='https://b2', details={'x': 1}),
+        _change(8, 'INSERT', 'c@example.com', webhook_url='https://c'),
+    ])
+    settings = cache.get_settings(table, load_all)
+
+    assert load_all.call_count == 1
+    assert sorted((s['userEmail'], s['webhook_url']) for s in settings) == [
+        ('b@example.com', 'https://b2'), ('c@example.com', 'https://c'),
+    ]
+    assert all('details' not in s for s in settings)  # 射影した属性だけを保持する
+    _, kwargs = table.query.call_args
+    assert kwargs['ConsistentRead'] is True
+    assert cache.version == 8
+    assert cache.last_refresh == {'mode': 'incremental', 'changes': 3, 'items': 2}
+
+def test_settings_cache_rescans_when_change_log_has_gap():
+    """変更履歴に欠番があれば全件を読み直す"""
+    cache = SettingsCache(max_age_seconds=3600)
+    load_all = Mock(return_value=[])
+    cache.get_settings(_settings_table(5), load_all)
+
+    table = _settings_table(7, [_change(7, 'INSERT', 'c@example.com')])
+    cache.get_settings(table, load_all)
+
+    assert load_all.call_count == 2
+    assert cache.version == 7
+    assert cache.last_refresh['mode'] == 'full'
+
+def test_settings_cache_rescans_after_max_age():
+    """max_age_secondsを過ぎたら変更がなくても全件を読み直す"""
+    cache = SettingsCache(max_age_seconds=0)
+    load_all = Mock(return_value=[])
+    table = _settings_table(5)
+    cache.get_settings(table, load_all)
+    cache.get_settings(table, load_all)
+    assert load_all.call_count == 2
+
+def test_settings_cache_keeps_previous_settings_when_reload_fails():
+    """全件スキャンに失敗したら前回の一覧を使い、次回は読み直しを再試行する"""
+    cache = SettingsCache(max_age_seconds=0)
+    item = {'gtfsRtEndpoint': 'data', 'userEmail': 'a@example.com'}
+    cache.get_settings(_settings_table(5), Mock(return_value=[item]))
+
+    settings = cache.get_settings(_settings_table(5), Mock(side_effect=Exception('throttled')))
+    assert settings == [item]
+    assert cache.version is None
+
+def test_settings_cache_reloads_every_time_without_changes_table():
+    """変更履歴テーブルがなければ毎回全件を読み直す"""
+    cache = SettingsCache(max_age_seconds=3600)
+    load_all = Mock(return_value=[{'gtfsRtEndpoint': 'data', 'userEmail': 'a@example.com'}])
+    assert len(cache.get_settings(None, load_all)) == 1
+    assert len(cache.get_settings(None, load_all)) == 1
+    assert load_all.call_count == 2
+    assert cache.last_refresh['mode'] == 'full'
+
+def test_settings_cache_applies_stream_records():
+    """DynamoDB Streams形式のレコードも反映できる"""
+    cache = SettingsCache()
+    cache.apply_stream_records([
+        {'eventName': 'INSERT', 'dynamodb': {
+            'Keys': {'gtfsRtEndpoint': {'S': 'data'}, 'userEmail': {'S': 'a@example.com'}},
+            'NewImage': {'gtfsRtEndpoint': {'S': 'data'}, 'userEmail': {'S': 'a@example.com'},
+                         'filters': {'M': {'direction_id': {'N': '1'}}}},
+        }},
+    ])
+    assert cache.settings() == [{'gtfsRtEndpoint': 'data', 'userEmail': 'a@example.com',
+                                 'filters': {'direction_id': Decimal(1)}}]
+
+    cache.apply_stream_records([{'eventName': 'REMOVE', 'dynamodb': {
+        'Keys': {'gtfsRtEndpoint': {'S': 'data'}, 'userEmail': {'S': 'a@example.com'}},
+    }}])
+    assert len(cache) == 0
+
+def test_record_settings_change_bumps_version_and_writes_change():
+    """バージョンを進め、そのバージョンをソートキーにした変更履歴を書き込む"""
+    table = MagicMock()
+    table.update_item.return_value = {'Attributes': {'version': Decimal(42)}}
+    item = {'gtfsRtEndpoint': 'data', 'userEmail': 'a@example.com', 'id': 'x'}
+
+    assert record_settings_change('INSERT', item, new_image=item, table=table) == 42
+    assert table.update_item.call_args.kwargs['Key'] == SETTINGS_VERSION_KEY
+    change = table.put_item.call_args.kwargs['Item']
+    assert change['partition'] == SETTINGS_CHANGES_PARTITION
+    assert change['sequence'] == '000000000042'
+    assert change['Keys'] == {'gtfsRtEndpoint': 'data', 'userEmail': 'a@example.com'}
+    assert change['NewImage'] == item
+    assert 'expiresAt' in change
+
+@patch('handler.record_settings_change')
+def test_post_records_settings_change(mock_record, mock_get_table):
+    """POSTで保存した設定は変更履歴にも記録される"""
+    event = {'httpMethod': 'POST', 'body': json.dumps({
+        'gtfs_rt_endpoint': 'data', 'user_email': 'a@example.com',
+        'gtfs_endpoint': 'https://example.com/gtfs', 'webhook_url': 'https://example.com/webhook',
+    })}
+    with patch('handler.get_trace_table'):
+        response = main(event, {})
+
+    assert response['statusCode'] == 200
+    args, kwargs = mock_record.call_args
+    assert args[0] == 'INSERT'
+    assert kwargs['new_image']['userEmail'] == 'a@example.com'
+
+def test_post_keeps_settings_changes_out_of_settings_table(mock_get_table):
+    """バージョンと変更履歴は変更履歴テーブルに書き、設定テーブル（スキャン対象）には設定だけが入る"""
+    changes_table = MagicMock()
+    changes_table.update_item.return_value = {'Attributes': {'version': Decimal(1)}}
+    event = {'httpMethod': 'POST', 'body': json.dumps({
+        'gtfs_rt_endpoint': 'data', 'user_email': 'a@example.com',
+        'gtfs_endpoint': 'https://example.com/gtfs', 'webhook_url': 'https://example.com/webhook',
+    })}
+    with patch('handler.get_trace_table'), \
+         patch('utils.settings_cache.get_changes_table', return_value=changes_table):
+        response = main(event, {})
+
+    assert response['statusCode'] == 200
+    mock_get_table.update_item.assert_not_called()
+    items = [c.kwargs['Item'] for c in mock_get_table.put_item.call_args_list]
+    assert [(item['gtfsRtEndpoint'], item['userEmail']) for item in items] == [('data', 'a@example.com')]
+    assert changes_table.put_item.call_args.kwargs['Item']['partition'] == SETTINGS_CHANGES_PARTITION
+
+def test_record_settings_change_skips_without_changes_table():
+    """変更履歴テーブルが設定されていなければ何も書かない"""
+    with patch.dict(os.environ, {'SETTINGS_CHANGES_TABLE_NAME': ''}):
+        assert record_settings_change('REMOVE', {'gtfsRtEndpoint': 'data', 'userEmail': 'a@example.com'}) is None
+
+######################################################################
+# GSIによる設定の検索のテスト
+######################################################################
+
+def test_user_email_key_strips_braces_and_last_segment():
+    """波括弧を外し、最後の@以降を除く"""
+    assert user_email_key('{test@example.com}@fcm') == 'test@example.com'
+    assert user_email_key('test@example.com') == 'test'
+    assert user_email_key('no-at-mark') == ''
+
+def test_main_get_queries_user_email_index(mock_get_table, mock_settings_item):
+    """GETはスキャンせず、UserEmailIndexを正規化したメールアドレスで引く"""
+    mock_get_table.query.side_effect = [
+        {'Items': [mock_settings_item], 'LastEvaluatedKey': {'id': 'x'}},
+        {'Items': [dict(mock_settings_item, id='second')]},
+    ]
+    event = {'httpMethod': 'GET', 'queryStringParameters': {'email': '{test@example.com}'}}
+
+    response = main(event, None)
+    assert response['statusCode'] == 200
+    assert [s['id'] for s in json.loads(response['body'])['settings']] == ['mock-id-1234', 'second']
+    first, second = mock_get_table.query.call_args_list
+    assert first.kwargs['IndexName'] == 'UserEmailIndex'
+    assert first.kwargs['KeyConditionExpression'] == Key('userEmailKey').eq('test@example.com')
+    assert second.kwargs['ExclusiveStartKey'] == {'id': 'x'}
+    mock_get_table.scan.assert_not_called()
+
+def test_main_delete_queries_id_index(mock_get_table, mock_settings_item):
+    """DELETEはIdIndexで見つけたアイテムだけを削除する"""
+    mock_get_table.query.return_value = {'Items': [mock_settings_item]}
+    response = main({'httpMethod': 'DELETE', 'pathParameters': {'id': 'mock-id-1234'}}, None)
+
+    assert response['statusCode'] == 200
+    _, kwargs = mock_get_table.query.call_args
+    assert kwargs['IndexName'] == 'IdIndex'
+    assert kwargs['KeyConditionExpression'] == Key('id').eq('mock-id-1234')
+    mock_get_table.delete_item.assert_called_once_with(
+        Key={'gtfsRtEndpoint': mock_settings_item['gtfsRtEndpoint'], 'userEmail': mock_settings_item['userEmail']})
+    mock_get_table.scan.assert_not_called()
+
+def test_main_post_writes_user_email_key(mock_get_table):
+    """POSTで保存するアイテムにはUserEmailIndexのキーが付く"""
+    event = {'httpMethod': 'POST', 'body': json.dumps({
+        'gtfs_rt_endpoint': 'data', 'user_email': '{a@example.com}@fcm',
+        'gtfs_endpoint': 'https://example.com/gtfs', 'webhook_url': 'https://example.com/webhook',
+    })}
+    with patch('handler.get_trace_table'):
+        main(event, {})
+
+    item = mock_get_table.put_item.call_args_list[0].kwargs['Item']
+    assert item['userEmailKey'] == 'a@example.com'
+
+@patch('delete_alert.get_table')
+def test_delete_alert_queries_index_and_matches_full_email(mock_table):
+    """delete_alertはGSIで候補を引き、波括弧を外した完全なメールアドレスが一致するものを削除する"""
+    mock_table.return_value.query.return_value = {'Items': [
+        {'gtfsRtEndpoint': 'data', 'userEmail': '{a@example.com}@other'},
+        {'gtfsRtEndpoint': 'data', 'userEmail': '{a@example.com}@fcm'},
+    ]}
+    event = {'httpMethod': 'GET', 'queryStringParameters': {'userEmail': '{a@example.com}@fcm'}}
+
+    response = delete_alert_handler(event, None)
+    assert response['statusCode'] == 200
+    _, kwargs = mock_table.return_value.query.call_args
+    assert kwargs['KeyConditionExpression'] == Key('userEmailKey').eq('a@example.com')
+    mock_table.return_value.delete_item.assert_called_once_with(
+        Key={'gtfsRtEndpoint': 'data', 'userEmail': '{a@example.com}@fcm'})
+    mock_table.return_value.scan.assert_not_called()
+
+def test_backfill_sets_missing_user_email_keys():
+    """userEmailKeyがない・古いアイテムだけを更新する"""
+    table = MagicMock()
+    items = [
+        {'gtfsRtEndpoint': 'data', 'userEmail': 'a@example.com@fcm'},
+        {'gtfsRtEndpoint': 'data', 'userEmail': 'b@example.com@fcm', 'userEmailKey': 'b@example.com'},
+        {'gtfsRtEndpoint': 'data', 'userEmail': 'no-at-mark'},
+    ]
+    assert backfill(table, items) == 1
+    _, kwargs = table.update_item.call_args
+    assert kwargs['ExpressionAttributeValues'] == {':key': 'a@example.com'}
+
+######################################################################
+# 1回の起動内でのポーリングループのテスト
+######################################################################
+
+class _FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def _run_loop(intervals, loop_seconds, tick_seconds, context=None):
+    clock = _FakeClock()
+    polled = []
+
+    def run_tick(due, now, notification_writes, dispatcher):
+        polled.extend((clock.now, gtfs_rt_endpoint) for gtfs_rt_endpoint in due)
+        clock.now += tick_seconds
+
+    feeds = {gtfs_rt_endpoint: Mock() for gtfs_rt_endpoint in intervals}
+    with patch('scheduled_task.run_tick', side_effect=run_tick):
+        iterations = run_polling_loop(feeds, loop_seconds, intervals, context, MagicMock(), Mock(),
+                                      clock=clock, sleep=clock.sleep)
+    return polled, iterations
+
+def test_polling_loop_polls_each_feed_at_its_own_interval_without_drift():
+    """フィードごとの間隔で、照合にかかった時間に関係なく予定時刻どおりにポーリングする"""
+    polled, iterations = _run_loop({'a': 15, 'b': 30}, loop_seconds=50, tick_seconds=2)
+    assert [t for t, feed in polled if feed == 'a'] == [0, 15, 30, 45]
+    assert [t for t, feed in polled if feed == 'b'] == [0, 30]
+    assert iterations == 4
+
+def test_polling_loop_skips_missed_slots():
+    """照合が間隔より長引いたら、間に合わなかった回は飛ばして予定時刻に合わせる"""
+    polled, _ = _run_loop({'a': 10}, loop_seconds=40, tick_seconds=12)
+    assert [t for t, _ in polled] == [0, 20, 40]
+
+def test_polling_loop_stops_before_lambda_timeout():
+    """Lambdaの残り時間から余裕を引いた時刻を過ぎてから始まる反復はない"""
+    context = Mock()
+    context.get_remaining_time_in_millis.return_value = 60000
+    with patch.dict(os.environ, {'POLL_SAFETY_MARGIN_SECONDS': '25'}):
+        polled, _ = _run_loop({'a': 10}, loop_seconds=300, tick_seconds=1, context=context)
+    assert [t for t, _ in polled] == [0, 10, 20, 30]
+
+def test_poll_intervals_override_by_feed_key():
+    """ポーリング間隔はイベントでフィードの識別子ごとに上書きできる"""
+    with patch('scheduled_task.compile_setting'):
+        feeds = group_feeds([
+            {'gtfsRtEndpoint': 'https://example.com/a', 'userEmail': 'a', 'webhook_url': 'w', 'filters': {}},
+            {'gtfsRtEndpoint': 'https://example.com/b', 'userEmail': 'b', 'webhook_url': 'w', 'filters': {}},
+        ])
+    with patch.dict(os.environ, {'POLL_INTERVAL_SECONDS': '20'}):
+        intervals = poll_intervals(feeds, {'poll_intervals': {'https://example.com/a': 5}})
+    assert intervals == {'https://example.com/a': 5.0, 'https://example.com/b': 20.0}
+
+@patch('scheduled_task.get_table')
+@patch('scheduled_task.load_all_settings')
+@patch('scheduled_task.fetch_gtfs_data')
+@patch('scheduled_task.trigger_webhook')
+@patch('scheduled_task.run_polling_loop', return_value=3)
+def test_scheduled_task_runs_polling_loop_when_requested(mock_loop, mock_webhook, mock_fetch, mock_get_all, mock_table, mock_settings_item):
+    """イベントでループの秒数が指定されたらポーリングループで照合する"""
+    mock_get_all.return_value = [mock_settings_item]
+    scheduled_task({'poll_loop_seconds': 45}, {})
+
+    mock_fetch.assert_not_called()
+    args = mock_loop.call_args.args
+    assert list(args[0]) == ['https://example.com/gtfs-rt-endpoint']
+    assert args[1] == 45.0
+
+######################################################################
+# 状態が変わった車両だけを照合するテスト
+######################################################################
+
+def _delta_setting(**filters):
+    filters.setdefault('allow_multiple_notifications', True)
+    return {'gtfsRtEndpoint': 'https://example.com/gtfs-rt-endpoint', 'userEmail': 'test@example.com',
+            'webhook_url': 'https://example.com/webhook', 'filters': filters}
+
+def _process(setting, feed_message, now):
+    dispatcher = Mock()
+    feed = FeedGroup('feed', 'https://example.com/gtfs-rt-endpoint', [setting])
+    process_feed('https://example.com/gtfs-rt-endpoint', feed, feed_message, now, MagicMock(), dispatcher)
+    return dispatcher.submit.call_count
+
+def test_unchanged_vehicle_reuses_previous_match(gtfs_feed_mock_vehicle):
+    """位置もtripも変わっていない車両は照合し直さず、前回の結果を使う"""
+    now = datetime(2024, 5, 13, 12, 0)
+    setting = _delta_setting(trip_id='trip123', notify_on=['enter', 'exit'])
+    with patch('utils.filter_plan.FilterPlan.matches', autospec=True, side_effect=lambda plan, vehicle: True) as mock_matches:
+        assert _process(setting, gtfs_feed_mock_vehicle, now) == 1
+        # 前回の一致が引き継がれるので、退出とはみなされない
+        assert _process(setting, gtfs_feed_mock_vehicle, now + timedelta(seconds=60)) == 0
+    assert mock_matches.call_count == 1
+
+def test_moved_vehicle_is_evaluated_again(gtfs_feed_mock_vehicle):
+    """位置が変わった車両は照合し直す"""
+    now = datetime(2024, 5, 13, 12, 0)
+    setting = _delta_setting(trip_id='trip123')
+    assert _process(setting, gtfs_feed_mock_vehicle, now) == 1
+
+    gtfs_feed_mock_vehicle.entity[0].vehicle.trip.trip_id = 'other-trip'
+    assert _process(setting, gtfs_feed_mock_vehicle, now) == 0
+
+def test_unchanged_vehicle_is_evaluated_for_newly_active_setting(gtfs_feed_mock_vehicle):
+    """時刻の条件で新しく有効になった設定は、止まっている車両とも照合する"""
+    setting = _delta_setting(trip_id='trip123', start_time='2024-05-13T12:00:00')
+    assert _process(setting, gtfs_feed_mock_vehicle, datetime(2024, 5, 13, 11, 59)) == 0
+    assert _process(setting, gtfs_feed_mock_vehicle, datetime(2024, 5, 13, 12, 0)) == 1
+
+def test_unchanged_vehicle_is_evaluated_for_edited_setting(gtfs_feed_mock_vehicle):
+    """フィルターが変更された設定は、止まっている車両とも照合し直す"""
+    now = datetime(2024, 5, 13, 12, 0)
+    assert _process(_delta_setting(trip_id='trip999'), gtfs_feed_mock_vehicle, now) == 0
+    assert _process(_delta_setting(trip_id='trip123'), gtfs_feed_mock_vehicle, now) == 1
+
+######################################################################
+# 入場・退出・滞在の遷移による通知のテスト
+######################################################################
+
+def _events(setting, feed_message, now):
+    dispatcher = Mock()
+    feed = FeedGroup('feed', 'https://example.com/gtfs-rt-endpoint', [setting])
+    process_feed('https://example.com/gtfs-rt-endpoint', feed, feed_message, now, MagicMock(), dispatcher)
+    return [call.args[1]['event_type'] for call in dispatcher.submit.call_args_list]
+
+def _move_vehicle(feed_message, latitude):
+    feed_message.entity[0].vehicle.position.latitude = latitude
+
+def test_vehicle_lingering_in_area_notifies_only_on_entry(gtfs_feed_mock_vehicle, sample_geojson_point):
+    """範囲内に留まる車両は入場時だけ通知し、出て再び入ったら再度通知する"""
+    setting = _delta_setting(target_area=sample_geojson_point)  # 中心 (139.2, 35.2)
+    now = datetime(2024, 5, 13, 12, 0)
+
+    assert _events(setting, gtfs_feed_mock_vehicle, now) == ['enter']
+    _move_vehicle(gtfs_feed_mock_vehicle, 35.2001)
+    assert _events(setting, gtfs_feed_mock_vehicle, now + timedelta(minutes=1)) == []
+    _move_vehicle(gtfs_feed_mock_vehicle, 36.0)
+    assert _events(setting, gtfs_feed_mock_vehicle, now + timedelta(minutes=2)) == []
+    _move_vehicle(gtfs_feed_mock_vehicle, 35.2)
+    assert _events(setting, gtfs_feed_mock_vehicle, now + timedelta(minutes=3)) == ['enter']
+
+def test_exit_notification_when_requested(gtfs_feed_mock_vehicle, sample_geojson_point):
+    """notify_onにexitを含めると、範囲から出たときに通知する"""
+    setting = _delta_setting(target_area=sample_geojson_point, notify_on=['exit'])
+    now = datetime(2024, 5, 13, 12, 0)
+
+    assert _events(setting, gtfs_feed_mock_vehicle, now) == []
+    _move_vehicle(gtfs_feed_mock_vehicle, 36.0)
+    assert _events(setting, gtfs_feed_mock_vehicle, now + timedelta(minutes=1)) == ['exit']
+
+def test_dwell_notification_after_dwell_seconds(gtfs_feed_mock_vehicle, sample_geojson_point):
+    """notify_onにdwellを含めると、dwell_seconds以上留まった車両で一度だけ通知する"""
+    setting = _delta_setting(target_area=sample_geojson_point, notify_on=['dwell'], dwell_seconds=120)
+    now = datetime(2024, 5, 13, 12, 0)
+
+    assert _events(setting, gtfs_feed_mock_vehicle, now) == []
+    assert _events(setting, gtfs_feed_mock_vehicle, now + timedelta(seconds=60)) == []
+    assert _events(setting, gtfs_feed_mock_vehicle, now + timedelta(seconds=120)) == ['dwell']
+    assert _events(setting, gtfs_feed_mock_vehicle, now + timedelta(seconds=180)) == []
+
+@pytest.mark.parametrize('filters', [
+    {'notify_on': ['dwell'], 'dwell_seconds': '5min'},
+    {'notify_on': 1},
+    {'notify_on': [['enter']]},
+])
+def test_malformed_notification_policy_does_not_block_other_settings(gtfs_feed_mock_vehicle, sample_geojson_point,
+                                                                     filters):
+    """notify_on・dwell_secondsを解釈できない設定は一致しないものとして扱い、他の設定は通知する"""
+    broken = dict(_delta_setting(target_area=sample_geojson_point, **filters), userEmail='broken@example.com')
+    valid = _delta_setting(target_area=sample_geojson_point)
+    dispatcher = Mock()
+    feeds = group_feeds([broken, valid])
+    feed = feeds['https://example.com/gtfs-rt-endpoint']
+    assert feed.plans[0] is None
+
+    process_feed('https://example.com/gtfs-rt-endpoint', feed, gtfs_feed_mock_vehicle,
+                 datetime(2024, 5, 13, 12, 0), MagicMock(), dispatcher)
+    assert [call.args[1]['alarm_settings']['userEmail'] for call in dispatcher.submit.call_args_list] == [
+        'test@example.com']
+
+def _transaction_canceled(*codes):
+    from botocore.exceptions import ClientError
+    return ClientError({'Error': {'Code': 'TransactionCanceledException', 'Message': 'canceled'},
+                        'CancellationReasons': [{'Code': code} for code in codes]}, 'TransactWriteItems')
+
+@patch('utils.vehicle_state.aws')
+def test_vehicle_state_store_loads_each_setting_once_in_parallel(mock_aws):
+    """設定の記録は初めて照合するときに一度だけ、設定ごとのQueryを並列に実行して読み込む"""
+    from utils.vehicle_state import VehicleStateStore
+    table = mock_aws.session_table.return_value.__enter__.return_value
+    table.query.side_effect = lambda **kwargs: {'Items': [{
+        'settingKey': 'feed#a', 'vehicleId': 'v1', 'enteredAt': Decimal(0), 'expiresAt': Decimal(2000000000),
+    }]} if 'feed#a' in str(kwargs['KeyConditionExpression'].get_expression()['values']) else {'Items': []}
+    store = VehicleStateStore(table_name='vehicle-states', ttl_seconds=3600, load_concurrency=4)
+    now = datetime(2024, 5, 13, 12, 0)
+
+    store.load(['feed#a', 'feed#b'])
+    store.load(['feed#a', 'feed#b'])
+    assert table.query.call_count == 2
+    table.scan.assert_not_called()
+    assert list(store.inside('v1', now)) == ['feed#a']
+
+@patch('utils.vehicle_state.aws')
+def test_vehicle_state_store_commits_notified_transitions_in_one_transaction(mock_aws):
+    """遷移は予約するだけで、通知する遷移は手元の状態を条件にしたTransactWriteItemsでまとめて確定させる"""
+    from utils.vehicle_state import VehicleStateStore
+    table = mock_aws.table.return_value
+    client = mock_aws.resource.return_value.meta.client
+    table.query.return_value = {'Items': [{
+        'settingKey': 'feed#a', 'vehicleId': 'v1', 'enteredAt': Decimal(0), 'expiresAt': Decimal(2000000000),
+    }]}
+    store = VehicleStateStore(table_name='vehicle-states', ttl_seconds=3600)
+    now = datetime(2024, 5, 13, 12, 0)
+    store.load(['feed#a'])
+
+    assert store.transition('feed#a', 'v1', False, now) == 'exit'
+    assert store.transition('feed#a', 'v2', True, now) == 'enter'
+    assert store.transition('feed#a', 'v2', True, now) is None
+    table.put_item.assert_not_called()
+    table.delete_item.assert_not_called()
+
+    assert store.commit([('feed#a', 'v1'), ('feed#a', 'v2')]) == set()
+    client.transact_write_items.assert_called_once()
+    items = client.transact_write_items.call_args.kwargs['TransactItems']
+    delete = next(item['Delete'] for item in items if 'Delete' in item)
+    assert delete['ConditionExpression'] == 'enteredAt = :entered'
+    put = next(item['Put'] for item in items if 'Put' in item)
+    assert put['Item']['vehicleId'] == 'v2'
+    assert put['Item']['expiresAt'] == put['Item']['enteredAt'] + 3600
+    assert 'attribute_not_exists' in put['ConditionExpression']
+    assert store.flush() == {'writes': 2, 'conflicts': 0, 'puts': 0, 'deletes': 0}
+    table.batch_writer.assert_not_called()
+
+@patch('utils.vehicle_state.aws')
+def test_vehicle_state_store_flushes_unnotified_transitions_in_batches(mock_aws):
+    """通知しない遷移は確定させず、flush() でBatchWriteItemにまとめて書き込む"""
+    from utils.vehicle_state import VehicleStateStore
+    table = mock_aws.table.return_value
+    batch = table.batch_writer.return_value.__enter__.return_value
+    store = VehicleStateStore(table_name='vehicle-states', ttl_seconds=3600)
+    now = datetime(2024, 5, 13, 12, 0)
+
+    store.transition('feed#a', 'v1', True, now)
+    store.transition('feed#a', 'v2', True, now)
+    assert store.commit([]) == set()
+    assert store.flush() == {'writes': 0, 'conflicts': 0, 'puts': 2, 'deletes': 0}
+    assert sorted(call.kwargs['Item']['vehicleId'] for call in batch.put_item.call_args_list) == ['v1', 'v2']
+    mock_aws.resource.return_value.meta.client.transact_write_items.assert_not_called()
+
+@patch('utils.vehicle_state.aws')
+def test_vehicle_state_store_refresh_reflects_other_containers(mock_aws):
+    """一致した組を読み直し、ほかのコンテナが記録した入場・退出を反映する"""
+    from utils.vehicle_state import VehicleStateStore
+    resource = mock_aws.resource.return_value
+    resource.batch_get_item.return_value = {'Responses': {'vehicle-states': [{
+        'settingKey': 'feed#a', 'vehicleId': 'v1', 'enteredAt': Decimal(0), 'expiresAt': Decimal(2000000000),
+    }]}}
+    store = VehicleStateStore(table_name='vehicle-states', ttl_seconds=3600)
+    now = datetime(2024, 5, 13, 12, 0)
+    store.transition('feed#a', 'v2', True, now)
+
+    store.refresh([('feed#a', 'v1'), ('feed#a', 'v2')])
+    request = resource.batch_get_item.call_args.kwargs['RequestItems']['vehicle-states']
+    assert request['ConsistentRead'] is True
+    assert len(request['Keys']) == 2
+    # ほかのコンテナが入場を通知済みの組は重複して通知せず、退出済みの組は中にいないものとして扱う
+    assert store.transition('feed#a', 'v1', True, now) is None
+    assert store.inside('v2', now) == {}
+
+@patch('utils.vehicle_state.aws')
+def test_vehicle_state_store_does_not_notify_transition_claimed_elsewhere(mock_aws):
+    """条件を満たさなかった遷移は通知せずテーブルの状態を読み直し、同じトランザクションのほかの遷移は再送する"""
+    from utils.vehicle_state import VehicleStateStore
+    resource = mock_aws.resource.return_value
+    resource.meta.client.transact_write_items.side_effect = [
+        _transaction_canceled('ConditionalCheckFailed', 'None'), {}]
+    resource.batch_get_item.return_value = {'Responses': {'vehicle-states': [{
+        'settingKey': 'feed#a', 'vehicleId': 'v1', 'enteredAt': Decimal(1715601000), 'dwellNotified': False,
+        'expiresAt': Decimal(2000000000),
+    }]}}
+    store = VehicleStateStore(table_name='vehicle-states', ttl_seconds=3600)
+    now = datetime(2024, 5, 13, 12, 0)
+
+    assert store.transition('feed#a', 'v1', True, now) == 'enter'
+    assert store.transition('feed#b', 'v1', True, now) == 'enter'
+    with patch('utils.vehicle_state.time.sleep'):
+        assert store.commit([('feed#a', 'v1'), ('feed#b', 'v1')]) == {('feed#a', 'v1')}
+    retried = resource.meta.client.transact_write_items.call_args.kwargs['TransactItems']
+    assert [item['Put']['Item']['settingKey'] for item in retried] == ['feed#b']
+    assert store.inside('v1', now)['feed#a']['enteredAt'] == 1715601000
+    assert store.flush() == {'writes': 1, 'conflicts': 1, 'puts': 0, 'deletes': 0}
+
+def test_process_feed_reads_and_writes_vehicle_states_in_batches(gtfs_feed_mock_vehicle, sample_geojson_point):
+    """状態が変わった車両の組だけを読み直し、照合の途中ではテーブルに1件ずつ書き込まない"""
+    from utils.vehicle_state import VehicleStateStore
+    setting = _delta_setting(target_area=sample_geojson_point)
+    now = datetime(2024, 5, 13, 12, 0)
+    with patch('utils.vehicle_state.aws') as mock_aws, \
+         patch('scheduled_task.vehicle_states', VehicleStateStore(table_name='vehicle-states', ttl_seconds=3600)):
+        resource = mock_aws.resource.return_value
+        resource.batch_get_item.return_value = {'Responses': {}}
+        mock_aws.table.return_value.query.return_value = {'Items': []}
+
+        assert _events(setting, gtfs_feed_mock_vehicle, now) == ['enter']
+        assert _events(setting, gtfs_feed_mock_vehicle, now + timedelta(minutes=1)) == []
+
+        assert resource.batch_get_item.call_count == 1  # 止まったままの車両は読み直さない
+        resource.meta.client.transact_write_items.assert_called_once()
+        mock_aws.table.return_value.put_item.assert_not_called()
+        mock_aws.table.return_value.delete_item.assert_not_called()
+
+######################################################################
+# Webhookの送信レート制限とまとめ送りのテスト
+######################################################################
+
+def test_token_bucket_allows_burst_then_sustained_rate():
+    """バースト分は待たずに送り、それ以降は持続レートの間隔で待つ"""
+    clock = _FakeClock()
+    bucket = TokenBucket(rate=2, burst=2, clock=clock)
+    assert [bucket.reserve() for _ in range(4)] == [0.0, 0.0, 0.5, 1.0]
+    clock.now = 10
+    assert bucket.reserve() == 0.0
+
+def test_host_rate_limiter_is_per_host_with_overrides():
+    """ホストごとに独立したバケットを持ち、ホスト単位で上書きできる"""
+    clock = _FakeClock()
+    limiter = HostRateLimiter(rate=1, burst=1, overrides={'fast.example.com': {'rate': 0}}, clock=clock)
+    assert [limiter.reserve('a.example.com') for _ in range(2)] == [0.0, 1.0]
+    assert limiter.reserve('b.example.com') == 0.0
+    assert [limiter.reserve('fast.example.com') for _ in range(3)] == [0.0, 0.0, 0.0]
+
+def test_webhook_dispatcher_waits_for_rate_limiter():
+    """送信の前にレート制限の待ち時間だけ待つ"""
+    sleep = Mock()
+    limiter = Mock()
+    limiter.reserve.side_effect = [0.0, 0.25]
+    dispatcher = WebhookDispatcher(Mock(return_value=200), max_workers=1, per_host_limit=1, sleep=sleep,
+                                   rate_limiter=limiter)
+    dispatcher.submit('https://hooks.example.com/a', {})
+    dispatcher.submit('https://hooks.example.com/b', {})
+    dispatcher.drain(timeout=5)
+
+    assert [call.args[0] for call in limiter.reserve.call_args_list] == ['hooks.example.com'] * 2
+    sleep.assert_called_once_with(0.25)
+
+def test_webhook_dispatcher_coalesces_batched_hosts():
+    """まとめ送りのホスト宛ての通知は、webhook_urlごとに配列1件のPOSTにまとめる"""
+    send = Mock(return_value=200)
+    dispatcher = WebhookDispatcher(send, max_workers=1, batch_hosts=['batch.example.com'])
+    for i in range(3):
+        dispatcher.submit('https://batch.example.com/hook?user=a', {'n': i})
+    dispatcher.submit('https://batch.example.com/hook?user=b', {'n': 3})
+    dispatcher.submit('https://other.example.com/hook', {'n': 4})
+    send.assert_called_once()  # まとめ送りでない宛先はすぐに送る
+
+    assert dispatcher.flush_batches() == 2
+    results, _ = dispatcher.drain(timeout=5)
+    sent = {call.args[0]: call.args[1] for call in send.call_args_list}
+    assert sent['https://batch.example.com/hook?user=a'] == [{'n': 0}, {'n': 1}, {'n': 2}]
+    assert sent['https://batch.example.com/hook?user=b'] == [{'n': 3}]
+    assert sorted(result['events'] for result in results) == [1, 1, 3]
+
+def test_webhook_dispatcher_retries_batched_post_only_on_429():
+    """まとめ送りは一部を配信済みのことがあるので、5xx・タイムアウトでは再送せず429だけ再送する"""
+    send = Mock(side_effect=[503, 429, 200])
+    dispatcher = WebhookDispatcher(send, max_workers=1, per_host_limit=1, max_attempts=3, sleep=Mock(),
+                                   batch_hosts=['batch.example.com'])
+    dispatcher.submit('https://batch.example.com/hook?user=a', {'n': 0})
+    dispatcher.flush_batches()
+    dispatcher.submit('https://batch.example.com/hook?user=b', {'n': 1})
+    dispatcher.flush_batches()
+    results, _ = dispatcher.drain(timeout=5)
+
+    assert sorted((r['webhook_url'], r['status_code'], r['attempts']) for r in results) == [
+        ('https://batch.example.com/hook?user=a', 503, 1),
+        ('https://batch.example.com/hook?user=b', 200, 2),
+    ]
+
+@patch('requests.Session.post')
+def test_trigger_webhook_posts_batch_as_array(mock_post):
+    """まとめ送りでは配列をPOSTし、クエリパラメータは各要素に追加する"""
+    mock_post.return_value.status_code = 200
+    assert trigger_webhook('https://example.com/webhook?foo=bar', [{'n': 0}, {'n': 1}]) == 200
+
+    args, kwargs = mock_post.call_args
+    assert args[0] == 'https://example.com/webhook'
+    assert kwargs['json'] == [{'n': 0, 'foo': 'bar'}, {'n': 1, 'foo': 'bar'}]
+
+######################################################################
+# 設定のシャーディングとコーディネーター／ワーカー実行のテスト
+######################################################################
+
+def _shard_setting(setting_id, trip_id='trip123'):
+    return {'gtfsRtEndpoint': 'https://example.com/gtfs-rt-endpoint', 'userEmail': f'{setting_id}@example.com',
+            'id': setting_id, 'webhook_url': f'https://example.com/webhook/{setting_id}',
+            'filters': {'trip_id': trip_id}}
+
+def _echo_worker(unit, context):
+    return {'node': unit['node'], 'pid': os.getpid()}
+
+def test_hash_ring_moves_only_keys_of_added_node():
+    """ワーカーを追加しても、追加したワーカーに移る設定以外の割り当ては変わらない"""
+    keys = [f'setting-{i}' for i in range(2000)]
+    before = HashRing(['w0', 'w1', 'w2'])
+    after = HashRing(['w0', 'w1', 'w2', 'w3'])
+    moved = [key for key in keys if before.node_for(key) != after.node_for(key)]
+    assert all(after.node_for(key) == 'w3' for key in moved)
+    assert 0 < len(moved) < len(keys) / 2
+    assert all(len(part) > 300 for part in before.partition(keys, key=lambda key: key).values())
+
+def test_feed_snapshot_round_trip(tmp_path):
+    """スナップショットは本文のダイジェストで保存し、参照から読み戻せる"""
+    ref = put_feed_snapshot(b'feed-bytes', bucket='', directory=str(tmp_path))
+    assert put_feed_snapshot(b'feed-bytes', bucket='', directory=str(tmp_path)) == ref
+    assert get_feed_snapshot(ref) == b'feed-bytes'
+
+def test_settings_snapshot_round_trip(tmp_path):
+    """設定のスナップショットはDecimalや入れ子の値もそのまま読み戻せる"""
+    settings = [dict(_shard_setting('a'), filters={'radius': Decimal('500.5'), 'days': ['mon']}, allow=True)]
+    ref = put_settings_snapshot(settings, bucket='', directory=str(tmp_path))
+    assert ref.endswith('.json')
+    assert get_settings_snapshot(ref) == settings
+
+@patch('utils.sharding.aws')
+def test_feed_snapshot_in_s3(mock_aws):
+    """SCHEDULER_SNAPSHOT_BUCKETを指定するとS3に保存する"""
+    ref = put_feed_snapshot(b'feed-bytes', bucket='snapshots-bucket')
+    assert ref.startswith('s3://snapshots-bucket/snapshots/')
+    put_kwargs = mock_aws.client.return_value.put_object.call_args.kwargs
+    assert put_kwargs['Bucket'] == 'snapshots-bucket' and put_kwargs['Body'] == b'feed-bytes'
+
+    get_feed_snapshot(ref)
+    mock_aws.client.return_value.get_object.assert_called_once_with(Bucket='snapshots-bucket', Key=put_kwargs['Key'])
+
+@patch('scheduled_task.fetch_feeds')
+def test_coordinator_sends_feed_only_to_workers_with_settings(mock_fetch, gtfs_feed_mock_vehicle, tmp_path, monkeypatch):
+    """フィードは1回だけ取得し、そのフィードの設定を担当するワーカーにだけスナップショットを渡す"""
+    monkeypatch.setenv('SCHEDULER_SNAPSHOT_DIR', str(tmp_path))
+    mock_fetch.return_value = iter([('https://example.com/gtfs-rt-endpoint', _complete_feed(gtfs_feed_mock_vehicle))])
+    ring = HashRing(['w0', 'w1', 'w2'])
+    settings = [_shard_setting('a'), _shard_setting('b')]
+    backend = Mock()
+
+    coordinate_tick(settings, datetime(2024, 5, 13, 12, 0), ['w0', 'w1', 'w2'], backend)
+
+    mock_fetch.assert_called_once_with(['https://example.com/gtfs-rt-endpoint'])
+    units = backend.dispatch.call_args.args[0]
+    assert {unit['node'] for unit in units} == {ring.node_for('a'), ring.node_for('b')}
+    for unit in units:
+        assert unit['nodes'] == ['w0', 'w1', 'w2']
+        assert unit['now'] == '2024-05-13T12:00:00'
+        snapshot = get_feed_snapshot(unit['feeds'][0]['snapshot'])
+        assert snapshot == gtfs_feed_mock_vehicle.SerializeToString()
+
+def test_coordinator_without_settings_dispatches_nothing():
+    """設定が1件もなければ、フィードを取得せず作業も割り振らない"""
+    from scheduled_task import fetch_feeds
+    backend = Mock()
+    assert coordinate_tick([], datetime(2024, 5, 13, 12, 0), ['w0', 'w1'], backend) == []
+    backend.dispatch.assert_not_called()
+    assert list(fetch_feeds([])) == []
+
+@patch('scheduled_task.get_table')
+@patch('scheduled_task.load_all_settings')
+@patch('scheduled_task.trigger_webhook')
+def test_worker_processes_only_its_settings(mock_webhook, mock_load_all, mock_table, gtfs_feed_mock_vehicle, tmp_path):
+    """ワーカーは設定一覧のうち、自分に割り当てられた設定だけを照合する"""
+    mock_table.return_value.get_item.return_value = {}
+    mock_webhook.return_value = 200
+    settings = [_shard_setting(f'setting-{i}') for i in range(10)]
+    mock_load_all.return_value = settings
+    ring = HashRing(['w0', 'w1'])
+    mine = [setting for setting in settings if ring.node_for(setting['id']) == 'w0']
+    snapshot = put_feed_snapshot(_complete_feed(gtfs_feed_mock_vehicle).SerializeToString(), bucket='', directory=str(tmp_path))
+
+    result = worker_task({
+        'node': 'w0', 'nodes': ['w0', 'w1'], 'now': '2024-05-13T12:00:00',
+        'feeds': [{'gtfs_rt_endpoint': 'https://example.com/gtfs-rt-endpoint', 'snapshot': snapshot}],
+    }, None)
+
+    assert result == {'node': 'w0', 'settings': len(mine), 'feeds': 1}
+    assert sorted(call.args[0] for call in mock_webhook.call_args_list) == sorted(
+        setting['webhook_url'] for setting in mine)
+
+@patch('scheduled_task.get_table')
+@patch('scheduled_task.load_all_settings')
+@patch('scheduled_task.trigger_webhook')
+def test_worker_loads_only_settings_in_its_unit(mock_webhook, mock_load_all, mock_table, gtfs_feed_mock_vehicle,
+                                                tmp_path, monkeypatch):
+    """コーディネーターが担当分の設定を作業単位に入れ、ワーカーは設定テーブルを読まずにそれだけを照合する"""
+    monkeypatch.setenv('SCHEDULER_SNAPSHOT_DIR', str(tmp_path))
+    mock_webhook.return_value = 200
+    settings = [_shard_setting(f'setting-{i}') for i in range(10)]
+    mine = [setting for setting in settings if HashRing(['w0', 'w1']).node_for(setting['id']) == 'w0']
+    backend = Mock()
+    with patch('scheduled_task.fetch_feeds', return_value=iter([
+            ('https://example.com/gtfs-rt-endpoint', _complete_feed(gtfs_feed_mock_vehicle))])):
+        coordinate_tick(settings, datetime(2024, 5, 13, 12, 0), ['w0', 'w1'], backend)
+    unit = next(unit for unit in backend.dispatch.call_args.args[0] if unit['node'] == 'w0')
+    assert get_settings_snapshot(unit['settings']) == mine
+
+    with patch('scheduled_task.get_settings_snapshot', wraps=get_settings_snapshot) as mock_snapshot:
+        result = worker_task(unit, None)
+        worker_task(unit, None)
+
+    assert result == {'node': 'w0', 'settings': len(mine), 'feeds': 1}
+    mock_load_all.assert_not_called()
+    mock_snapshot.assert_called_once()  # 同じ参照なら読み直さない
+    assert sorted(call.args[0] for call in mock_webhook.call_args_list) == sorted(
+        setting['webhook_url'] for setting in mine)
+
+def test_local_backend_pins_each_node_to_one_process():
+    """ローカルのバックエンドは、同じノードの作業を常に同じプロセスで処理する"""
+    backend = LocalProcessBackend(_echo_worker, timeout=30)
+    try:
+        first = backend.dispatch([{'node': 'w0'}, {'node': 'w1'}])
+        second = backend.dispatch([{'node': 'w0'}, {'node': 'w1'}])
+    finally:
+        backend.shutdown()
+    assert [result['node'] for result in first] == ['w0', 'w1']
+    assert first == second
+    assert first[0]['pid'] != first[1]['pid'] != os.getpid()
+
+def test_lambda_backend_invokes_worker_function_asynchronously():
+    """Lambdaのバックエンドは、ノード名の関数を非同期で呼び出す"""
+    client = Mock()
+    client.invoke.return_value = {'StatusCode': 202}
+    unit = {'node': 'worker-fn-0', 'nodes': ['worker-fn-0'], 'now': '2024-05-13T12:00:00', 'feeds': []}
+
+    assert LambdaInvokeBackend(client=client).dispatch([unit]) == [{'node': 'worker-fn-0', 'status_code': 202}]
+    kwargs = client.invoke.call_args.kwargs
+    assert kwargs['FunctionName'] == 'worker-fn-0'
+    assert kwargs['InvocationType'] == 'Event'
+    assert json.loads(kwargs['Payload']) == unit
+
+######################################################################
+# ベンチマーク用の合成データのテスト
+######################################################################
+
+def test_synthetic_data_is_deterministic_and_matchable():
+    """同じseedからは同じデータができ、生成した設定は照合に使える（時間帯・曜日の設定も有効）"""
+    now = datetime(2024, 5, 13, 12, 0)
+    stops = make_stops(20, seed=1)
+    feed = make_feed(50, 10, stops=stops, seed=1)
+    assert feed.SerializeToString() == make_feed(50, 10, stops=stops, seed=1).SerializeToString()
+    settings = make_settings(200, 10, stops=stops, seed=1, now=now)
+    assert settings == make_settings(200, 10, stops=stops, seed=1, now=now)
+
+    with patch('scheduled_task.get_stop_name', side_effect=lambda stop_id, endpoint: stops[stop_id]):
+        plans = [compile_setting(setting['filters'], None) for setting in settings]
+    assert all(plan.is_active(now) and not plan.never for plan in plans)
+    assert any(plan.matches(entity.vehicle) for plan in plans for entity in feed.entity)
+
+def test_benchmark_compare_reports_regressions_over_threshold():
+    """ベースラインからthreshold以上遅くなった項目だけを回帰とする"""
+    baseline = {'results': {'tick': {'vehicles_per_second': 1000}, 'check_conditions': {'vehicles_per_second': 1000}}}
+    report = {'results': {'tick': {'vehicles_per_second': 700}, 'check_conditions': {'vehicles_per_second': 800}}}
+    assert compare(report, baseline, 0.25) == [{'name': 'tick', 'baseline': 1000, 'actual': 700, 'ratio': 0.7}]
+
+######################################################################
+# ティックのメトリクス（EMF）のテスト
+######################################################################
+
+def test_tick_metrics_builds_emf_record_with_feed_breakdown():
+    """フェーズの所要時間とカウンターをEMFのメトリクスにし、フィードごとの内訳をプロパティに入れる"""
+    clock = _FakeClock()
+    metrics = TickMetrics(namespace='Test', service='scheduler', clock=clock)
+    with metrics.timer('fetch', feed='a'):
+        clock.now += 0.25
+    metrics.count('bytes_fetched', 1024, feed='a')
+    metrics.count('webhooks_sent', 2)
+
+    record = metrics.record(timestamp=1715601600)
+    assert record['fetch_ms'] == 250.0
+    assert record['bytes_fetched'] == 1024
+    assert record['webhooks_sent'] == 2
+    assert record['feeds'] == {'a': {'fetch_ms': 250.0, 'bytes_fetched': 1024}}
+    assert record['Service'] == 'scheduler'
+    definition = record['_aws']['CloudWatchMetrics'][0]
+    assert record['_aws']['Timestamp'] == 1715601600000
+    assert definition['Namespace'] == 'Test'
+    assert definition['Dimensions'] == [['Service']]
+    assert {'Name': 'bytes_fetched', 'Unit': 'Bytes'} in definition['Metrics']
+    assert {'Name': 'fetch_ms', 'Unit': 'Milliseconds'} in definition['Metrics']
+
+@patch('scheduled_task.get_table')
+@patch('scheduled_task.load_all_settings')
+@patch('scheduled_task.fetch_feeds')
+@patch('scheduled_task.trigger_webhook', return_value=200)
+def test_scheduled_task_emits_one_metrics_record_per_tick(mock_webhook, mock_fetch, mock_load_all, mock_table,
+                                                          gtfs_feed_mock_vehicle, capsys):
+    """1ティックにつき1件のEMFレコードを出力し、照合と配信の件数が入る"""
+    mock_table.return_value.get_item.return_value = {}
+    mock_load_all.return_value = [_shard_setting('a'), _shard_setting('b', trip_id='trip999')]
+    mock_fetch.return_value = iter([('https://example.com/gtfs-rt-endpoint', gtfs_feed_mock_vehicle)])
+
+    scheduled_task({}, None)
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if '"_aws"' in line]
+    assert len(records) == 1
+    record = records[0]
+    assert record['settings'] == 2
+    assert record['vehicles'] == 1
+    assert record['matches'] == 1
+    assert record['notifications'] == 1
+    assert record['webhooks_sent'] == 1
+    assert record['webhooks_failed'] == 0
+    assert {'settings_ms', 'match_ms', 'writes_ms', 'dispatch_ms'} <= set(record)
+    assert record['feeds']['https://example.com/gtfs-rt-endpoint']['vehicles'] == 1
+
+######################################################################
+# ログ出力のテスト
+######################################################################
+
+class _Unprintable:
+    def __str__(self):
+        raise AssertionError('formatted below the log level')
+
+def test_logger_skips_formatting_below_level():
+    """ログレベル未満のメッセージは引数を文字列にしない"""
+    stream = io.StringIO()
+    logger = Logger(level='INFO', stream=stream)
+    logger.debug("Vehicle: %s", _Unprintable())
+    logger.info("Fetched %d settings", 3)
+    assert stream.getvalue() == '[INFO] Fetched 3 settings\n'
+
+def test_logger_rate_limits_each_message_and_reports_in_summary():
+    """同じメッセージは窓ごとに上限件数まで出し、抑止した件数を集計の1行に出す"""
+    stream = io.StringIO()
+    clock = _FakeClock()
+    logger = Logger(level='INFO', max_per_key=2, window_seconds=60, stream=stream, clock=clock)
+    for i in range(5):
+        logger.warning("Webhook delivery failed: %s", i)
+    logger.error("Error fetching GTFS-RT data: %s", 'timeout')
+    clock.now = 60
+    logger.warning("Webhook delivery failed: %s", 5)
+
+    assert logger.summary() == {'lines': {'WARNING': 3, 'ERROR': 1}, 'suppressed': {'Webhook delivery failed: %s': 3}}
+    lines = stream.getvalue().splitlines()
+    assert lines[:2] == ['[WARNING] Webhook delivery failed: 0', '[WARNING] Webhook delivery failed: 1']
+    assert lines[3] == '[WARNING] Webhook delivery failed: 5'
+    assert lines[4].startswith('[INFO] Log summary:')
+    assert logger.summary()['suppressed'] == {}
+
+def test_logger_json_format():
+    """LOG_FORMAT=jsonでは1行1件のJSONで出力する"""
+    stream = io.StringIO()
+    Logger(level=DEBUG, fmt='json', stream=stream).debug("Evaluated %d vehicles", 10, feed='a')
+    assert json.loads(stream.getvalue()) == {'level': 'DEBUG', 'message': 'Evaluated 10 vehicles', 'feed': 'a'}
+
+def test_matching_loop_logs_nothing_at_default_level(gtfs_feed_mock_vehicle, capsys):
+    """デフォルトのログレベルでは、車両と設定の照合・通知のキューイングでログを出さない"""
+    with patch('scheduled_task.logger', Logger(level='INFO')):
+        assert _process(_delta_setting(trip_id='trip123'), gtfs_feed_mock_vehicle, datetime(2024, 5, 13, 12, 0)) == 1
+        assert _process(_delta_setting(trip_id='trip999'), gtfs_feed_mock_vehicle, datetime(2024, 5, 13, 12, 1)) == 0
+    assert capsys.readouterr().out == ''
+
+######################################################################
+# プロファイリングのテスト
+######################################################################
+
+def _busy(seconds):
+    deadline = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < deadline:
+        total += sum(range(100))
+    return total
+
+def test_profiling_modes_from_event_and_sampling():
+    """イベントの指定が優先し、環境変数の指定はN回に1回だけ有効になる"""
+    assert profiling_modes({'profile': True}) == {'cpu', 'stacks', 'memory'}
+    assert profiling_modes({'profile': 'cpu, memory'}) == {'cpu', 'memory'}
+    assert profiling_modes({'profile': False}) == frozenset()
+    assert profiling_modes({}) == frozenset()
+    with patch.dict(os.environ, {'PROFILE_MODES': 'stacks', 'PROFILE_SAMPLE_EVERY': '10'}):
+        assert profiling_modes({}, rng=lambda: 0.05) == {'stacks'}
+        assert profiling_modes({}, rng=lambda: 0.5) == frozenset()
+
+def test_profile_writes_pstats_stacks_and_allocations(tmp_path):
+    """cProfileの統計・折りたたみスタック・確保の多い行を出力先に書き込む"""
+    with patch.dict(os.environ, {'PROFILE_SAMPLE_INTERVAL_MS': '1'}):
+        with profile('tick', {'cpu', 'stacks', 'memory'}, sink=ProfileSink(str(tmp_path))) as outputs:
+            _busy(0.05)
+            data = [bytearray(1024) for _ in range(100)]
+
+    assert set(outputs) == {'pstats', 'pstats_raw', 'stacks', 'allocations'}
+    assert '_busy' in open(outputs['pstats']).read()
+    assert 'test_handler.py:_busy' in open(outputs['stacks']).read()
+    assert open(outputs['allocations']).read().startswith('peak traced memory:')
+    assert any(func[2] == '_busy' for func in pstats.Stats(outputs['pstats_raw']).stats)
+    assert len(data) == 100
+
+def test_profile_without_modes_does_nothing(tmp_path):
+    with profile('tick', frozenset(), sink=ProfileSink(str(tmp_path))) as outputs:
+        pass
+    assert outputs == {}
+    assert list(tmp_path.iterdir()) == []
+
+@patch('scheduled_task.run_scheduled_task')
+def test_scheduled_task_profiles_when_event_requests_it(mock_run, tmp_path):
+    """EventBridgeの入力の profile で、その実行だけプロファイルを取る"""
+    with patch.dict(os.environ, {'PROFILE_SINK': str(tmp_path)}):
+        scheduled_task({'profile': 'cpu'}, None)
+    mock_run.assert_called_once_with({'profile': 'cpu'}, None)
+    assert [path.suffix for path in sorted(tmp_path.iterdir())] == ['.pstats', '.txt']
+
+######################################################################
+# boto3・firebase_admin の遅延import
+######################################################################
+
+def test_aws_table_is_created_once_per_container():
+    """テーブルとリソースはコンテナ内で1度だけ作り、以降は使い回す"""
+    with patch('boto3.resource') as mock_resource:
+        assert aws.table('settings') is aws.table('settings')
+        aws.table('other')
+    mock_resource.assert_called_once_with('dynamodb')
+    assert mock_resource.return_value.Table.call_count == 2
+
+def test_session_table_is_reused_across_parallel_scans():
+    """並列スキャン用のテーブルは返却後に使い回し、同時に借りたスレッドには別のテーブルを貸す"""
+    with patch('boto3.session.Session') as mock_session:
+        mock_session.return_value.resource.return_value.Table.side_effect = lambda name: MagicMock()
+        with aws.session_table('settings') as first, aws.session_table('settings') as second:
+            assert first is not second
+        with aws.session_table('settings') as again:
+            assert again in (first, second)
+    assert mock_session.call_count == 2
+
+def test_handlers_do_not_import_optional_dependencies_at_import_time():
+    """boto3・NumPy・firebase_admin・GTFS-RTのprotobufは、使うときまでimportしない"""
+    code = (
+        'import sys, handler, delete_alert, mattermost_handler, scheduled_task\n'
+        "print(sorted(m for m in ('boto3', 'numpy', 'firebase_admin', 'google.transit.gtfs_realtime_pb2') if m in sys.modules))\n"
+    )
+    completed = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                               env={**os.environ, 'AWS_DEFAULT_REGION': 'ap-northeast-1'},
+                               capture_output=True, text=True, check=True)
+    assert completed.stdout.strip() == '[]'
+
+######################################################################
+# mattermost_handler のFCMのまとめ送り
+######################################################################
+
+MATTERMOST_ENV = {
+    'MATTERMOST_WEBHOOK_URL': 'https://example.com/mattermost',
+    'SMTP_HOST': 'smtp.example.com',
+    'SMTP_USER': 'user',
+    'SMTP_PASSWORD': 'password',
+}
+
+@pytest.fixture(autouse=True)
+def reset_mail_senders():
+    """コンテナ内で使い回すSMTPの接続を、テストごとに作り直す"""
+    mail.reset_senders()
+    yield
+    mail.reset_senders()
+
+@pytest.fixture
+def firebase():
+    """firebase_admin の代わりのモック（アプリの初期化状態もテストごとに戻す）"""
+    firebase_admin = MagicMock()
+    firebase_admin._apps = {}
+    with patch.dict(sys.modules, {'firebase_admin': firebase_admin}), \
+            patch('mattermost_handler._firebase_app', None):
+        yield firebase_admin
+
+def _multicast_response(*successes):
+    return MagicMock(responses=[
+        MagicMock(success=True, message_id=f'id-{i}') if success else MagicMock(success=False, exception='Unregistered')
+        for i, success in enumerate(successes)
+    ])
+
+def test_initialize_app_once_per_container(firebase):
+    """証明書の読み込みとアプリの初期化は1度だけ"""
+    app = mattermost_handler.initialize_app('./firebase.json')
+    assert mattermost_handler.initialize_app('./firebase.json') is app
+    firebase.credentials.Certificate.assert_called_once_with('./firebase.json')
+    firebase.initialize_app.assert_called_once()
+
+@patch.dict(os.environ, MATTERMOST_ENV)
+@patch('mattermost_handler.post_to_mattermost')
+@patch('mattermost_handler.send_emails', return_value=[{'email': 'user@example.com', 'success': True}])
+def test_mattermost_handler_batch_sends_multicast_per_alert(mock_send_emails, mock_post, firebase):
+    """まとめ送りの配列は、同じ通知のトークンを1回のマルチキャストで送り、トークンごとの結果を返す"""
+    messaging = firebase.messaging
+    messaging.send_each_for_multicast.return_value = _multicast_response(True, False)
+    alarm = {'details': {'label': '到着', 'describe': 'まもなく到着します'}}
+    body = [
+        {'fcm': '{token-a}', 'alarm_settings': alarm},
+        {'fcm': '{token-b}', 'alarm_settings': alarm},
+        {'email': 'user@example.com', 'alarm_settings': alarm},
+    ]
+
+    response = mattermost_handler.handler({'body': json.dumps(body)}, None)
+
+    assert response['statusCode'] == 200
+    results = json.loads(response['body'])['results']
+    assert results == [
+        {'email': 'user@example.com', 'success': True},
+        {'fcm': 'token-a', 'success': True, 'message_id': 'id-0'},
+        {'fcm': 'token-b', 'success': False, 'error': 'Unregistered'},
+    ]
+    messaging.send_each_for_multicast.assert_called_once()
+    messaging.MulticastMessage.assert_called_once_with(
+        data={'title': '到着', 'body': 'まもなく到着します'}, tokens=['token-a', 'token-b'])
+    firebase.initialize_app.assert_called_once()
+    mock_send_emails.assert_called_once()
+    mock_post.assert_called_once()
+
+@patch.dict(os.environ, MATTERMOST_ENV)
+@patch('mattermost_handler.post_to_mattermost')
+def test_mattermost_handler_batch_sends_emails_over_one_session(mock_post):
+    """まとめ送りのメールは1つのSMTPセッションで送り、1件の失敗で残りを止めない"""
+    server = MagicMock()
+    server.sendmail.side_effect = [smtplib.SMTPRecipientsRefused({'a@example.com': (550, b'No such user')}), {}]
+    body = [{'email': 'a@example.com'}, {'email': 'b@example.com'}]
+    with patch('smtplib.SMTP', return_value=server) as mock_smtp:
+        response = mattermost_handler.handler({'body': json.dumps(body)}, None)
+
+    assert response['statusCode'] == 200
+    assert [result['success'] for result in json.loads(response['body'])['results']] == [False, True]
+    mock_smtp.assert_called_once()
+    server.login.assert_called_once_with('user', 'password')
+    assert server.sendmail.call_count == 2
+
+@patch.dict(os.environ, MATTERMOST_ENV)
+@patch('mattermost_handler.post_to_mattermost', side_effect=RuntimeError('mattermost down'))
+@patch('mattermost_handler.send_emails', return_value=[{'email': 'user@example.com', 'success': True}])
+def test_mattermost_handler_batch_reports_failures_after_emails_sent(mock_send_emails, mock_post, firebase):
+    """まとめ送りでメールを送った後にFCM・MatterMostが失敗しても、再送されないよう結果付きの200を返す"""
+    firebase.messaging.send_each_for_multicast.side_effect = RuntimeError('fcm unavailable')
+    body = [{'email': 'user@example.com'}, {'fcm': '{token-a}'}]
+
+    response = mattermost_handler.handler({'body': json.dumps(body)}, None)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['results'] == [
+        {'email': 'user@example.com', 'success': True},
+        {'fcm': 'token-a', 'success': False, 'error': 'fcm unavailable'},
+    ]
+    mock_send_emails.assert_called_once()
+
+@patch.dict(os.environ, MATTERMOST_ENV)
+@patch('mattermost_handler.post_to_mattermost')
+@patch('mattermost_handler.send_emails', return_value=[{'email': 'user@example.com', 'success': True}])
+def test_mattermost_handler_batch_skips_invalid_items(mock_send_emails, mock_post):
+    """まとめ送りの不正な通知（@のないメールアドレスなど）はその通知だけ失敗にし、残りは送る"""
+    body = [{'email': 'no-at-sign'}, 'not-an-object', {'email': 'user@example.com@device'}]
+
+    response = mattermost_handler.handler({'body': json.dumps(body)}, None)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['results'] == [
+        {'email': 'no-at-sign', 'success': False, 'error': "Invalid email: 'no-at-sign'"},
+        {'success': False, 'error': "'str' object has no attribute 'get'"},
+        {'email': 'user@example.com', 'success': True},
+    ]
+    assert [message[0] for message in mock_send_emails.call_args.args[4]] == ['user@example.com']
+
+def test_send_multicast_splits_tokens_over_limit(firebase):
+    """1度に送れるトークンの上限ごとに分けて送る"""
+    firebase.messaging.send_each_for_multicast.side_effect = lambda message: _multicast_response(
+        *[True] * len(firebase.messaging.MulticastMessage.call_args.kwargs['tokens']))
+    tokens = [f'token-{i}' for i in range(mattermost_handler.FCM_MULTICAST_LIMIT + 1)]
+
+    results = mattermost_handler.send_multicast(tokens, 'title', 'body')
+
+    assert [result['fcm'] for result in results] == tokens
+    assert firebase.messaging.send_each_for_multicast.call_count == 2
+
+######################################################################
+# SMTP接続の使い回し
+######################################################################
+
+def _smtp_sender(servers, clock=lambda: 0.0, idle_timeout=60):
+    factory = MagicMock(side_effect=servers)
+    sender = mail.SmtpSender('smtp.example.com', 587, 'user', 'password', sender='from@example.com',
+                             idle_timeout=idle_timeout, smtp_factory=factory, clock=clock)
+    return sender, factory
+
+def test_smtp_sender_reuses_authenticated_connection():
+    """STARTTLS・ログインは最初の1度だけで、2通目以降は同じ接続で送る"""
+    server = MagicMock()
+    sender, factory = _smtp_sender([server])
+    sender.send('a@example.com', 'subject', 'body')
+    sender.send('b@example.com', 'subject', 'body')
+
+    factory.assert_called_once_with('smtp.example.com', 587, timeout=10.0)
+    server.starttls.assert_called_once()
+    server.login.assert_called_once_with('user', 'password')
+    assert [c.args[1] for c in server.sendmail.call_args_list] == ['a@example.com', 'b@example.com']
+
+def test_smtp_sender_reconnects_when_connection_was_dropped():
+    """サーバーに切られていた接続では、接続し直して1度だけ再送する"""
+    stale, fresh = MagicMock(), MagicMock()
+    stale.sendmail.side_effect = smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+    sender, factory = _smtp_sender([stale, fresh])
+    sender.send('a@example.com', 'subject', 'body')
+
+    assert factory.call_count == 2
+    fresh.sendmail.assert_called_once()
+
+def test_smtp_sender_reconnects_after_idle_timeout():
+    """しばらく使っていない接続は、送信前に閉じて接続し直す"""
+    now = [0.0]
+    first, second = MagicMock(), MagicMock()
+    sender, factory = _smtp_sender([first, second], clock=lambda: now[0], idle_timeout=60)
+    sender.send('a@example.com', 'subject', 'body')
+    now[0] = 61.0
+    sender.send('b@example.com', 'subject', 'body')
+
+    first.quit.assert_called_once()
+    second.sendmail.assert_called_once()
+
+def test_smtp_sender_send_raises_and_drops_broken_connection():
+    """再送しても送れなかった場合は例外を送出し、その接続は次の送信で使わない"""
+    servers = [MagicMock() for _ in range(3)]
+    for server in servers[:2]:
+        server.sendmail.side_effect = smtplib.SMTPServerDisconnected('closed')
+    sender, factory = _smtp_sender(servers)
+    with pytest.raises(smtplib.SMTPServerDisconnected):
+        sender.send('a@example.com', 'subject', 'body')
+    sender.send('a@example.com', 'subject', 'body')
+
+    assert factory.call_count == 3
+    servers[2].sendmail.assert_called_once()
@@ -0,0 +1,78 @@
+import os
+import threading
+from contextlib import contextmanager
+
+# コンテナ（ウォームスタートしたLambda間）で使い回すboto3のクライアント・リソース・テーブル
+# boto3はサービス定義の読み込みに時間がかかるので、初めて使うときにだけimportして作る
+_cache = {}
+_lock = threading.RLock()  # table() の作成中に resource() を取りに行くので再入可能にする
+_idle_tables = {}  # テーブル名 -> session_table() で作り、いまは使われていないテーブル
+
+
+def _cached(key, create):
+    value = _cache.get(key)
+    if value is None:
+        with _lock:
+            value = _cache.get(key)
+            if value is None:
+                value = _cache[key] = create()
+    return value
+
+
+def client(service_name):
+    """boto3のクライアント（スレッド間で共有できる）"""
+    def create():
+        import boto3
+        return boto3.client(service_name)
+    return _cached(('client', service_name), create)
+
+
+def resource(service_name):
+    """
+    boto3のリソース。リソースはスレッドセーフではないので、
+    別スレッドで使う場合は boto3.session.Session() から作る。
+    """
+    def create():
+        import boto3
+        return boto3.resource(service_name)
+    return _cached(('resource', service_name), create)
+
+
+def table(table_name):
+    """DynamoDBのテーブル"""
+    return _cached(('table', table_name), lambda: resource('dynamodb').Table(table_name))
+
+
+@contextmanager
+def session_table(table_name):
+    """
+    別スレッドで使うDynamoDBのテーブル（セッションごとのリソースから作る）を借りる。
+    セッションの作成は重いので、返されたテーブルはプールに戻し、次の並列処理で使い回す。
+    同じテーブルを同時に2つのスレッドに貸すことはない。
+    """
+    with _lock:
+        idle = _idle_tables.get(table_name)
+        table = idle.pop() if idle else None
+    if table is None:
+        import boto3
+        table = boto3.session.Session().resource('dynamodb').Table(table_name)
+    try:
+        yield table
+    finally:
+        with _lock:
+            _idle_tables.setdefault(table_name, []).append(table)
+
+
+def _clear():
+    _cache.clear()
+    _idle_tables.clear()
+
+
+def clear():
+    """キャッシュを捨てる"""
+    with _lock:
+        _clear()
+
+
+# fork したワーカーのプロセスでは、親の接続プールを共有しないよう作り直す
+os.register_at_fork(after_in_child=_clear)
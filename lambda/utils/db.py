@@ -1,20 +1,218 @@
 import os
-import boto3
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import aws
+from utils.log import logger
+
+# 設定の変更履歴テーブル（partition / sequence）のキー。設定テーブルのスキャンに混ざらないよう別テーブルに置く
+SETTINGS_VERSION_PARTITION = 'version'
+SETTINGS_CHANGES_PARTITION = 'changes'
+SETTINGS_VERSION_KEY = {'partition': SETTINGS_VERSION_PARTITION, 'sequence': SETTINGS_VERSION_PARTITION}
 
 def get_table():
-    """Get DynamoDB table instance"""
-    dynamodb = boto3.resource('dynamodb')
-    return dynamodb.Table(os.getenv('SETTINGS_TABLE_NAME'))
+    """Get DynamoDB table instance（コンテナ内で使い回す）"""
+    return aws.table(os.getenv('SETTINGS_TABLE_NAME'))
+
+def get_changes_table():
+    """設定の変更履歴テーブル。SETTINGS_CHANGES_TABLE_NAME が未設定ならNone"""
+    name = os.getenv('SETTINGS_CHANGES_TABLE_NAME')
+    return aws.table(name) if name else None
+
+def user_email_key(user_email):
+    """UserEmailIndexのキー（波括弧を外し、最後の@以降を除いたメールアドレス）"""
+    user_email = user_email.replace('{', '').replace('}', '')
+    return '@'.join(user_email.split('@')[:-1])
+
+def with_user_email_key(item):
+    """userEmailKeyを付けたアイテムを返す（空文字はGSIのキーにできないので付けない）"""
+    key = user_email_key(item['userEmail'])
+    if not key:
+        return item
+    return dict(item, userEmailKey=key)
+
+def key_condition(name):
+    """KeyConditionExpressionの条件（boto3.dynamodb.conditions はクエリするときに初めてimportする）"""
+    from boto3.dynamodb.conditions import Key
+    return Key(name)
+
+def query_items(table, **query_kwargs):
+    """LastEvaluatedKeyをたどってQueryの全ページのアイテムを返す"""
+    items = []
+    while True:
+        response = table.query(**query_kwargs)
+        items.extend(response.get('Items', []))
+        last_evaluated_key = response.get('LastEvaluatedKey')
+        if not last_evaluated_key:
+            return items
+        query_kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+def _projection_kwargs(attributes):
+    """ProjectionExpressionの引数を作る（予約語と衝突しないよう属性名はプレースホルダーにする）"""
+    if not attributes:
+        return {}
+    names = {f'#a{i}': attribute for i, attribute in enumerate(attributes)}
+    return {
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names,
+    }
+
+def _segment_table():
+    """並列スキャンのワーカー用のテーブルを借りる（boto3のリソースはスレッド間で共有しない）"""
+    return aws.session_table(os.getenv('SETTINGS_TABLE_NAME'))
+
+def _scan_pages(table, scan_kwargs):
+    """LastEvaluatedKeyをたどって全ページのアイテムを返す"""
+    kwargs = dict(scan_kwargs)
+    while True:
+        response = table.scan(**kwargs)
+        yield response.get('Items', [])
+        last_evaluated_key = response.get('LastEvaluatedKey')
+        if not last_evaluated_key:
+            return
+        kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+def iter_settings(attributes=None, segments=None, page_size=None):
+    """
+    設定テーブルをスキャンしてアイテムを1件ずつ返すジェネレーター。
+    attributes: 取得する属性名のリスト（Noneなら全属性）
+    segments: 並列スキャンのセグメント数（Segment/TotalSegments）。2以上ならスレッドで並列に読む
+    """
+    if segments is None:
+        segments = int(os.getenv('SETTINGS_SCAN_SEGMENTS', 1))
+    scan_kwargs = _projection_kwargs(attributes)
+    if page_size:
+        scan_kwargs['Limit'] = page_size
+
+    if segments <= 1:
+        for items in _scan_pages(get_table(), scan_kwargs):
+            yield from items
+        return
 
-def get_all_settings():
+    # セグメントごとのワーカーが読んだページを、届いた順に返す
+    pages = queue.Queue()
+    done = object()
+
+    def scan_segment(segment):
+        try:
+            with _segment_table() as table:
+                for items in _scan_pages(table, dict(scan_kwargs, Segment=segment, TotalSegments=segments)):
+                    pages.put(items)
+            pages.put(done)
+        except Exception as e:
+            pages.put(e)
+
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        for segment in range(segments):
+            executor.submit(scan_segment, segment)
+        remaining = segments
+        while remaining:
+            page = pages.get()
+            if page is done:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield from page
+
+def get_all_settings(attributes=None, segments=None):
     """DynamoDBからすべての設定を取得する"""
-    print("Fetching all settings from DynamoDB")
+    logger.info("Fetching all settings from DynamoDB")
     try:
-        settings_table = get_table()
-        response = settings_table.scan()
-        items = response.get('Items', [])
-        print(f"Fetched {len(items)} settings")
+        items = list(iter_settings(attributes=attributes, segments=segments))
+        logger.info("Fetched %d settings", len(items))
         return items
     except Exception as e:
-        print(f"Error fetching settings from DynamoDB: {str(e)}")
+        logger.error("Error fetching settings from DynamoDB: %s", e)
         return []
+
+class NotificationWriteBuffer:
+    """
+    lastNotificationTimestamp の更新をティック中に溜めておき、最後にまとめて書き込む。
+    書き込みは設定ごとに1回、タイムスタンプ属性だけを更新するUpdateItemで、
+    ティック開始時の値から変わっていない場合にのみ反映する（APIからの同時編集を上書きしない）。
+    再通知を抑止する期間のある通知は、claim() で送る前にテーブルの値を確かめて書き込む。
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self._pending = {}  # (gtfsRtEndpoint, userEmail) -> (更新前の値, 新しい値)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def record(self, setting, timestamp):
+        """メモリ上の設定を更新し、書き込みを予約する"""
+        key = (setting['gtfsRtEndpoint'], setting['userEmail'])
+        previous = self._pending[key][0] if key in self._pending else setting.get('lastNotificationTimestamp')
+        self._pending[key] = (previous, timestamp)
+        setting['lastNotificationTimestamp'] = timestamp
+
+    def claim(self, setting, timestamp, not_after):
+        """
+        通知を送る前に、テーブル上の lastNotificationTimestamp が not_after より前（または未設定）の場合だけ
+        timestamp を書き込み、この通知を送る権利を得る。
+        キャッシュした設定にはほかのコンテナ（重なったティックやワーカー）の通知時刻が反映されていないので、
+        メモリ上の値だけで判定すると同じ通知を重複して送ってしまう。
+        書き込めたらTrue。ほかで通知済み（または設定が削除済み）ならテーブルの値をメモリ上の設定に反映してFalse。
+        書き込み自体に失敗した場合は通知を止めず、ティックの最後の書き込みに回してTrueを返す。
+        """
+        from botocore.exceptions import ClientError
+
+        key = (setting['gtfsRtEndpoint'], setting['userEmail'])
+        try:
+            self.table.update_item(
+                Key={'gtfsRtEndpoint': key[0], 'userEmail': key[1]},
+                UpdateExpression='SET lastNotificationTimestamp = :ts',
+                ConditionExpression=('attribute_exists(gtfsRtEndpoint) AND '
+                                     '(attribute_not_exists(lastNotificationTimestamp) OR lastNotificationTimestamp < :not_after)'),
+                ExpressionAttributeValues={':ts': timestamp, ':not_after': not_after},
+                ReturnValuesOnConditionCheckFailure='ALL_OLD',
+            )
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                logger.error("Error claiming notification for %s: %s", key[1], e)
+                self.record(setting, timestamp)
+                return True
+            # 失敗時に返るアイテムは型付きの形式（{'S': ...}）
+            current = (e.response.get('Item') or {}).get('lastNotificationTimestamp', {}).get('S')
+            if current:
+                setting['lastNotificationTimestamp'] = current
+            return False
+        setting['lastNotificationTimestamp'] = timestamp
+        # テーブルの値はもう timestamp になっているので、このティックで予約した書き込みは不要
+        self._pending.pop(key, None)
+        return True
+
+    def flush(self):
+        """予約した書き込みを反映し、書き込み件数と消費キャパシティを返す"""
+        from botocore.exceptions import ClientError
+
+        stats = {'writes': 0, 'conflicts': 0, 'errors': 0, 'consumed_capacity': 0.0}
+        pending, self._pending = self._pending, {}
+        for (gtfs_rt_endpoint, user_email), (previous, timestamp) in pending.items():
+            values = {':ts': timestamp}
+            if previous is None:
+                # 削除済みの設定を作り直さないよう、アイテムの存在も条件にする
+                condition = 'attribute_exists(gtfsRtEndpoint) AND attribute_not_exists(lastNotificationTimestamp)'
+            else:
+                condition = 'lastNotificationTimestamp = :previous'
+                values[':previous'] = previous
+            try:
+                response = self.table.update_item(
+                    Key={'gtfsRtEndpoint': gtfs_rt_endpoint, 'userEmail': user_email},
+                    UpdateExpression='SET lastNotificationTimestamp = :ts',
+                    ConditionExpression=condition,
+                    ExpressionAttributeValues=values,
+                    ReturnConsumedCapacity='TOTAL',
+                )
+                stats['writes'] += 1
+                stats['consumed_capacity'] += float(response.get('ConsumedCapacity', {}).get('CapacityUnits', 0))
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                    # ティック中に設定が編集・削除された
+                    stats['conflicts'] += 1
+                else:
+                    logger.error("Error updating lastNotificationTimestamp for %s: %s", user_email, e)
+                    stats['errors'] += 1
+        return stats
@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from utils.log import logger
+from utils.rate_limit import HostRateLimiter
+
+
+def _is_retryable(status_code, batched=False):
+    """
+    送信失敗（例外・タイムアウト）、429、5xxは再送する。
+    まとめ送り（配列のPOST）は一部を配信済みでも5xxやタイムアウトになりうるので、
+    受け付けていないことが明らかな429だけ再送する（配列全体の再送で通知が重複しないように）。
+    """
+    if batched:
+        return status_code == 429
+    if status_code is None:
+        return True
+    return isinstance(status_code, int) and (status_code == 429 or status_code >= 500)
+
+
+def _is_success(status_code):
+    return isinstance(status_code, int) and 200 <= status_code < 300
+
+
+class WebhookDispatcher:
+    """
+    Webhookの送信を照合ループから切り離して、スレッドプールで非同期に配信する。
+    全体の同時送信数に加え、宛先ホストごとの同時送信数にも上限を設ける。
+    ホストの上限に達した送信はホストごとのキューで待たせ、ワーカースレッドを占有しない。
+    さらに送信の頻度をホストごとのトークンバケット（rate_limiter）で制限する。
+    batch_hosts に含まれるホスト（'*'なら全ホスト）宛ての送信は、flush_batches() まで溜めて
+    同じwebhook_urlごとに配列1件のPOSTにまとめる。
+    send(webhook_url, event_data) はHTTPステータスコード（失敗時はNone）を返す関数。
+    event_data はまとめた場合はリストになる。
+    """
+
+    def __init__(self, send, max_workers=None, per_host_limit=None, max_attempts=None, backoff_seconds=None,
+                 sleep=time.sleep, rate_limiter=None, batch_hosts=None):
+        if max_workers is None:
+            max_workers = int(os.getenv('WEBHOOK_CONCURRENCY', 16))
+        if per_host_limit is None:
+            per_host_limit = int(os.getenv('WEBHOOK_PER_HOST_CONCURRENCY', 4))
+        if max_attempts is None:
+            max_attempts = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 3))
+        if backoff_seconds is None:
+            backoff_seconds = float(os.getenv('WEBHOOK_RETRY_BACKOFF_SECONDS', 0.5))
+        if rate_limiter is None:
+            rate_limiter = HostRateLimiter()
+        if batch_hosts is None:
+            batch_hosts = [host.strip() for host in os.getenv('WEBHOOK_BATCH_HOSTS', '').split(',') if host.strip()]
+        self._send = send
+        self._sleep = sleep
+        self._rate_limiter = rate_limiter
+        self.batch_hosts = frozenset(batch_hosts)
+        self._batches = {}  # webhook_url -> まとめて送るevent_dataのリスト
+        self.per_host_limit = max(per_host_limit, 1)
+        self.max_attempts = max(max_attempts, 1)
+        self.backoff_seconds = backoff_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max(max_workers, 1))
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._active = defaultdict(int)  # ホスト -> 送信中の数
+        self._queues = defaultdict(deque)  # ホスト -> 上限待ちの送信
+        self._pending = 0
+        self.results = []
+
+    def _batched(self, host):
+        return '*' in self.batch_hosts or host in self.batch_hosts
+
+    def submit(self, webhook_url, event_data):
+        """送信をキューに積む（すぐに戻る）"""
+        host = urlparse(webhook_url).netloc
+        if self._batched(host):
+            with self._lock:
+                self._batches.setdefault(webhook_url, []).append(event_data)
+            return
+        self._enqueue(host, webhook_url, event_data)
+
+    def flush_batches(self):
+        """まとめ送りの宛先に溜めた送信を、webhook_urlごとに1件の送信として積む"""
+        with self._lock:
+            batches, self._batches = self._batches, {}
+        for webhook_url, events in batches.items():
+            self._enqueue(urlparse(webhook_url).netloc, webhook_url, events)
+        return len(batches)
+
+    def _enqueue(self, host, webhook_url, event_data):
+        with self._lock:
+            self._pending += 1
+            if self._active[host] < self.per_host_limit:
+                self._active[host] += 1
+                self._executor.submit(self._run, host, webhook_url, event_data)
+            else:
+                self._queues[host].append((webhook_url, event_data))
+
+    def _deliver(self, host, webhook_url, event_data):
+        started = time.monotonic()
+        status_code = None
+        attempts = 0
+        while attempts < self.max_attempts:
+            attempts += 1
+            # 再送も含めて、ホストごとの送信レートを超えないよう待つ
+            delay = self._rate_limiter.reserve(host)
+            if delay > 0:
+                self._sleep(delay)
+            try:
+                status_code = self._send(webhook_url, event_data)
+            except Exception as e:
+                logger.error("Error delivering webhook: %s, Error: %s", webhook_url, e)
+                status_code = None
+            if not _is_retryable(status_code, isinstance(event_data, list)) or attempts >= self.max_attempts:
+                break
+            # 指数バックオフ
+            self._sleep(self.backoff_seconds * (2 ** (attempts - 1)))
+        return {
+            'webhook_url': webhook_url,
+            'status_code': status_code,
+            'ok': _is_success(status_code),
+            'attempts': attempts,
+            'events': len(event_data) if isinstance(event_data, list) else 1,
+            'latency_ms': round((time.monotonic() - started) * 1000, 1),
+        }
+
+    def _run(self, host, webhook_url, event_data):
+        while True:
+            try:
+                result = self._deliver(host, webhook_url, event_data)
+            except Exception as e:
+                # 集計の失敗などでもdrain()が待ち続けないよう、必ず完了として数える
+                logger.error("Error delivering webhook: %s, Error: %s", webhook_url, e)
+                result = {'webhook_url': webhook_url, 'status_code': None, 'ok': False, 'attempts': 0,
+                          'events': len(event_data) if isinstance(event_data, list) else 1, 'latency_ms': 0.0}
+            with self._lock:
+                self.results.append(result)
+                self._pending -= 1
+                if self._pending == 0:
+                    self._idle.notify_all()
+                # 同じホストで待っている送信があれば、このスレッドで続けて送る
+                if not self._queues[host]:
+                    self._active[host] -= 1
+                    return
+                webhook_url, event_data = self._queues[host].popleft()
+
+    def drain(self, timeout=None):
+        """
+        積まれた送信がすべて終わるまで待つ。
+        戻り値は (配信結果のリスト, タイムアウトで未完了の送信数)
+        """
+        # まとめ送りで溜まったままの送信があれば先に積む
+        self.flush_batches()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._pending > 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._idle.wait(remaining)
+            results = list(self.results)
+            unfinished = self._pending
+        self._executor.shutdown(wait=False, cancel_futures=unfinished > 0)
+        return results, unfinished
+
+
+def summarize_deliveries(results, unfinished=0):
+    """配信結果の集計（ログ出力用）"""
+    latencies = sorted(result['latency_ms'] for result in results)
+    return {
+        'sent': len(results),
+        'events': sum(result.get('events', 1) for result in results),
+        'succeeded': sum(1 for result in results if result['ok']),
+        'failed': sum(1 for result in results if not result['ok']),
+        'retried': sum(1 for result in results if result['attempts'] > 1),
+        'unfinished': unfinished,
+        'latency_p50_ms': latencies[len(latencies) // 2] if latencies else None,
+        'latency_max_ms': latencies[-1] if latencies else None,
+    }
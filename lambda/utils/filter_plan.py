@@ -0,0 +1,230 @@
+from datetime import datetime, timezone
+
+from utils.geo import haversine_distance
+from utils.log import logger
+
+
+def stop_radius(stop_lat):
+    """停留所フィルターの判定半径（メートル）"""
+    # やんばる急行バスの場合のみ、半径を3kmに設定。やんばる急行バスは緯度が30度以下のはず！
+    if stop_lat and float(stop_lat) < 30.0:
+        return 3000
+    return 100
+
+
+def _parse_datetime(value):
+    """ISO形式の日時をナイーブなUTC日時に変換する（utcnow()と比較できるように）"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _circle(center_point, radius_meters):
+    """GeoJSON順の中心座標と半径を (経度, 緯度, 半径) のfloatタプルにする"""
+    return (float(center_point[0]), float(center_point[1]), float(radius_meters))
+
+
+def _compile_target_area(target_area):
+    """target_areaを検証して円のタプルに変換する。不正な形式ならNone"""
+    if isinstance(target_area, list):
+        points = target_area
+    elif isinstance(target_area, dict):
+        points = [target_area]
+    else:
+        return None
+    circles = []
+    for point in points:
+        # Validate GeoJSON Point format
+        if not isinstance(point, dict) or point.get('type') != 'Point' or 'coordinates' not in point:
+            return None
+        if 'radius' not in point.get('properties', {}):
+            return None
+        circles.append(_circle(point['coordinates'], point['properties']['radius']))
+    return tuple(circles)
+
+
+# 完全一致で判定するフィルター（転置インデックスに登録する優先順）
+INDEXED_FIELDS = ('trip_id', 'vehicle_id', 'route_id', 'direction_id')
+
+
+def vehicle_direction_id(vehicle):
+    """VehiclePositionのdirection_id。未設定ならNone"""
+    if not vehicle.trip.HasField('direction_id'):
+        return None
+    return vehicle.trip.direction_id
+
+
+def vehicle_keys(vehicle):
+    """転置インデックスを引くための車両側の値"""
+    return {
+        'trip_id': vehicle.trip.trip_id,
+        'vehicle_id': vehicle.vehicle.id,
+        'route_id': vehicle.trip.route_id,
+        'direction_id': vehicle_direction_id(vehicle),
+    }
+
+
+def vehicle_fingerprint(vehicle):
+    """
+    照合結果を左右する車両の状態。これが前回と同じ車両（停車中など）は照合し直さなくてよい。
+    VehiclePosition.timestampは停車中でも更新されるが照合には使わないので含めない。
+    """
+    return (
+        vehicle.position.latitude,
+        vehicle.position.longitude,
+        vehicle.trip.trip_id,
+        vehicle.trip.route_id,
+        vehicle_direction_id(vehicle),
+        vehicle.stop_id,
+    )
+
+
+class FilterPlan:
+    """
+    設定のfiltersを一度だけ解析した評価用の表現。
+    時刻に関する条件は is_active() でティックごとに1回、車両に関する条件は matches() で評価する。
+    """
+
+    __slots__ = ('trip_id', 'route_id', 'vehicle_id', 'direction_id', 'date', 'start_time', 'end_time', 'weekdays',
+                 'stop_circle', 'area_circles', 'never')
+
+    def __init__(self):
+        self.trip_id = None
+        self.route_id = None
+        self.vehicle_id = None
+        self.direction_id = None
+        self.date = None
+        self.start_time = None
+        self.end_time = None
+        self.weekdays = None
+        self.stop_circle = None  # (経度, 緯度, 半径)
+        self.area_circles = None  # ((経度, 緯度, 半径), ...)
+        self.never = False  # 決して一致しない設定（不正なフィルターや見つからない停留所）
+
+    def signature(self):
+        """プランの内容を表すハッシュ可能な値（設定が変更されたかどうかの判定用）"""
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def is_active(self, now):
+        """日付・曜日・時間帯の条件を判定する"""
+        if self.never:
+            return False
+        if self.date is not None and now.date() != self.date:
+            return False
+        if self.start_time is not None and now < self.start_time:
+            return False
+        if self.end_time is not None and now > self.end_time:
+            return False
+        if self.weekdays is not None and now.strftime('%A') not in self.weekdays:
+            return False
+        return True
+
+    def geofence(self):
+        """
+        車両位置に課す円の一覧（空間インデックス用）。位置条件がなければNone。
+        target_areaと停留所の両方がある場合はどちらも必要条件なので、target_areaの円を返す。
+        """
+        if self.area_circles is not None:
+            return self.area_circles
+        if self.stop_circle is not None:
+            return (self.stop_circle,)
+        return None
+
+    def area_only(self):
+        """
+        車両に課す条件がtarget_areaの円だけならTrue。
+        このプランの一致は空間インデックスの距離判定（いずれかの円の中にいるか）だけで決まる。
+        """
+        return (not self.never and self.area_circles is not None and self.stop_circle is None
+                and self.index_key() is None)
+
+    def index_key(self):
+        """
+        転置インデックスに登録するキー (フィールド名, 値)。完全一致の条件がなければNone。
+        複数ある場合は最も絞り込みの効くものを選ぶ。
+        """
+        for field in INDEXED_FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                return field, value
+        return None
+
+    def matches(self, vehicle):
+        """trip_id・route_id・vehicle_id・direction_idと位置の条件を判定する"""
+        if self.never:
+            return False
+        if self.trip_id and vehicle.trip.trip_id != self.trip_id:
+            return False
+        if self.route_id and vehicle.trip.route_id != self.route_id:
+            return False
+        if self.vehicle_id and vehicle.vehicle.id != self.vehicle_id:
+            return False
+        if self.direction_id is not None and vehicle_direction_id(vehicle) != self.direction_id:
+            return False
+        if self.stop_circle is None and self.area_circles is None:
+            return True
+
+        vehicle_location = [vehicle.position.longitude, vehicle.position.latitude]
+        if self.stop_circle is not None:
+            lon, lat, radius = self.stop_circle
+            if haversine_distance(vehicle_location, [lon, lat]) > radius:
+                return False
+        if self.area_circles is not None:
+            for lon, lat, radius in self.area_circles:
+                if haversine_distance(vehicle_location, [lon, lat]) <= radius:
+                    return True
+            return False
+        return True
+
+
+def compile_filters(filters, resolve_stop):
+    """
+    filtersをFilterPlanに変換する。
+    resolve_stop(stop_id) は (stop_name, stop_lat, stop_lon) を返す関数。
+    """
+    plan = FilterPlan()
+    try:
+        plan.trip_id = filters.get('trip_id') or None
+        plan.route_id = filters.get('route_id') or None
+        plan.vehicle_id = filters.get('vehicle_id') or None
+        direction_filter = filters.get('direction_id')
+        if direction_filter is not None and direction_filter != '':
+            # DynamoDBからはDecimalで返るのでintに揃える
+            plan.direction_id = int(direction_filter)
+
+        date_filter = filters.get('date')
+        if date_filter:
+            plan.date = datetime.strptime(date_filter, '%Y-%m-%d').date()
+        start_time_filter = filters.get('start_time')
+        if start_time_filter:
+            plan.start_time = _parse_datetime(start_time_filter)
+        end_time_filter = filters.get('end_time')
+        if end_time_filter:
+            plan.end_time = _parse_datetime(end_time_filter)
+        weekday_filter = filters.get('weekday')
+        if weekday_filter:
+            if isinstance(weekday_filter, str):
+                weekday_filter = [weekday_filter]
+            plan.weekdays = frozenset(weekday_filter)
+
+        target_area = filters.get('target_area')
+        if target_area:
+            plan.area_circles = _compile_target_area(target_area)
+            if plan.area_circles is None:
+                logger.warning("Invalid target_area format")
+                plan.never = True
+                return plan
+
+        stop_id_filter = filters.get('stop_id')
+        if stop_id_filter:
+            stop_name, stop_lat, stop_lon = resolve_stop(stop_id_filter)
+            if not stop_name:
+                plan.never = True
+                return plan
+            # 座標は他のジオフェンスと同じく [経度, 緯度] の順で扱う
+            plan.stop_circle = _circle([stop_lon, stop_lat], stop_radius(stop_lat))
+    except (TypeError, ValueError, IndexError, AttributeError) as e:
+        logger.warning("Invalid filters: %s, Error: %s", filters, e)
+        plan.never = True
+    return plan
@@ -1,5 +1,27 @@
 import math
 
+from utils.log import logger
+
+_np = None  # 読み込んだNumPy（ない環境ではFalse）
+
+EARTH_RADIUS_METERS = 6371000
+# ベクトル版とスカラー版の丸め誤差で境界上の車両を取りこぼさないための許容誤差（メートル）
+RADIUS_TOLERANCE_METERS = 1e-6
+
+def _numpy():
+    """
+    NumPyは読み込みが重く、ジオフェンスの設定がなければ使わないので、ベクトル計算で初めて使うときにimportする。
+    NumPyがない環境ではNoneを返し、スカラー版にフォールバックする。
+    """
+    global _np
+    if _np is None:
+        try:
+            import numpy
+            _np = numpy
+        except ImportError:
+            _np = False
+    return _np or None
+
 def haversine_distance(coord1, coord2):
     try:
         R = 6371000  # 地球の半径（メートル単位）
@@ -19,7 +41,7 @@ def haversine_distance(coord1, coord2):
         c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
         return R * c
     except Exception as e:
-        print(f"Error in haversine_distance calculation: {str(e)}")
+        logger.warning("Error in haversine_distance calculation: %s", e)
         return float('inf')  # 無効な距離を示す大きな値を返す
 
 def is_within_radius(vehicle_location, center_point, radius_meters):
@@ -41,3 +63,35 @@ def is_within_any_radius(vehicle_location, points_with_radius):
         if is_within_radius(vehicle_location, center_point, radius_meters):
             return True
     return False
+
+# ---------------------------------------------------------------------
+# バッチ判定API: NumPyがあればベクトル化し、なければ上のスカラー関数で計算する
+# ---------------------------------------------------------------------
+
+def _haversine_arrays(lon1, lat1, lon2, lat2):
+    """Vectorized haversine distance (meters) between broadcastable arrays of degrees."""
+    np = _numpy()
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    delta_phi = phi2 - phi1
+    delta_lambda = np.radians(lon2 - lon1)
+    a = np.sin(delta_phi / 2.0) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(delta_lambda / 2.0) ** 2
+    return EARTH_RADIUS_METERS * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def within_radius_indexed(vehicle_locations, center_points, radii, vehicle_ids, circle_ids):
+    """
+    Candidate pairs k = (vehicle_ids[k], circle_ids[k]) index into vehicle_locations and center_points/radii.
+    Returns the (vehicle_id, circle_id) pairs where the vehicle is within the circle.
+    """
+    np = _numpy()
+    if np is None:
+        return [(v, c) for v, c in zip(vehicle_ids, circle_ids)
+                if is_within_radius(vehicle_locations[v], center_points[c], radii[c])]
+    v = np.asarray(vehicle_ids, dtype=np.intp)
+    c = np.asarray(circle_ids, dtype=np.intp)
+    locations = np.asarray(vehicle_locations, dtype=float).reshape(-1, 2)[v]
+    centers = np.asarray(center_points, dtype=float).reshape(-1, 2)[c]
+    distances = _haversine_arrays(locations[:, 0], locations[:, 1], centers[:, 0], centers[:, 1])
+    inside = distances <= np.asarray(radii, dtype=float)[c] + RADIUS_TOLERANCE_METERS
+    return list(zip(v[inside].tolist(), c[inside].tolist()))
@@ -0,0 +1,90 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# ウォームスタートしたLambda間で使い回すセッション（ホストごとのKeep-Alive接続プールを持つ）
+_session = None
+_session_lock = threading.Lock()
+
+
+def default_timeout():
+    """(接続タイムアウト, 読み込みタイムアウト) 秒"""
+    return (
+        float(os.getenv('HTTP_CONNECT_TIMEOUT_SECONDS', 3.05)),
+        float(os.getenv('HTTP_READ_TIMEOUT_SECONDS', 10)),
+    )
+
+
+def retry_policy():
+    """(リトライ回数, 指数バックオフの基準秒数)"""
+    return int(os.getenv('HTTP_MAX_RETRIES', 2)), float(os.getenv('HTTP_RETRY_BACKOFF_SECONDS', 0.3))
+
+
+def max_request_seconds(timeout=None):
+    """
+    リトライも含めて、1回のリクエストがタイムアウトで失敗するまでにかかる秒数。
+    読み込みタイムアウトは受信の間隔の上限なので、少しずつ届く応答やRetry-Afterの待ち時間はこれを超えうる。
+    """
+    if timeout is None:
+        timeout = default_timeout()
+    connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    retries, backoff = retry_policy()
+    # urllib3は2回目以降の再送の前に backoff * 2 ** (n - 1) 秒（上限あり）待つ
+    sleeps = sum(min(backoff * 2 ** (n - 1), Retry.DEFAULT_BACKOFF_MAX) for n in range(2, retries + 1))
+    return (retries + 1) * (connect + read) + sleeps
+
+
+def create_session():
+    """接続プールとリトライ方針を設定したSessionを作成する"""
+    retries, backoff = retry_policy()
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 502, 503, 504),
+        # ステータスコード・読み込みエラーでの再送は冪等なメソッドだけ（接続エラーはPOSTでも再送される）
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=int(os.getenv('HTTP_POOL_CONNECTIONS', 16)),
+        pool_maxsize=int(os.getenv('HTTP_POOL_MAXSIZE', 32)),
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def reset_session():
+    """セッションを破棄する（設定変更時やテスト用）"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def _with_timeout(kwargs):
+    if kwargs.get('timeout') is None:
+        kwargs['timeout'] = default_timeout()
+    return kwargs
+
+
+def get(url, **kwargs):
+    return get_session().get(url, **_with_timeout(kwargs))
+
+
+def post(url, **kwargs):
+    return get_session().post(url, **_with_timeout(kwargs))
@@ -0,0 +1,28 @@
+class KeyIndex:
+    """
+    trip_id・vehicle_id・route_id・direction_id の値から、その値を条件に持つキーを引く転置インデックス。
+    車両はここで引いたキーと、完全一致の条件を持たない残りのキーだけを評価すればよい。
+    """
+
+    def __init__(self):
+        self._buckets = {}  # フィールド名 -> {値: [キー]}
+        self.size = 0
+
+    def add(self, field, value, key):
+        self._buckets.setdefault(field, {}).setdefault(value, []).append(key)
+        self.size += 1
+
+    def lookup(self, values):
+        """
+        values: {フィールド名: 車両側の値}
+        一致するキーの集合を返す
+        """
+        keys = set()
+        for field, buckets in self._buckets.items():
+            value = values.get(field)
+            if value is None:
+                continue
+            bucket = buckets.get(value)
+            if bucket:
+                keys.update(bucket)
+        return keys
@@ -0,0 +1,110 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+
+class Logger:
+    """
+    Lambdaの各モジュールで共有するログ出力。
+    - LOG_LEVEL（デフォルト: INFO）未満のメッセージは、引数を文字列にすることもなく捨てる
+    - メッセージは logger.info("... %s", value) のように渡し、出力するときだけ整形する
+    - 同じメッセージ（key、省略時は書式文字列）は window_seconds ごとに max_per_key 件までしか出さず、
+      抑止した件数は summary() の1行にまとめて出す
+    LOG_FORMAT=json なら1行1件のJSONで出力する。
+    """
+
+    def __init__(self, level=None, max_per_key=None, window_seconds=None, fmt=None, stream=None,
+                 clock=time.monotonic):
+        if level is None:
+            level = os.getenv('LOG_LEVEL', 'INFO')
+        if max_per_key is None:
+            max_per_key = int(os.getenv('LOG_MAX_PER_KEY', 20))
+        if window_seconds is None:
+            window_seconds = float(os.getenv('LOG_RATE_WINDOW_SECONDS', 60))
+        if fmt is None:
+            fmt = os.getenv('LOG_FORMAT', 'text')
+        self.level = LEVELS.get(str(level).upper(), INFO) if isinstance(level, str) else level
+        self.max_per_key = max_per_key
+        self.window_seconds = window_seconds
+        self.fmt = fmt
+        self._stream = stream
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._windows = {}  # key -> [窓の開始時刻, 窓内の件数]
+        self.begin_tick()
+
+    def begin_tick(self):
+        """summary() で出す集計をリセットする"""
+        with self._lock:
+            self.counts = defaultdict(int)  # レベル名 -> 出力した件数
+            self.suppressed = defaultdict(int)  # key -> 抑止した件数
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def _allow(self, key):
+        if self.max_per_key <= 0:
+            return True
+        now = self._clock()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.window_seconds:
+            window = self._windows[key] = [now, 0]
+        window[1] += 1
+        if window[1] <= self.max_per_key:
+            return True
+        self.suppressed[key] += 1
+        return False
+
+    def _write(self, level, message, fields):
+        if self.fmt == 'json':
+            line = json.dumps({'level': LEVEL_NAMES[level], 'message': message, **fields},
+                              ensure_ascii=False, default=str)
+        else:
+            line = f'[{LEVEL_NAMES[level]}] {message}'
+        print(line, file=self._stream or sys.stdout)
+
+    def log(self, level, message, *args, key=None, **fields):
+        if level < self.level:
+            return
+        with self._lock:
+            if not self._allow(key or message):
+                return
+            self.counts[LEVEL_NAMES[level]] += 1
+        if args:
+            message = message % args
+        self._write(level, message, fields)
+
+    def debug(self, message, *args, **kwargs):
+        self.log(DEBUG, message, *args, **kwargs)
+
+    def info(self, message, *args, **kwargs):
+        self.log(INFO, message, *args, **kwargs)
+
+    def warning(self, message, *args, **kwargs):
+        self.log(WARNING, message, *args, **kwargs)
+
+    def error(self, message, *args, **kwargs):
+        self.log(ERROR, message, *args, **kwargs)
+
+    def summary(self):
+        """前回の begin_tick() 以降の出力件数と抑止した件数を1行で出し、集計をリセットする"""
+        with self._lock:
+            counts, suppressed = dict(self.counts), dict(self.suppressed)
+        self.begin_tick()
+        if self.enabled(INFO):
+            self._write(INFO, f'Log summary: lines={counts} suppressed={suppressed}',
+                        {'lines': counts, 'suppressed': suppressed})
+        return {'lines': counts, 'suppressed': suppressed}
+
+
+logger = Logger()
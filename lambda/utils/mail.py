@@ -0,0 +1,148 @@
+import os
+import smtplib
+import threading
+import time
+from email.mime.text import MIMEText
+
+from utils.log import logger
+
+# 送信中に接続が切れたときに、接続し直して1度だけ再送するエラー
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError)
+# 宛先・本文を拒否されたエラー（sendmail() がRSETするので、接続はそのまま次の送信に使える）
+REJECTED_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+class SmtpSender:
+    """
+    STARTTLS・ログイン済みのSMTP接続を持ち、ウォームスタートしたLambda間で使い回して送信する。
+    - SMTP_IDLE_TIMEOUT_SECONDS（デフォルト: 60）より長く使っていない接続は、サーバー側で
+      切られている可能性が高いので、送信前に接続し直す
+    - 送信中に接続が切れていた場合は、接続し直して1度だけ再送する
+    smtplib.SMTPは複数スレッドから同時に使えないので、送信はロックで直列にする。
+    """
+
+    def __init__(self, host, port, user, password, sender=None, timeout=None, idle_timeout=None,
+                 smtp_factory=None, clock=time.monotonic):
+        if sender is None:
+            sender = os.getenv('SENDER_EMAIL')
+        if timeout is None:
+            timeout = float(os.getenv('SMTP_TIMEOUT_SECONDS', 10))
+        if idle_timeout is None:
+            idle_timeout = float(os.getenv('SMTP_IDLE_TIMEOUT_SECONDS', 60))
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.sender = sender
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._smtp_factory = smtp_factory
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._server = None
+        self._last_used = None
+
+    def _connect(self):
+        server = (self._smtp_factory or smtplib.SMTP)(self.host, self.port, timeout=self.timeout)
+        try:
+            server.starttls()
+            server.login(self.user, self.password)
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+        self._last_used = self._clock()
+        logger.debug("Connected to SMTP server %s:%s", self.host, self.port)
+
+    def _disconnect(self):
+        server, self._server = self._server, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def _connection(self):
+        if self._server is not None and self._clock() - self._last_used >= self.idle_timeout:
+            self._disconnect()
+        if self._server is None:
+            self._connect()
+        return self._server
+
+    def _message(self, to_email, subject, body):
+        msg = MIMEText(body, 'plain', 'utf-8')
+        msg['Subject'] = subject
+        msg['From'] = self.sender
+        msg['To'] = to_email
+        return msg
+
+    def _send(self, msg):
+        try:
+            self._connection().sendmail(msg['From'], msg['To'], msg.as_string())
+        except RECONNECT_ERRORS as e:
+            logger.warning("SMTP connection lost, reconnecting: %s", e)
+            self._disconnect()
+            self._connection().sendmail(msg['From'], msg['To'], msg.as_string())
+        self._last_used = self._clock()
+
+    def _discard_after(self, error):
+        # 状態のわからない接続は次の送信で使わない
+        if not isinstance(error, REJECTED_ERRORS):
+            self._disconnect()
+
+    def send(self, to_email, subject, body):
+        """1通送る（失敗した場合は例外を送出する）"""
+        msg = self._message(to_email, subject, body)
+        with self._lock:
+            try:
+                self._send(msg)
+            except Exception as e:
+                self._discard_after(e)
+                raise
+
+    def send_many(self, messages):
+        """
+        (宛先, 件名, 本文) のリストを1つの接続でまとめて送り、宛先ごとの結果を返す。
+        1通の失敗で残りの送信は止めない。
+        """
+        results = []
+        with self._lock:
+            for to_email, subject, body in messages:
+                try:
+                    self._send(self._message(to_email, subject, body))
+                    results.append({'email': to_email, 'success': True})
+                except Exception as e:
+                    logger.error("Error sending email to %s: %s", to_email, e)
+                    self._discard_after(e)
+                    results.append({'email': to_email, 'success': False, 'error': str(e)})
+        return results
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+
+# ウォームスタートしたLambda間で使い回す送信元（接続先・ユーザーごと）
+_senders = {}
+_senders_lock = threading.Lock()
+
+
+def get_sender(host, port, user, password):
+    key = (host, port, user, password)
+    sender = _senders.get(key)
+    if sender is None:
+        with _senders_lock:
+            sender = _senders.get(key)
+            if sender is None:
+                sender = _senders[key] = SmtpSender(host, port, user, password)
+    return sender
+
+
+def reset_senders():
+    """接続を閉じて送信元を破棄する（設定変更時やテスト用）"""
+    with _senders_lock:
+        senders = list(_senders.values())
+        _senders.clear()
+    for sender in senders:
+        sender.close()
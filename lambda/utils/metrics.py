@@ -0,0 +1,99 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# 単位を指定しないメトリクスの既定の単位
+DURATION_UNIT = 'Milliseconds'
+COUNT_UNIT = 'Count'
+# 既定以外の単位で出すカウンター
+COUNTER_UNITS = {'bytes_fetched': 'Bytes'}
+
+
+class TickMetrics:
+    """
+    ティック内のフェーズごとの所要時間とカウンターを集計し、CloudWatch Embedded Metric Format（EMF）の
+    JSONレコード1件として出力する。CloudWatch Logsに出力するだけでメトリクスとして取り込まれる。
+    feed を指定した計測はティック全体の値にも加算し、フィードごとの内訳はメトリクスではなく
+    レコードのプロパティ（Logs Insightsで検索できる）として出す。
+    フィードの取得は複数スレッドで並行するので、集計はロックで保護する。
+    """
+
+    def __init__(self, namespace=None, service=None, clock=time.perf_counter):
+        if namespace is None:
+            namespace = os.getenv('METRICS_NAMESPACE', 'GtfsRtTrigger')
+        self.namespace = namespace
+        self.service = service or 'scheduled_task'
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.begin_tick()
+
+    def begin_tick(self):
+        """集計をリセットする"""
+        with self._lock:
+            self.durations = defaultdict(float)  # フェーズ -> ミリ秒
+            self.counters = defaultdict(int)
+            self.feeds = defaultdict(lambda: {'durations': defaultdict(float), 'counters': defaultdict(int)})
+
+    @contextmanager
+    def timer(self, phase, feed=None):
+        """with で囲んだ処理の時間を phase の所要時間に加算する（例外で抜けた場合も加算する）"""
+        started = self._clock()
+        try:
+            yield
+        finally:
+            self.add_duration(phase, (self._clock() - started) * 1000, feed=feed)
+
+    def add_duration(self, phase, milliseconds, feed=None):
+        with self._lock:
+            self.durations[phase] += milliseconds
+            if feed is not None:
+                self.feeds[feed]['durations'][phase] += milliseconds
+
+    def count(self, name, value=1, feed=None):
+        with self._lock:
+            self.counters[name] += value
+            if feed is not None:
+                self.feeds[feed]['counters'][name] += value
+
+    def record(self, timestamp=None):
+        """EMFのレコードを作る"""
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            metrics = []
+            record = {'Service': self.service}
+            for phase, milliseconds in sorted(self.durations.items()):
+                name = f'{phase}_ms'
+                metrics.append({'Name': name, 'Unit': DURATION_UNIT})
+                record[name] = round(milliseconds, 3)
+            for name, value in sorted(self.counters.items()):
+                metrics.append({'Name': name, 'Unit': COUNTER_UNITS.get(name, COUNT_UNIT)})
+                record[name] = value
+            record['feeds'] = {
+                feed: {
+                    **{f'{phase}_ms': round(milliseconds, 3) for phase, milliseconds in values['durations'].items()},
+                    **values['counters'],
+                }
+                for feed, values in self.feeds.items()
+            }
+        record['_aws'] = {
+            'Timestamp': int(timestamp * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [['Service']],
+                'Metrics': metrics,
+            }],
+        }
+        return record
+
+    def emit(self):
+        """レコードを1行のJSONで出力し、集計をリセットする。何も計測していなければ出力しない"""
+        if not self.durations and not self.counters:
+            return None
+        record = self.record()
+        print(json.dumps(record, ensure_ascii=False))
+        self.begin_tick()
+        return record
@@ -0,0 +1,191 @@
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from utils import aws
+from utils.log import logger
+
+CPU = 'cpu'  # cProfileの関数ごとの統計（pstats）
+STACKS = 'stacks'  # サンプリングによる折りたたみスタック（flamegraph.pl / speedscope で読める）
+MEMORY = 'memory'  # tracemallocによる確保の多い行
+ALL_MODES = (CPU, STACKS, MEMORY)
+
+
+def _parse_modes(value):
+    if value is True:
+        return frozenset(ALL_MODES)
+    if not value:
+        return frozenset()
+    if isinstance(value, str):
+        value = value.split(',')
+    modes = frozenset(mode.strip() for mode in value if mode.strip())
+    return frozenset(ALL_MODES) if 'all' in modes else modes & frozenset(ALL_MODES)
+
+
+def profiling_modes(event, rng=random.random):
+    """
+    この実行でプロファイルを取る種類。
+    イベントの profile（true / "cpu,memory" / ["stacks"]）があればそれに従い、
+    なければ PROFILE_MODES の種類を PROFILE_SAMPLE_EVERY 回に1回（確率 1/N）だけ取る。
+    """
+    if isinstance(event, dict) and 'profile' in event:
+        return _parse_modes(event['profile'])
+    modes = _parse_modes(os.getenv('PROFILE_MODES', ''))
+    sample_every = int(os.getenv('PROFILE_SAMPLE_EVERY', 1))
+    if not modes or sample_every <= 0:
+        return frozenset()
+    if sample_every > 1 and rng() >= 1 / sample_every:
+        return frozenset()
+    return modes
+
+
+class StackSampler:
+    """
+    別スレッドから対象スレッドのスタックを interval 秒ごとに採取し、折りたたみスタックの形式で数える。
+    cProfileと違って対象の処理に計測のオーバーヘッドをほとんど載せない。
+    """
+
+    def __init__(self, thread_id=None, interval=None):
+        if interval is None:
+            interval = float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', 5)) / 1000
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _collapse(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is not None:
+            self.stacks[self._collapse(frame)] += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class ProfileSink:
+    """
+    プロファイルの出力先。PROFILE_SINK が s3://bucket/prefix ならS3、それ以外はディレクトリ
+    （デフォルト: 一時ディレクトリの gtfs-profiles）に書き込み、書き込んだ場所を返す。
+    """
+
+    def __init__(self, location=None):
+        if location is None:
+            location = os.getenv('PROFILE_SINK') or os.path.join(tempfile.gettempdir(), 'gtfs-profiles')
+        self.location = location
+
+    def write(self, name, content):
+        data = content if isinstance(content, bytes) else content.encode('utf-8')
+        if self.location.startswith('s3://'):
+            bucket, _, prefix = self.location[len('s3://'):].partition('/')
+            key = f"{prefix.rstrip('/')}/{name}" if prefix else name
+            aws.client('s3').put_object(Bucket=bucket, Key=key, Body=data)
+            return f's3://{bucket}/{key}'
+        os.makedirs(self.location, exist_ok=True)
+        path = os.path.join(self.location, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+
+def _pstats_text(stats, limit):
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
+
+
+def _allocations_text(snapshot, peak, limit):
+    lines = [f'peak traced memory: {peak} bytes']
+    for stat in snapshot.statistics('lineno')[:limit]:
+        frame = stat.traceback[0]
+        lines.append(f'{stat.size} bytes in {stat.count} blocks: {frame.filename}:{frame.lineno}')
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def profile(name, modes, sink=None, limit=None):
+    """
+    with の中の処理を modes の種類でプロファイルし、終了時に sink へ書き込む。
+    書き込んだ場所は yield する辞書に入る。modes が空なら何もしない。
+    """
+    outputs = {}
+    if not modes:
+        yield outputs
+        return
+    if limit is None:
+        limit = int(os.getenv('PROFILE_TOP_N', 50))
+    sink = sink or ProfileSink()
+    prefix = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')}-{name}"
+
+    profiler = cProfile.Profile() if CPU in modes else None
+    sampler = StackSampler() if STACKS in modes else None
+    started_tracing = MEMORY in modes and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(int(os.getenv('PROFILE_TRACEMALLOC_FRAMES', 1)))
+    if sampler is not None:
+        sampler.start()
+    if profiler is not None:
+        profiler.enable()
+    started = time.perf_counter()
+    try:
+        yield outputs
+    finally:
+        elapsed = time.perf_counter() - started
+        if profiler is not None:
+            profiler.disable()
+        if sampler is not None:
+            sampler.stop()
+        snapshot = peak = None
+        if MEMORY in modes and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            if started_tracing:
+                tracemalloc.stop()
+        # 出力に失敗しても本来の処理の結果には影響させない
+        try:
+            if profiler is not None:
+                stats = pstats.Stats(profiler)
+                # .pstats は pstats.Stats(path) や snakeviz でそのまま読める（Stats.dump_statsと同じ形式）
+                outputs['pstats_raw'] = sink.write(f'{prefix}.pstats', marshal.dumps(stats.stats))
+                outputs['pstats'] = sink.write(f'{prefix}.pstats.txt', _pstats_text(stats, limit))
+            if sampler is not None:
+                outputs['stacks'] = sink.write(f'{prefix}.folded', sampler.collapsed())
+            if snapshot is not None:
+                outputs['allocations'] = sink.write(f'{prefix}.allocations.txt', _allocations_text(snapshot, peak, limit))
+            logger.info("Profile of %s (%.3fs) written: %s", name, elapsed, outputs)
+        except Exception as e:
+            logger.error("Error writing profile of %s: %s", name, e)
@@ -0,0 +1,67 @@
+import json
+import os
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    持続レート rate（件/秒）とバースト burst のトークンバケット。
+    reserve() はトークンを前借りしてでも1つ予約し、使えるようになるまでの待ち秒数を返す（予約順に待つ）。
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._clock = clock
+        self._tokens = float(self.burst)
+        self._updated = clock()
+
+    def reserve(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate
+
+
+class HostRateLimiter:
+    """
+    宛先ホストごとのトークンバケット。
+    rate が0ならそのホストは制限しない。overrides でホストごとに {"rate": ..., "burst": ...} を上書きできる。
+    """
+
+    def __init__(self, rate=None, burst=None, overrides=None, clock=time.monotonic):
+        if rate is None:
+            rate = float(os.getenv('WEBHOOK_HOST_RATE_PER_SECOND', 0))
+        if burst is None:
+            burst = int(os.getenv('WEBHOOK_HOST_BURST', 10))
+        if overrides is None:
+            overrides = json.loads(os.getenv('WEBHOOK_HOST_RATE_LIMITS', '{}'))
+        self.rate = rate
+        self.burst = burst
+        self.overrides = overrides
+        self._clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host):
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            limits = self.overrides.get(host, {})
+            rate = float(limits.get('rate', self.rate))
+            if rate <= 0:
+                return None
+            bucket = TokenBucket(rate, int(limits.get('burst', self.burst)), clock=self._clock)
+            self._buckets[host] = bucket
+        return bucket
+
+    def reserve(self, host):
+        """hostへの送信を1件予約し、送信してよくなるまでの待ち秒数を返す"""
+        with self._lock:
+            bucket = self._bucket(host)
+            if bucket is None:
+                return 0.0
+            return bucket.reserve()
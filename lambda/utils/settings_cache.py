@@ -0,0 +1,180 @@
+import os
+import time
+
+from utils.db import SETTINGS_CHANGES_PARTITION, SETTINGS_VERSION_KEY, get_changes_table, key_condition, query_items
+from utils.log import logger
+
+
+def change_sort_key(version):
+    """変更履歴のソートキー（文字列順がバージョン順になるようゼロ埋めする）"""
+    return f'{int(version):012d}'
+
+
+def _setting_key(keys):
+    return (keys['gtfsRtEndpoint'], keys['userEmail'])
+
+
+def record_settings_change(event_name, keys, new_image=None, ttl_seconds=None, table=None):
+    """
+    設定の変更を変更履歴テーブルに書き込み、バージョンカウンターを進める。
+    event_name はDynamoDB Streamsと同じく 'INSERT' / 'MODIFY' / 'REMOVE'。
+    設定自体の書き込みは済んでいるので、失敗してもログを出すだけにする（スケジューラーは欠番を見て全件を読み直す）。
+    変更履歴テーブルが設定されていなければ何もしない（スケジューラーは毎回全件を読む）。
+    """
+    if table is None:
+        table = get_changes_table()
+        if table is None:
+            return None
+    if ttl_seconds is None:
+        ttl_seconds = int(os.getenv('SETTINGS_CHANGE_TTL_SECONDS', 86400))
+    try:
+        response = table.update_item(
+            Key=SETTINGS_VERSION_KEY,
+            UpdateExpression='ADD #version :one',
+            ExpressionAttributeNames={'#version': 'version'},
+            ExpressionAttributeValues={':one': 1},
+            ReturnValues='UPDATED_NEW',
+        )
+        version = int(response['Attributes']['version'])
+        change = {
+            'partition': SETTINGS_CHANGES_PARTITION,
+            'sequence': change_sort_key(version),
+            'version': version,
+            'eventName': event_name,
+            'Keys': {'gtfsRtEndpoint': keys['gtfsRtEndpoint'], 'userEmail': keys['userEmail']},
+            'expiresAt': int(time.time()) + ttl_seconds,
+        }
+        if new_image is not None:
+            change['NewImage'] = new_image
+        table.put_item(Item=change)
+        return version
+    except Exception as e:
+        logger.error("Error recording settings change: %s, Error: %s", keys, e)
+        return None
+
+
+class SettingsCache:
+    """
+    ウォームスタートしたLambda間で設定一覧を保持するキャッシュ。
+    ティックの開始時に変更履歴テーブルのバージョンカウンターを1件読み、変わっていればその間の変更履歴だけを反映する。
+    変更履歴に欠番がある（書き込み失敗やTTL切れ）場合や、max_age_seconds を過ぎた場合だけ全件をスキャンし直す。
+    """
+
+    def __init__(self, max_age_seconds=None, attributes=None):
+        if max_age_seconds is None:
+            max_age_seconds = float(os.getenv('SETTINGS_CACHE_MAX_AGE_SECONDS', 3600))
+        self.max_age_seconds = max_age_seconds
+        self.attributes = attributes
+        self._deserializer = None  # 変更ストリームを反映するときに作る
+        self.clear()
+
+    def clear(self):
+        self._items = {}  # (gtfsRtEndpoint, userEmail) -> 設定
+        self.version = None  # Noneなら次回は全件を読み直す
+        self.loaded_at = None
+        self.last_refresh = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def settings(self):
+        return list(self._items.values())
+
+    def _project(self, image):
+        if not self.attributes:
+            return dict(image)
+        return {name: image[name] for name in self.attributes if name in image}
+
+    def _read_version(self, table):
+        item = table.get_item(Key=SETTINGS_VERSION_KEY, ConsistentRead=True).get('Item') or {}
+        return int(item.get('version', 0))
+
+    def _read_changes(self, table, after_version):
+        """after_versionより新しい変更履歴をバージョン順に返す"""
+        return query_items(
+            table,
+            KeyConditionExpression=(key_condition('partition').eq(SETTINGS_CHANGES_PARTITION)
+                                    & key_condition('sequence').gt(change_sort_key(after_version))),
+            ConsistentRead=True,
+        )
+
+    def _apply(self, event_name, keys, image):
+        key = _setting_key(keys)
+        if event_name == 'REMOVE':
+            self._items.pop(key, None)
+        elif image is not None:
+            self._items[key] = self._project(image)
+
+    def apply_changes(self, changes):
+        """変更履歴のアイテム（eventName・Keys・NewImage）を反映する"""
+        for change in changes:
+            self._apply(change['eventName'], change['Keys'], change.get('NewImage'))
+
+    def apply_stream_records(self, records):
+        """DynamoDB Streams形式のレコード（型付きのKeys・NewImage）を反映する"""
+        if self._deserializer is None:
+            from boto3.dynamodb.types import TypeDeserializer
+            self._deserializer = TypeDeserializer()
+        for record in records:
+            stream = record['dynamodb']
+            keys = {name: self._deserializer.deserialize(value) for name, value in stream['Keys'].items()}
+            image = stream.get('NewImage')
+            if image is not None:
+                image = {name: self._deserializer.deserialize(value) for name, value in image.items()}
+            self._apply(record['eventName'], keys, image)
+
+    def _reload(self, table, load_all):
+        # 先にカウンターを読んでおけば、スキャン中の変更は次のティックで（冪等に）もう一度反映される
+        version = None
+        if table is not None:
+            try:
+                version = self._read_version(table)
+            except Exception as e:
+                logger.error("Error reading settings version: %s", e)
+        try:
+            items = load_all()
+        except Exception as e:
+            # 読み直しに失敗したら手元の一覧を使い続け、次のティックで再試行する
+            logger.error("Error reloading settings: %s", e)
+            self.version = None
+            self.last_refresh = {'mode': 'failed', 'changes': 0, 'items': len(self._items)}
+            return
+        self._items = {_setting_key(item): item for item in items}
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.last_refresh = {'mode': 'full', 'changes': 0, 'items': len(self._items)}
+
+    def _refresh_incrementally(self, table):
+        """変更履歴で追いつけたらTrue。全件の読み直しが必要ならFalse"""
+        latest = self._read_version(table)
+        if latest == self.version:
+            self.last_refresh = {'mode': 'unchanged', 'changes': 0, 'items': len(self._items)}
+            return True
+        if latest < self.version:
+            # カウンターが作り直された
+            return False
+        changes = self._read_changes(table, self.version)
+        versions = [int(change['version']) for change in changes if int(change['version']) <= latest]
+        if versions != list(range(self.version + 1, latest + 1)):
+            logger.warning("Settings change log has gaps between versions %s and %s", self.version, latest)
+            return False
+        self.apply_changes(changes[:len(versions)])
+        self.version = latest
+        self.last_refresh = {'mode': 'incremental', 'changes': len(versions), 'items': len(self._items)}
+        return True
+
+    def get_settings(self, table, load_all):
+        """
+        最新の設定一覧を返す。
+        table は変更履歴テーブル（Noneなら毎回全件を読み直す）。
+        load_all() は全件スキャンで設定のリストを返す関数（失敗時は例外を送出する）。
+        """
+        expired = self.loaded_at is None or time.monotonic() - self.loaded_at >= self.max_age_seconds
+        if self.version is not None and not expired:
+            try:
+                if self._refresh_incrementally(table):
+                    return self.settings()
+            except Exception as e:
+                logger.error("Error reading settings changes: %s", e)
+        self._reload(table, load_all)
+        return self.settings()
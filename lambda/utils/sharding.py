@@ -0,0 +1,180 @@
+import bisect
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import aws
+from utils.log import logger
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+def setting_shard_key(setting):
+    """設定をワーカーに割り当てるキー（設定のid。idのない古い設定はテーブルのキー）"""
+    return setting.get('id') or f"{setting['gtfsRtEndpoint']}#{setting['userEmail']}"
+
+
+class HashRing:
+    """
+    仮想ノード付きのコンシステントハッシュ。
+    ワーカーを増減しても割り当てが変わる設定は一部だけなので、各ワーカーのキャッシュ
+    （設定の評価プラン、前回の照合結果、出入りの状態）が温まったまま使える。
+    """
+
+    def __init__(self, nodes, replicas=None):
+        if replicas is None:
+            replicas = int(os.getenv('SHARD_VIRTUAL_NODES', 64))
+        self.nodes = list(nodes)
+        if not self.nodes:
+            raise ValueError('HashRing needs at least one node')
+        points = sorted((_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(max(replicas, 1)))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+    def partition(self, items, key):
+        """items をノードごとに分ける（key(item) が割り当てのキー）"""
+        partitions = {node: [] for node in self.nodes}
+        for item in items:
+            partitions[self.node_for(key(item))].append(item)
+        return partitions
+
+
+def _put_snapshot(content, suffix, bucket=None, directory=None):
+    """本文のダイジェストをキーにして保存し、参照（s3://... またはファイルパス）を返す"""
+    if bucket is None:
+        bucket = os.getenv('SCHEDULER_SNAPSHOT_BUCKET')
+    name = f'{hashlib.sha1(content).hexdigest()}{suffix}'
+    if bucket:
+        key = f'snapshots/{name}'
+        aws.client('s3').put_object(Bucket=bucket, Key=key, Body=content)
+        return f's3://{bucket}/{key}'
+    if directory is None:
+        directory = os.getenv('SCHEDULER_SNAPSHOT_DIR') or os.path.join(tempfile.gettempdir(), 'gtfs-snapshots')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+    return path
+
+
+def _get_snapshot(ref):
+    if ref.startswith('s3://'):
+        bucket, key = ref[len('s3://'):].split('/', 1)
+        return aws.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+    with open(ref, 'rb') as f:
+        return f.read()
+
+
+def put_feed_snapshot(content, bucket=None, directory=None):
+    """
+    コーディネーターが取得したフィードの本文を保存し、ワーカーに渡す参照（s3://... またはファイルパス）を返す。
+    本文のダイジェストをキーにするので、同じスナップショットを何度保存しても1つになる。
+    """
+    return _put_snapshot(content, '.pb', bucket, directory)
+
+
+def get_feed_snapshot(ref):
+    """put_feed_snapshot() の参照から本文を読む"""
+    return _get_snapshot(ref)
+
+
+def put_settings_snapshot(settings, bucket=None, directory=None):
+    """
+    ワーカーが担当する設定の一覧を保存し、参照を返す。
+    DynamoDBの型付きの形式（{'S': ...}）のJSONにするので、Decimalなどの値もそのまま読み戻せる。
+    """
+    from boto3.dynamodb.types import TypeSerializer
+
+    serializer = TypeSerializer()
+    items = [{name: serializer.serialize(value) for name, value in setting.items()} for setting in settings]
+    content = json.dumps(items, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return _put_snapshot(content, '.json', bucket, directory)
+
+
+def get_settings_snapshot(ref):
+    """put_settings_snapshot() の参照から設定の一覧を読む"""
+    from boto3.dynamodb.types import TypeDeserializer
+
+    deserializer = TypeDeserializer()
+    return [{name: deserializer.deserialize(value) for name, value in item.items()}
+            for item in json.loads(_get_snapshot(ref))]
+
+
+class LocalProcessBackend:
+    """
+    作業単位をローカルのプロセスで処理するバックエンド（Lambdaへのファンアウトの代わり）。
+    ノードごとに専用のプロセスを1つ持ち、同じノードの作業は常に同じプロセスで処理するので、
+    プロセス内のキャッシュがティックをまたいで温まったまま使える。
+    target(unit, context) はワーカーの処理で、戻り値は結果としてそのまま返す。
+    """
+
+    def __init__(self, target, timeout=None):
+        if timeout is None:
+            timeout = float(os.getenv('SCHEDULER_WORKER_TIMEOUT_SECONDS', 240))
+        self.target = target
+        self.timeout = timeout
+        self._executors = {}
+
+    def dispatch(self, units):
+        futures = []
+        for unit in units:
+            executor = self._executors.get(unit['node'])
+            if executor is None:
+                executor = self._executors[unit['node']] = ProcessPoolExecutor(max_workers=1)
+            futures.append((unit['node'], executor.submit(self.target, unit, None)))
+        results = []
+        for node, future in futures:
+            try:
+                results.append(future.result(timeout=self.timeout))
+            except Exception as e:
+                logger.error("Worker %s failed: %s", node, e)
+                results.append({'node': node, 'error': str(e)})
+        return results
+
+    def shutdown(self):
+        for executor in self._executors.values():
+            executor.shutdown(wait=True)
+        self._executors = {}
+
+
+class LambdaInvokeBackend:
+    """
+    作業単位をワーカーのLambda関数に非同期で渡すバックエンド。
+    ノード名をそのまま関数名（またはARN）として使い、ノードごとに別の関数にすることで
+    ウォームスタートしたコンテナのキャッシュが同じ設定の組に対して使われる。
+    非同期呼び出しなので、結果には受け付けたかどうか（StatusCode 202）だけが入る。
+    """
+
+    def __init__(self, client=None):
+        self._client = client
+
+    def _lambda(self):
+        if self._client is None:
+            self._client = aws.client('lambda')
+        return self._client
+
+    def dispatch(self, units):
+        results = []
+        for unit in units:
+            try:
+                response = self._lambda().invoke(
+                    FunctionName=unit['node'],
+                    InvocationType='Event',
+                    Payload=json.dumps(unit).encode('utf-8'),
+                )
+                results.append({'node': unit['node'], 'status_code': response.get('StatusCode')})
+            except Exception as e:
+                logger.error("Error invoking worker %s: %s", unit['node'], e)
+                results.append({'node': unit['node'], 'error': str(e)})
+        return results
@@ -0,0 +1,92 @@
+import math
+import os
+
+from utils.geo import within_radius_indexed
+
+METERS_PER_DEGREE = 111320.0  # 緯度1度あたりのおおよその距離（メートル）
+
+
+class GeofenceIndex:
+    """
+    円形ジオフェンス（中心座標と半径）を緯度経度グリッドのバケットに登録し、
+    車両位置から候補となるキーだけを引けるようにする空間インデックス。
+    candidates() はセル単位の候補（上位集合）を、matches_many() は距離判定まで行った結果を返す。
+    """
+
+    def __init__(self, cell_degrees=None, max_cells_per_circle=None):
+        if cell_degrees is None:
+            cell_degrees = float(os.getenv('GEOFENCE_CELL_DEGREES', 0.01))
+        if max_cells_per_circle is None:
+            max_cells_per_circle = int(os.getenv('GEOFENCE_MAX_CELLS_PER_CIRCLE', 2500))
+        self.cell_degrees = cell_degrees
+        self.max_cells_per_circle = max_cells_per_circle
+        self._cells = {}  # (lat_cell, lon_cell) -> [円の番号]
+        self._oversized = []  # セル数が多すぎる巨大な円は全車両で候補とする
+        self._centers = []  # 円の番号 -> [経度, 緯度]
+        self._radii = []
+        self._keys = []
+
+    def _cell(self, lon, lat):
+        return (math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees))
+
+    def add(self, center_point, radius_meters, key):
+        """
+        center_point: [longitude, latitude]
+        """
+        lon, lat = float(center_point[0]), float(center_point[1])
+        radius_meters = float(radius_meters)
+        circle_id = len(self._keys)
+        self._centers.append([lon, lat])
+        self._radii.append(radius_meters)
+        self._keys.append(key)
+
+        # 円を囲む矩形（経度方向は緯度に応じて広げる）
+        delta_lat = radius_meters / METERS_PER_DEGREE
+        cos_lat = max(math.cos(math.radians(min(abs(lat) + delta_lat, 90.0))), 0.01)
+        delta_lon = radius_meters / (METERS_PER_DEGREE * cos_lat)
+
+        lat_min, lon_min = self._cell(lon - delta_lon, lat - delta_lat)
+        lat_max, lon_max = self._cell(lon + delta_lon, lat + delta_lat)
+        if (lat_max - lat_min + 1) * (lon_max - lon_min + 1) > self.max_cells_per_circle:
+            self._oversized.append(circle_id)
+            return
+
+        for lat_cell in range(lat_min, lat_max + 1):
+            for lon_cell in range(lon_min, lon_max + 1):
+                self._cells.setdefault((lat_cell, lon_cell), []).append(circle_id)
+
+    @property
+    def circle_count(self):
+        return len(self._keys)
+
+    def _circle_ids(self, location):
+        circle_ids = self._cells.get(self._cell(float(location[0]), float(location[1])), [])
+        if self._oversized:
+            return circle_ids + self._oversized
+        return circle_ids
+
+    def candidates(self, location):
+        """
+        location: [longitude, latitude]
+        車両位置のセルに重なる円を持つキーの集合を返す
+        """
+        return {self._keys[circle_id] for circle_id in self._circle_ids(location)}
+
+    def matches_many(self, locations):
+        """
+        locations: [[longitude, latitude], ...]
+        各車両位置について、実際に位置を含む円を持つキーの集合のリストを返す。
+        グリッドで候補ペアを（車両と円の番号として）絞り込んだ後、距離判定はまとめてベクトル計算する。
+        """
+        vehicle_ids, circle_ids = [], []
+        for v, location in enumerate(locations):
+            ids = self._circle_ids(location)
+            vehicle_ids.extend([v] * len(ids))
+            circle_ids.extend(ids)
+
+        matches = [set() for _ in locations]
+        if not circle_ids:
+            return matches
+        for v, circle_id in within_radius_indexed(locations, self._centers, self._radii, vehicle_ids, circle_ids):
+            matches[v].add(self._keys[circle_id])
+        return matches
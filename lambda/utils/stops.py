@@ -0,0 +1,80 @@
+import os
+import time
+from utils import http
+from utils.log import logger
+
+
+def fetch_bus_stops(gtfs_id):
+    """BuTTER APIから指定gtfs_idの停留所一覧を取得する"""
+    api_base_url = os.getenv('API_BASE_URL')
+    api_url = f"{api_base_url}/getBusStops?gtfs_id={gtfs_id}"
+    response = http.get(api_url)
+    response.raise_for_status()
+    return response.json()
+
+
+class StopCatalog:
+    """
+    gtfs_idごとの停留所一覧をstop_idで索引化して保持するキャッシュ。
+    モジュールレベルで保持することでウォームスタートしたLambda間でも再利用する。
+    """
+
+    def __init__(self, ttl_seconds=None, fetch=fetch_bus_stops):
+        if ttl_seconds is None:
+            ttl_seconds = float(os.getenv('STOP_CATALOG_TTL_SECONDS', 3600))
+        self.ttl_seconds = ttl_seconds
+        self._fetch = fetch
+        self._stops = {}  # gtfs_id -> (取得時刻, {stop_id: stop})
+        self._failed = set()  # 現在のティックで取得に失敗したgtfs_id
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+
+    def begin_tick(self):
+        """ティック単位のカウンタと失敗記録をリセットする"""
+        self._failed.clear()
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'fetches': self.fetches}
+
+    def clear(self):
+        self._stops.clear()
+        self._failed.clear()
+
+    def _index(self, gtfs_id):
+        cached = self._stops.get(gtfs_id)
+        if cached and time.monotonic() - cached[0] < self.ttl_seconds:
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        # 同一ティック内で失敗したgtfs_idは再取得しない（失敗時のリトライ嵐を防ぐ）
+        if gtfs_id in self._failed:
+            return cached[1] if cached else None
+
+        try:
+            self.fetches += 1
+            stops_data = self._fetch(gtfs_id)
+        except Exception as e:
+            logger.error('Error fetching bus stops for gtfs_id: %s, Error: %s', gtfs_id, e)
+            self._failed.add(gtfs_id)
+            # TTL切れでも古い一覧があればそれを使い続ける
+            return cached[1] if cached else None
+
+        index = {stop['stop_id']: stop for stop in stops_data}
+        self._stops[gtfs_id] = (time.monotonic(), index)
+        logger.info('Stops data retrieved successfully from BuTTER API: %s (%d stops)', gtfs_id, len(index))
+        return index
+
+    def get(self, gtfs_id, stop_id):
+        """stop_idに対応する停留所を返す。見つからなければNone"""
+        index = self._index(gtfs_id)
+        if index is None:
+            return None
+        return index.get(stop_id)
+
+
+stop_catalog = StopCatalog()
@@ -0,0 +1,353 @@
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+
+from utils import aws
+from utils.db import key_condition, query_items
+from utils.log import logger
+
+ENTER = 'enter'
+EXIT = 'exit'
+DWELL = 'dwell'
+TRANSITIONS = frozenset((ENTER, EXIT, DWELL))
+
+# BatchGetItemで1回に読めるキーの数
+BATCH_GET_LIMIT = 100
+# TransactWriteItemsで1回に書き込めるアイテムの数
+TRANSACT_WRITE_LIMIT = 100
+
+
+def _epoch(now):
+    """ナイーブなUTC日時（utcnow()）をエポック秒にする"""
+    if now.tzinfo is None:
+        now = now.replace(tzinfo=timezone.utc)
+    return int(now.timestamp())
+
+
+def parse_notification_policy(filters, default_dwell_seconds):
+    """
+    filtersの notify_on（通知する遷移のリスト、デフォルトは入場のみ）と dwell_seconds を解釈する。
+    戻り値は (遷移の集合, 滞在通知の秒数。dwellを通知しなければNone)。解釈できない値ならValueErrorを送出する。
+    """
+    if not isinstance(filters, dict):
+        raise ValueError(f'filters must be an object: {filters!r}')
+    notify_on = filters.get('notify_on') or [ENTER]
+    if isinstance(notify_on, str):
+        notify_on = [notify_on]
+    if not isinstance(notify_on, (list, tuple, set, frozenset)) or not all(isinstance(name, str) for name in notify_on):
+        raise ValueError(f'notify_on must be a list of transitions: {notify_on!r}')
+    notify_on = frozenset(notify_on)
+    dwell_seconds = None
+    if DWELL in notify_on:
+        dwell_seconds = parse_dwell_seconds(filters.get('dwell_seconds') or default_dwell_seconds)
+    return notify_on, dwell_seconds
+
+
+def parse_dwell_seconds(value):
+    """滞在通知の秒数（0以上の有限の数）。解釈できない値ならValueErrorを送出する"""
+    if isinstance(value, bool):
+        raise ValueError(f'dwell_seconds must be a number of seconds: {value!r}')
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'dwell_seconds must be a number of seconds: {value!r}') from None
+    if not math.isfinite(seconds) or seconds < 0:
+        raise ValueError(f'dwell_seconds must be a number of seconds: {value!r}')
+    return seconds
+
+
+def setting_state_key(setting):
+    """状態テーブルのパーティションキー（設定テーブルのキーをつなげたもの）"""
+    return f"{setting['gtfsRtEndpoint']}#{setting['userEmail']}"
+
+
+class VehicleStateStore:
+    """
+    設定と車両の組ごとに「条件を満たす範囲の中にいるか」を保持し、出入りの遷移を判定する。
+    テーブルは設定ごとのパーティションに、中にいる組だけを記録する。
+    - 設定の記録は、そのコンテナで初めて照合するときに load() で一度だけ、設定ごとのQueryを並列に実行して読み込む
+    - 重なったティックや交代で動くコンテナが記録した出入りを反映するため、
+      前回から状態が変わった車両の一致した組だけを refresh() でBatchGetItemで読み直す
+    - transition() は手元の状態で遷移を判定して書き込みを予約するだけで、テーブルには書き込まない
+    - 通知する遷移は commit() でTransactWriteItemsにまとめ、手元の状態を条件にして確定させる。
+      ほかのコンテナが先に書き込んでいた組はテーブルの状態を読み直し、通知しない
+    - 通知しない遷移とTTLの延長は flush() でBatchWriteItemにまとめて書き込む
+    記録にはTTLを付ける。中にいるままフィードから消えた車両は退出（EXIT）を判定できず、記録は期限切れで消える。
+    table_name が空ならメモリ上だけで保持する。
+    """
+
+    def __init__(self, table_name=None, ttl_seconds=None, load_concurrency=None):
+        if table_name is None:
+            table_name = os.getenv('VEHICLE_STATE_TABLE_NAME')
+        if ttl_seconds is None:
+            ttl_seconds = int(os.getenv('VEHICLE_STATE_TTL_SECONDS', 21600))
+        if load_concurrency is None:
+            load_concurrency = int(os.getenv('VEHICLE_STATE_LOAD_CONCURRENCY', 8))
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+        self.load_concurrency = max(load_concurrency, 1)
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._states = {}  # 車両ID -> {設定のキー: {'enteredAt', 'dwellNotified', 'expiresAt'}}
+        self._pending = {}  # 予約した変更 (設定のキー, 車両ID) -> (書き込む状態（削除ならNone）, テーブル上の状態)
+        self._loaded = set()  # 記録を読み込んだ設定のキー
+        self._stats = {'writes': 0, 'conflicts': 0}
+
+    def _table(self):
+        return aws.table(self.table_name)
+
+    @staticmethod
+    def _state(item):
+        return {
+            'enteredAt': int(item['enteredAt']),
+            'dwellNotified': bool(item.get('dwellNotified', False)),
+            'expiresAt': int(item['expiresAt']),
+        }
+
+    def _remember(self, setting_key, vehicle_id, state):
+        if state is None:
+            self._states.get(vehicle_id, {}).pop(setting_key, None)
+        else:
+            self._states.setdefault(vehicle_id, {})[setting_key] = state
+
+    def _query(self, table, setting_key):
+        return query_items(table, KeyConditionExpression=key_condition('settingKey').eq(setting_key), ConsistentRead=True)
+
+    def _query_in_session(self, setting_key):
+        with aws.session_table(self.table_name) as table:
+            return self._query(table, setting_key)
+
+    def load(self, setting_keys):
+        """まだ読み込んでいない設定の記録をQueryで読み込む（コンテナごとに設定1件につき1回。複数の設定は並列に読む）"""
+        if not self.table_name:
+            return
+        with self._lock:
+            setting_keys = sorted(set(setting_keys) - self._loaded)
+            self._loaded.update(setting_keys)
+        if not setting_keys:
+            return
+        if len(setting_keys) == 1 or self.load_concurrency == 1:
+            table = self._table()
+            results = [(setting_key, self._try(self._query, table, setting_key)) for setting_key in setting_keys]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.load_concurrency, len(setting_keys))) as executor:
+                futures = [(setting_key, executor.submit(self._try, self._query_in_session, setting_key))
+                           for setting_key in setting_keys]
+                results = [(setting_key, future.result()) for setting_key, future in futures]
+        records = 0
+        with self._lock:
+            for setting_key, items in results:
+                if isinstance(items, Exception):
+                    # 読めなかった設定は次のティックで読み直す（それまでは状態が変わった車両の組だけを refresh() で確かめる）
+                    logger.error("Error loading vehicle states for %s: %s", setting_key, items)
+                    self._loaded.discard(setting_key)
+                    continue
+                for item in items:
+                    self._remember(setting_key, item['vehicleId'], self._state(item))
+                records += len(items)
+        logger.info("Loaded vehicle states for %d settings (%d records)", len(setting_keys), records)
+
+    @staticmethod
+    def _try(function, *args):
+        """例外を送出せずに戻り値として返す"""
+        try:
+            return function(*args)
+        except Exception as e:
+            return e
+
+    def refresh(self, pairs, max_attempts=3):
+        """
+        (設定のキー, 車両ID) の組の状態をBatchGetItem（強い整合性の読み込み）で読み直す。
+        テーブルにない組はメモリ上からも消す。読めなかった組は手元の状態のままにする。
+        """
+        if not self.table_name:
+            return
+        pairs = list({(setting_key, vehicle_id) for setting_key, vehicle_id in pairs if vehicle_id})
+        if not pairs:
+            return
+        resource = aws.resource('dynamodb')
+        found = {}
+        unread = set()
+        for start in range(0, len(pairs), BATCH_GET_LIMIT):
+            request = {self.table_name: {
+                'Keys': [{'settingKey': setting_key, 'vehicleId': vehicle_id}
+                         for setting_key, vehicle_id in pairs[start:start + BATCH_GET_LIMIT]],
+                'ConsistentRead': True,
+            }}
+            for attempt in range(max_attempts):
+                if attempt:
+                    time.sleep(0.05 * 2 ** attempt)
+                try:
+                    response = resource.batch_get_item(RequestItems=request)
+                except Exception as e:
+                    logger.error("Error reading vehicle states: %s", e)
+                    break
+                for item in response.get('Responses', {}).get(self.table_name, []):
+                    found[(item['settingKey'], item['vehicleId'])] = self._state(item)
+                request = response.get('UnprocessedKeys')
+                if not request:
+                    break
+            if request:
+                unread.update((key['settingKey'], key['vehicleId']) for key in request[self.table_name]['Keys'])
+        with self._lock:
+            for setting_key, vehicle_id in pairs:
+                if (setting_key, vehicle_id) not in unread:
+                    self._remember(setting_key, vehicle_id, found.get((setting_key, vehicle_id)))
+
+    def inside(self, vehicle_id, now):
+        """車両が中にいる設定のキーと状態（期限切れの記録は除く）"""
+        now_epoch = _epoch(now)
+        with self._lock:
+            states = self._states.get(vehicle_id, {})
+            return {key: state for key, state in states.items() if state['expiresAt'] > now_epoch}
+
+    def _stage(self, setting_key, vehicle_id, state, previous):
+        """変更を手元の状態に反映して書き込みを予約する（同じ組の変更が続いたら、最初のテーブル上の状態を条件にする）"""
+        pending = self._pending.get((setting_key, vehicle_id))
+        if pending is not None:
+            previous = pending[1]
+        self._pending[(setting_key, vehicle_id)] = (state, previous)
+        self._remember(setting_key, vehicle_id, state)
+
+    def transition(self, setting_key, vehicle_id, matched, now, dwell_seconds=None):
+        """
+        照合結果から状態を更新し、起きた遷移（ENTER / EXIT / DWELL）を返す。遷移がなければNone。
+        dwell_seconds を指定すると、その秒数以上中にいる車両で一度だけ DWELL を返す。
+        テーブルへの書き込みは予約するだけなので、通知する遷移は commit() で確定させてから通知する。
+        """
+        if not vehicle_id:
+            # IDのない車両は追跡できないので、一致するたびに入場として扱う
+            return ENTER if matched else None
+        now_epoch = _epoch(now)
+        with self._lock:
+            state = self._states.get(vehicle_id, {}).get(setting_key)
+            if state is not None and state['expiresAt'] <= now_epoch:
+                state = None
+            if not matched:
+                if state is None:
+                    return None
+                self._stage(setting_key, vehicle_id, None, state)
+                return EXIT
+            if state is None:
+                entered = {'enteredAt': now_epoch, 'dwellNotified': False, 'expiresAt': now_epoch + self.ttl_seconds}
+                self._stage(setting_key, vehicle_id, entered, None)
+                return ENTER
+            if dwell_seconds is not None and not state['dwellNotified'] and now_epoch - state['enteredAt'] >= dwell_seconds:
+                self._stage(setting_key, vehicle_id, dict(state, dwellNotified=True, expiresAt=now_epoch + self.ttl_seconds), state)
+                return DWELL
+            if state['expiresAt'] - now_epoch < self.ttl_seconds / 2:
+                # 長く中にいる車両の記録が期限切れにならないよう、TTLを延ばす
+                self._stage(setting_key, vehicle_id, dict(state, expiresAt=now_epoch + self.ttl_seconds), state)
+            return None
+
+    def _transact_item(self, setting_key, vehicle_id, state, previous):
+        """手元の状態（previous）がテーブルでも変わっていない場合だけ書き込む、TransactWriteItemsの1件"""
+        key = {'settingKey': setting_key, 'vehicleId': vehicle_id}
+        if state is None:
+            return {'Delete': {
+                'TableName': self.table_name,
+                'Key': key,
+                'ConditionExpression': 'enteredAt = :entered',
+                'ExpressionAttributeValues': {':entered': previous['enteredAt']},
+            }}
+        if previous is None:
+            # 期限切れでまだ消えていない記録は、中にいないものとして上書きする
+            condition = 'attribute_not_exists(settingKey) OR expiresAt <= :now'
+            values = {':now': state['enteredAt']}
+        else:
+            condition = 'enteredAt = :entered AND dwellNotified = :dwell'
+            values = {':entered': previous['enteredAt'], ':dwell': previous['dwellNotified']}
+        return {'Put': {
+            'TableName': self.table_name,
+            'Item': dict(state, **key),
+            'ConditionExpression': condition,
+            'ExpressionAttributeValues': values,
+        }}
+
+    def commit(self, pairs, max_attempts=3):
+        """
+        通知する遷移の組 (設定のキー, 車両ID) について予約した変更を、テーブル上の状態を条件にした
+        TransactWriteItems（100件ずつ）でまとめて確定させる。
+        ほかのコンテナが先に書き込んでいた組の集合を返す（テーブルの状態を読み直してあるので、通知しない）。
+        条件以外の理由で書き込めなかった組は通知を止めず、flush() でもう一度書き込む。
+        """
+        if not self.table_name:
+            return set()
+        with self._lock:
+            writes = {pair: self._pending.pop(pair) for pair in set(pairs) if pair in self._pending}
+        if not writes:
+            return set()
+        from botocore.exceptions import ClientError
+
+        client = aws.resource('dynamodb').meta.client  # リソースのクライアントはPythonの値をそのまま受け付ける
+        conflicts = set()
+        failed = []
+        written = 0
+        remaining = list(writes)
+        for attempt in range(max_attempts):
+            if attempt:
+                time.sleep(0.05 * 2 ** attempt)
+            retry = []
+            for start in range(0, len(remaining), TRANSACT_WRITE_LIMIT):
+                chunk = remaining[start:start + TRANSACT_WRITE_LIMIT]
+                try:
+                    client.transact_write_items(
+                        TransactItems=[self._transact_item(*pair, *writes[pair]) for pair in chunk])
+                except ClientError as e:
+                    if e.response.get('Error', {}).get('Code') != 'TransactionCanceledException':
+                        logger.error("Error writing vehicle states: %s", e)
+                        failed.extend(chunk)
+                        continue
+                    # 1件でも条件を満たさなければ全体が取り消されるので、条件を満たさなかった組を除いて再送する
+                    reasons = e.response.get('CancellationReasons') or []
+                    for pair, reason in zip(chunk, reasons):
+                        if reason.get('Code') == 'ConditionalCheckFailed':
+                            conflicts.add(pair)
+                    retry.extend(pair for pair in chunk if pair not in conflicts)
+                except Exception as e:
+                    logger.error("Error writing vehicle states: %s", e)
+                    failed.extend(chunk)
+                else:
+                    written += len(chunk)
+            remaining = retry
+            if not remaining:
+                break
+        failed.extend(remaining)
+        with self._lock:
+            for pair in failed:
+                self._pending.setdefault(pair, writes[pair])
+            self._stats['writes'] += written
+            self._stats['conflicts'] += len(conflicts)
+        if conflicts:
+            self.refresh(conflicts)
+        return conflicts
+
+    def flush(self):
+        """
+        ティック中の書き込み件数を返し、予約したままの変更（通知しない遷移・TTLの延長・確定に失敗した変更）を
+        BatchWriteItemでまとめて書き込む（メモリ上だけで保持する場合は変更の件数を返す）
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            stats, self._stats = self._stats, {'writes': 0, 'conflicts': 0}
+        stats['puts'] = sum(1 for state, _ in pending.values() if state is not None)
+        stats['deletes'] = sum(1 for state, _ in pending.values() if state is None)
+        if not pending or not self.table_name:
+            return stats
+        try:
+            # batch_writerは25件ずつのBatchWriteItemに分け、未処理のアイテムを再送する
+            with self._table().batch_writer() as batch:
+                for (setting_key, vehicle_id), (state, _) in pending.items():
+                    if state is None:
+                        batch.delete_item(Key={'settingKey': setting_key, 'vehicleId': vehicle_id})
+                    else:
+                        batch.put_item(Item=dict(state, settingKey=setting_key, vehicleId=vehicle_id))
+        except Exception as e:
+            logger.error("Error writing vehicle states: %s", e)
+            stats['errors'] = len(pending)
+        return stats
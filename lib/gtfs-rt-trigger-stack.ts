@@ -22,6 +22,19 @@ export class GtfsRtWebhookStack extends cdk.Stack {
       sortKey: { name: 'userEmail', type: dynamodb.AttributeType.STRING },
       billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
     });
+    // メールアドレスでの検索用（handler.pyのGETとdelete_alert.py）。既存のアイテムには backfill_user_email_key.py でキーを付ける
+    settingsTable.addGlobalSecondaryIndex({
+      indexName: 'UserEmailIndex',
+      partitionKey: { name: 'userEmailKey', type: dynamodb.AttributeType.STRING },
+    });
+
+    // 設定のバージョンと変更履歴（設定テーブルのスキャンに混ざらないよう別テーブルに置き、履歴は期限切れで削除する）
+    const settingsChangesTable = new dynamodb.Table(this, `SettingsChangesTable${SUFFIX}`, {
+      partitionKey: { name: 'partition', type: dynamodb.AttributeType.STRING },
+      sortKey: { name: 'sequence', type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: 'expiresAt',
+    });
 
     // これまでに作成されたアラート一覧
     const settingsTableForTrace = new dynamodb.Table(this, `SettingsTableForTrace${SUFFIX}`, {
@@ -38,6 +51,7 @@ export class GtfsRtWebhookStack extends cdk.Stack {
       environment: {
         SETTINGS_TABLE_NAME: settingsTable.tableName,
         SETTINGS_TABLE_NAME_FOR_TRACE: settingsTableForTrace.tableName,
+        SETTINGS_CHANGES_TABLE_NAME: settingsChangesTable.tableName,
         API_BASE_URL: process.env.API_BASE_URL ?? '',
       },
       architecture: lambda.Architecture.ARM_64,
@@ -48,6 +62,7 @@ export class GtfsRtWebhookStack extends cdk.Stack {
     // LambdaにDynamoDBのアクセス権限を付与
     settingsTable.grantFullAccess(saveSettingsLambda);
     settingsTableForTrace.grantFullAccess(saveSettingsLambda);
+    settingsChangesTable.grantReadWriteData(saveSettingsLambda);
 
     // API Gatewayで設定管理用エンドポイントを作成
     const api = new apigateway.RestApi(this, `GtfsSettingsApi${SUFFIX}`, {
@@ -90,6 +105,14 @@ export class GtfsRtWebhookStack extends cdk.Stack {
 
     const lambdaLayers = [lambda.LayerVersion.fromLayerVersionArn(this, `lambdaLayer${SUFFIX}`, 'arn:aws:lambda:ap-northeast-1:211125380625:layer:gtfs-rt-trigger:2')]
 
+    // 設定と車両の組ごとの出入りの状態（範囲内にいる組だけを保持し、期限切れで削除する）
+    const vehicleStateTable = new dynamodb.Table(this, `VehicleStateTable${SUFFIX}`, {
+      partitionKey: { name: 'settingKey', type: dynamodb.AttributeType.STRING },
+      sortKey: { name: 'vehicleId', type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: 'expiresAt',
+    });
+
     // スケジュール実行するLambda関数の作成
     const scheduledLambda = new lambda.Function(this, `ScheduledGtfsLambda${SUFFIX}`, {
       runtime: lambda.Runtime.PYTHON_3_12,
@@ -97,6 +120,8 @@ export class GtfsRtWebhookStack extends cdk.Stack {
       code: lambda.Code.fromAsset('lambda'),
       environment: {
         SETTINGS_TABLE_NAME: settingsTable.tableName,
+        SETTINGS_CHANGES_TABLE_NAME: settingsChangesTable.tableName,
+        VEHICLE_STATE_TABLE_NAME: vehicleStateTable.tableName,
         API_BASE_URL: process.env.API_BASE_URL ?? '',
       },
       timeout: cdk.Duration.seconds(300), // 必要に応じて調整
@@ -107,6 +132,8 @@ export class GtfsRtWebhookStack extends cdk.Stack {
 
     // LambdaにDynamoDBの読み取り権限を付与
     settingsTable.grantFullAccess(scheduledLambda);
+    settingsChangesTable.grantReadData(scheduledLambda);
+    vehicleStateTable.grantReadWriteData(scheduledLambda);
 
     // Lambdaに外部へのアクセス許可を付与（GTFS-RTデータ取得とWebHook呼び出しのため）
     scheduledLambda.addToRolePolicy(new cdk.aws_iam.PolicyStatement({
@@ -114,6 +141,47 @@ export class GtfsRtWebhookStack extends cdk.Stack {
       resources: ['*'],
     }));
 
+    // シャーディング実行（SCHEDULER_WORKER_COUNT > 0）では、スケジュール実行するLambdaはコーディネーターになり、
+    // フィードのスナップショットをS3に置いて、設定のidで割り当てたワーカーのLambdaに照合を任せる
+    const workerCount = Number(process.env.SCHEDULER_WORKER_COUNT ?? '0');
+    if (workerCount > 0) {
+      const snapshotBucket = new s3.Bucket(this, `FeedSnapshotBucket${SUFFIX}`, {
+        removalPolicy: cdk.RemovalPolicy.DESTROY,
+        autoDeleteObjects: true,
+        lifecycleRules: [{ expiration: cdk.Duration.days(1) }],
+      });
+      const workerLambdas = [...Array(workerCount).keys()].map((i) => {
+        const workerLambda = new lambda.Function(this, `ScheduledGtfsWorkerLambda${i}${SUFFIX}`, {
+          runtime: lambda.Runtime.PYTHON_3_12,
+          handler: 'scheduled_task.worker_task',
+          code: lambda.Code.fromAsset('lambda'),
+          environment: {
+            SETTINGS_TABLE_NAME: settingsTable.tableName,
+            SETTINGS_CHANGES_TABLE_NAME: settingsChangesTable.tableName,
+            VEHICLE_STATE_TABLE_NAME: vehicleStateTable.tableName,
+            API_BASE_URL: process.env.API_BASE_URL ?? '',
+          },
+          timeout: cdk.Duration.seconds(300),
+          layers: lambdaLayers,
+          architecture: lambda.Architecture.ARM_64,
+          memorySize: 2048,
+          // 作業単位は毎分届くので、失敗した回は再試行しない
+          retryAttempts: 0,
+        });
+        settingsTable.grantReadWriteData(workerLambda);
+        settingsChangesTable.grantReadData(workerLambda);
+        vehicleStateTable.grantReadWriteData(workerLambda);
+        snapshotBucket.grantRead(workerLambda);
+        workerLambda.grantInvoke(scheduledLambda);
+        return workerLambda;
+      });
+      snapshotBucket.grantWrite(scheduledLambda);
+      scheduledLambda.addEnvironment('SCHEDULER_MODE', 'coordinator');
+      scheduledLambda.addEnvironment('SCHEDULER_BACKEND', 'lambda');
+      scheduledLambda.addEnvironment('SCHEDULER_SNAPSHOT_BUCKET', snapshotBucket.bucketName);
+      scheduledLambda.addEnvironment('SCHEDULER_WORKERS', workerLambdas.map((workerLambda) => workerLambda.functionName).join(','));
+    }
+
     // EventBridgeルールの作成（1分ごとにLambdaをトリガー）
     new events.Rule(this, `ScheduleRule${SUFFIX}`, {
       schedule: events.Schedule.rate(cdk.Duration.minutes(1)),
@@ -157,12 +225,14 @@ export class GtfsRtWebhookStack extends cdk.Stack {
       code: lambda.Code.fromAsset('lambda'),
       environment: {
         SETTINGS_TABLE_NAME: settingsTable.tableName,
+        SETTINGS_CHANGES_TABLE_NAME: settingsChangesTable.tableName,
       },
       architecture: lambda.Architecture.ARM_64,
       memorySize: 128,
       timeout: cdk.Duration.seconds(900),
     });
     settingsTable.grantReadWriteData(deleteAlarmLambda);
+    settingsChangesTable.grantReadWriteData(deleteAlarmLambda);
 
     const deleteAlarm = api.root.addResource('delete-alarm');
     const deleteAlarmIntegration = new apigateway.LambdaIntegration(deleteAlarmLambda, {